@@ -9,30 +9,80 @@
 
 
 import os
+from shutil import disk_usage, rmtree
 from socket import timeout
 from sys import argv
 from getopt import getopt, GetoptError
 from signal import signal, pause, SIGINT, SIGTERM, SIG_IGN
-from multiprocessing import Process
+from multiprocessing import Process, Value
 from multiprocessing.managers import SyncManager
-from time import strptime, strftime, gmtime
-from calendar import timegm
-from lib.server import udp_client, udp_server, tcp_server
+from time import strftime, gmtime, monotonic, sleep
+from lib.server import udp_client, udp_server, tcp_client, tcp_server
+from lib.storage import (is_internal, is_packed, entry_digest, load_index, read_index,
+                         save_index, update_index, drop_entries, cached_listing,
+                         format_listing,
+                         folder_lock, upload_lock, move_lock,
+                         trash_folder, reclaim_trash, unaccounted_trash,
+                         write_temp, discard_temp, commit_due, commit_files,
+                         remove_stale_temps, DURABILITY_LEVELS)
+from lib.metrics import (init_metrics, timed, count, count_tcp_bytes,
+                         format_sta, serve_metrics)
+from lib.log import (log, init_logging, stop_logging, parse_levels,
+                     DEBUG, INFO, WARNING, ERROR)
+from lib.bandwidth import (RESTORE_WEIGHT, BACKUP_WEIGHT, init_scheduler,
+                           parse_rate, stream, capped, throttled)
+from lib.quota import (init_quota, load_usage, user_usage, release,
+                       account)
+from lib.snapshot import (SNAPSHOT_KEEP, SNAPSHOT_DIR, is_snapshot_id, snapshot_path,
+                          list_snapshots, find_snapshot, take_snapshot, prune_snapshots,
+                          link_folder)
+from lib.packfile import (PACK_MAX_FILE, COMPACT_INTERVAL, open_segment,
+                          close_segment, append, open_entries, send_packed,
+                          compact_folder)
+from lib.protocol import (recv_frame, send_frame, send_message, accept_version,
+                          offer_version, negotiated, read_reply, parse_mtime,
+                          CHECKSUM)
+from lib.checksum import new_digest, digested, verify_folder
 from lib.utils import (read_bytes_until, chunked_read_socket, chunked_read_fd,
                        DEFAULT_CS_PORT, DEFAULT_BS_PORT, BS_USER_SAVEFILE,
+                       BS_USAGE_SAVEFILE,
+                       BS_REPORT_INTERVAL, BS_HEARTBEAT_INTERVAL,
                        backup_dict_to_file, restore_dict_from_file,
                        ignore_sigint, print_connection_event,
-                       get_best_ip)
+                       get_best_ip, is_safe_path)
+
+
+TCP_COMMANDS = ("AUT", "UPL", "RSB", "MIG", "SNP")
+TEXT_LINE_COMMANDS = ("VER", "AUT", "RSB", "MIG") # their arguments are the rest of the line
+UDP_COMMANDS = ("LSU", "DLB", "LSF", "LSC", "LSN", "LSQ", "STA")
+COUNTERS = ("bytes_in", "bytes_out", "connections", "workers", "streams",
+            "throttled_ms", "scrubbed_bytes", "corrupt_files")
+
+# Deleted folders are reclaimed every RECLAIM_INTERVAL seconds, removing at
+# most RECLAIM_RATE files per second (RECLAIM_BUSY_RATE during transfers)
+RECLAIM_INTERVAL = 1
+RECLAIM_RATE = 2000
+RECLAIM_BUSY_RATE = 200
+
+MIGRATION_TIMEOUT = 60      # seconds the BS a folder is moved to may take to answer
+
+# Stored files are re-read every SCRUB_PERIOD seconds, the first time
+# SCRUB_DELAY seconds after start, at most at SCRUB_RATE bytes per second
+SCRUB_RATE = 4 * 1024 * 1024
+SCRUB_PERIOD = 24 * 3600
+SCRUB_DELAY = 60
+
+MAX_UDP_REPLY = 65507       # larger listings do not fit in a datagram
 
 # Functions to register/deregister from CS (UDP client)
 
-def register_in_cs(cs_host, cs_port, my_address, my_port):
-    """ Contact the CS via UDP to register itself """
+def register_in_cs(cs_host, cs_port, my_address, my_port, load):
+    """ Contact the CS via UDP to register itself, reporting its load """
 
     try:
         cs_socket = udp_client(cs_host, cs_port)
 
-        message = "REG {} {}\n".format(my_address, my_port)
+        message = "REG {} {} {} {} {} {}\n".format(my_address, my_port, *load)
         print_connection_event((cs_host, cs_port), "Registering in CS Server", message[:-1], "<-")
         cs_socket.sendall(message.encode())
 
@@ -50,10 +100,10 @@ def register_in_cs(cs_host, cs_port, my_address, my_port):
         return res
 
     except timeout:
-        print("Error: CS server took too long to respond.")
+        log(ERROR, "CS server took too long to respond.")
         exit(1)
     except (ConnectionError, ConnectionRefusedError):
-        print("Error: CS server does not seem active. Shutting down.\n")
+        log(ERROR, "CS server does not seem active. Shutting down.")
         exit(1)
 
 
@@ -62,7 +112,6 @@ def unregister_from_cs(cs_host, cs_port, my_address, my_port):
 
     try:
         cs_socket = udp_client(cs_host, cs_port)
-        print()
         print_connection_event((cs_host, cs_port), "Unregistering from CS", "", "<-")
 
         cs_socket.sendall("UNR {} {}\n".format(my_address, my_port).encode())
@@ -71,15 +120,192 @@ def unregister_from_cs(cs_host, cs_port, my_address, my_port):
         return response == "UAR OK\n"
 
     except timeout:
-        print("Error: CS server took too long to respond.")
-        print("Shutting down uncleanly.\n")
+        log(ERROR, "CS server took too long to respond.")
+        log(ERROR, "Shutting down uncleanly.")
         exit(1)
     except ConnectionError:
-        print("Error: CS server does not seem active.")
-        print("Shutting down uncleanly.\n")
+        log(ERROR, "CS server does not seem active.")
+        log(ERROR, "Shutting down uncleanly.")
         exit(1)
 
 
+def add_to_counter(counter, amount):
+    """ Atomically adds amount to a shared multiprocessing.Value """
+    with counter.get_lock():
+        counter.value += amount
+
+
+def current_load(transfers, throughput=0):
+    """ Load reported to the CS: (free, total, active transfers, throughput) """
+    usage = disk_usage(".")
+    return (usage.free, usage.total, transfers.value, throughput)
+
+
+def report_to_cs(cs_host, cs_port, my_address, my_port, transfers, moved):
+    """ Heartbeat and load reporter process function / program
+
+    Every BS_HEARTBEAT_INTERVAL seconds sends a heartbeat to the CS (HBT),
+    so that it knows this BS is alive. Every BS_REPORT_INTERVAL seconds it
+    also sends the current load (STS), with the throughput (bytes/s)
+    measured since the previous report. The CS does not respond to either;
+    a lost message is simply replaced by the next one.
+    """
+
+    def signal_handler(_signum, _frame):
+        cs_socket.close()
+        exit(0)
+
+
+    cs_socket = udp_client(cs_host, cs_port)
+
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, signal_handler)
+
+    heartbeat = "HBT {} {}\n".format(my_address, my_port)
+    last_moved, last_time = moved.value, monotonic()
+    while True:
+        sleep(BS_HEARTBEAT_INTERVAL)
+        message = heartbeat
+
+        now_moved, now = moved.value, monotonic()
+        if now - last_time >= BS_REPORT_INTERVAL:
+            throughput = int((now_moved - last_moved) / (now - last_time))
+            last_moved, last_time = now_moved, now
+            message = "STS {} {} {} {} {} {}\n".format(my_address, my_port,
+                                                    *current_load(transfers, throughput))
+
+        try:
+            cs_socket.sendall(message.encode())
+        except ConnectionError:
+            pass # CS not listening right now, try again on next beat
+
+
+def compact_packs(known_users):
+    """ Compactor process function / program
+
+    Every COMPACT_INTERVAL seconds goes through the folders of every user,
+    reclaiming the space of pack segments mostly taken by replaced files,
+    and of temporary files left behind by uploads interrupted by a crash.
+    """
+
+    def signal_handler(_signum, _frame):
+        exit(0)
+
+
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, signal_handler)
+
+    while True:
+        sleep(COMPACT_INTERVAL)
+
+        for user in known_users.keys():
+            if not os.path.isdir(user):
+                continue
+            for folder in os.scandir(user):
+                if not folder.is_dir():
+                    continue
+                try:
+                    remove_stale_temps(folder.path)
+                    reclaimed = compact_folder(folder.path)
+                except FileNotFoundError:
+                    continue # folder removed meanwhile
+                if reclaimed:
+                    log(INFO, "Compacted {}: {} bytes reclaimed".format(folder.path, reclaimed))
+
+
+def reclaim_space(transfers):
+    """ Trash reclaimer process function / program
+
+    Removes the files of the folders deleted (see remove_dir) in the
+    background, at the lowest CPU and I/O priority, and paced to at most
+    RECLAIM_RATE files per second, or RECLAIM_BUSY_RATE while uploads or
+    restores are going, so that it does not slow them down. First, the
+    bytes of the folders deleted without an index are added up, and taken
+    from the usage of their users.
+    """
+
+    def signal_handler(_signum, _frame):
+        exit(0)
+
+
+    def pace():
+        nonlocal due
+        rate = RECLAIM_BUSY_RATE if transfers.value else RECLAIM_RATE
+        now = monotonic()
+        due = max(due, now - RECLAIM_INTERVAL) + 1 / rate
+        if due > now:
+            sleep(due - now)
+
+
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, signal_handler)
+    os.nice(19) # the I/O priority follows the CPU one
+
+    due = monotonic()
+    while True:
+        sleep(RECLAIM_INTERVAL)
+        try:
+            for user, freed in unaccounted_trash():
+                release(user, freed)
+            removed = reclaim_trash(pace)
+        except OSError as error:
+            log(WARNING, "Could not reclaim deleted folders: {}".format(error))
+            continue
+        if removed:
+            log(INFO, "Reclaimed {} files of deleted folders".format(removed))
+
+
+def scrub_files(known_users, rate):
+    """ Scrubber process function / program
+
+    Every SCRUB_PERIOD seconds re-reads the files of the folders of every
+    user, at the lowest CPU and I/O priority and at most rate bytes per
+    second, checking them against their digests (see lib/checksum.py).
+    Corrupt files are dropped from the index of their folder, so that the
+    next backup of the folder sends them again.
+    """
+
+    def signal_handler(_signum, _frame):
+        exit(0)
+
+
+    def pace(nbytes):
+        nonlocal due
+        count("scrubbed_bytes", nbytes)
+        now = monotonic()
+        due = max(due, now - 1) + nbytes / rate
+        if due > now:
+            sleep(due - now)
+
+
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, signal_handler)
+    os.nice(19) # the I/O priority follows the CPU one
+
+    sleep(SCRUB_DELAY)
+    due = monotonic()
+    while True:
+        started = monotonic()
+        for user in known_users.keys():
+            if not os.path.isdir(user):
+                continue
+            for folder in os.scandir(user):
+                if not folder.is_dir() or is_internal(folder.name):
+                    continue
+                try:
+                    corrupt = verify_folder(folder.path, pace)
+                    dropped = drop_entries(folder.path, corrupt)
+                except OSError as error:
+                    log(WARNING, "Could not scrub {}: {}".format(folder.path, error))
+                    continue
+                if dropped:
+                    release(user, sum(entry[1] for entry in dropped.values()))
+                    count("corrupt_files", len(dropped))
+                    log(ERROR, "Corrupt files in {}, dropped: {}".format(
+                        folder.path, " ".join(dropped)))
+        sleep(max(0, SCRUB_PERIOD - (monotonic() - started)))
+
+
 def unexpected_command(my_socket, address=None):
     """ Informs that there was a error. TCP and UDP compatible. """
     if not address:
@@ -110,7 +336,7 @@ def deal_with_udp(udp_socket, known_users):
         response, address = udp_socket.recvfrom(128)
 
         if response.decode()[-1] != "\n":
-            print("Error: Malformed UDP message")
+            log(ERROR, "Malformed UDP message")
             unexpected_command(udp_socket, address)
 
         response = response.decode()[:-1]
@@ -118,14 +344,23 @@ def deal_with_udp(udp_socket, known_users):
 
         print_connection_event(address, "Got new UDP message", response, "->")
 
-        if command == "LSU":
-            add_user(known_users, args, udp_socket, address)
-        elif command == "DLB":
-            remove_dir(known_users, args, udp_socket, address)
-        elif command == "LSF":
-            list_user_files(known_users, args, udp_socket, address)
-        else:
-            unexpected_command(udp_socket, address)
+        with timed(command if command in UDP_COMMANDS else "ERR"):
+            if command == "LSU":
+                add_user(known_users, args, udp_socket, address)
+            elif command == "DLB":
+                remove_dir(known_users, args, udp_socket, address)
+            elif command == "LSF":
+                list_user_files(known_users, args, udp_socket, address)
+            elif command == "LSC":
+                list_user_checksums(known_users, args, udp_socket, address)
+            elif command == "LSN":
+                list_user_snapshots(known_users, args, udp_socket, address)
+            elif command == "LSQ":
+                report_usage(args, udp_socket, address)
+            elif command == "STA":
+                udp_socket.sendto(format_sta().encode(), address)
+            else:
+                unexpected_command(udp_socket, address)
 
 
 
@@ -141,9 +376,9 @@ def add_user(known_users, args, udp_socket, address):
 
     status = "ERR\n"
     if len(args) != 2 or len(args[1]) > 8 or not args[1].isalnum():
-        print("Error in arguments received from CS server: {}".format(args[0]))
+        log(ERROR, "Malformed arguments received from CS server: {}".format(args[0]))
     elif args[0] in known_users and args[1] != known_users[args[0]]:
-        print("Error: Already knew user {}".format(args[0]))
+        log(ERROR, "Already knew user {}".format(args[0]))
         status = "NOK\n"
     else:
         try:
@@ -163,25 +398,32 @@ def add_user(known_users, args, udp_socket, address):
 def remove_dir(known_users, args, udp_socket, address):
     """ Remove directory of user (DLB/DBR)
 
-    Returns ERR if user not found, NOK if user exists but folder was not found
+    Returns ERR if user not found, NOK if user exists but folder was not found.
+    The folder is moved to the trash, and its files removed later by the
+    reclaimer (reclaim_space), so the reply does not wait for them. Its
+    bytes are taken from the usage of the user from its index; a folder
+    without one is sized by the reclaimer too, not to walk it here.
     """
 
     status = "ERR\n"
     if not args[0] in known_users or not os.path.isdir(args[0]):
-        print("Error: no files from user exist in this server")
+        log(ERROR, "No files from user exist in this server")
     elif not os.path.isdir(os.path.join(args[0], args[1])):
-        print("Error: no such folder exists: {}".format(args[1]))
+        log(ERROR, "No such folder exists: {}".format(args[1]))
         status = "NOK\n"
     else:
         base_dir = os.path.join(args[0], args[1])
-        for userfile in os.listdir(base_dir):
-            os.remove(os.path.join(base_dir, userfile))
-        os.rmdir(base_dir)
+        index = read_index(base_dir)
+        freed = sum(entry[1] for entry in index.values()) if index is not None else 0
+        trash_folder(base_dir, owner=args[0] if index is None else None)
 
         # No more files from user, remove from known_users
         if not os.listdir(args[0]):
             known_users.pop(args[0], 0)
             os.rmdir(args[0])
+            release(args[0], freed, forget=True)
+        else:
+            release(args[0], freed)
 
         status = "OK\n"
 
@@ -195,35 +437,103 @@ def list_user_files(known_users, args, udp_socket, address):
     """ List files of user present in this BS server
 
     Returns ERR if user not found, NOK if user exists but folder was not found
-    (like remove_dir).
+    (like remove_dir). The listing comes from the folder index, formatted
+    only when the folder changed since the last LSF. With a third argument,
+    a snapshot id, lists the folder as of then (NOK if there is no snapshot
+    that old).
     """
 
     status = "0\n"
     n_files = 0
     if not args[0] in known_users or not os.path.isdir(args[0]):
-        print("Error: no files from user exist in this server")
+        log(ERROR, "No files from user exist in this server")
     elif not os.path.isdir(os.path.join(args[0], args[1])):
-        print("Error: no such folder exists: {}".format(args[1]))
+        log(ERROR, "No such folder exists: {}".format(args[1]))
     else:
-        listing = ""
-        for user_file in os.scandir(os.path.join(args[0], args[1])):
-            n_files += 1
-            f_stat = user_file.stat()
-            f_time = strftime("%d.%m.%Y %H:%M:%S", gmtime(f_stat.st_mtime))
-            listing += " {} {} {}".format(user_file.name, f_time, f_stat.st_size)
-
-        status = "{} {}\n".format(n_files, listing)
+        dirpath = os.path.join(args[0], args[1])
+        if len(args) > 2:
+            dirpath = find_snapshot(dirpath, args[2])
+        if dirpath is None:
+            log(ERROR, "No snapshot of {} as of {}".format(args[1], args[2]))
+            status = "NOK\n"
+        else:
+            n_files, listing = cached_listing(dirpath)
+            status = "{}{}\n".format(n_files, listing)
 
     response = "LFD " + status
     print_connection_event(address, "Responding to list files request", "LFD " + str(n_files), "<-")
     udp_socket.sendto(response.encode(), address)
 
 
+def list_user_checksums(known_users, args, udp_socket, address):
+    """ List files of user present in this BS server, with digests (LSC/LCR)
+
+    Like LSF, but every file also has its digest ("-" for files received
+    before there were checksums). The listing is not cached. ERR if it
+    does not fit in a datagram, for the CS to ask with LSF instead.
+    """
+
+    status = "0\n"
+    n_files = 0
+    if not args[0] in known_users or not os.path.isdir(args[0]):
+        log(ERROR, "No files from user exist in this server")
+    elif not os.path.isdir(os.path.join(args[0], args[1])):
+        log(ERROR, "No such folder exists: {}".format(args[1]))
+    else:
+        dirpath = os.path.join(args[0], args[1])
+        if len(args) > 2:
+            dirpath = find_snapshot(dirpath, args[2])
+        if dirpath is None:
+            log(ERROR, "No snapshot of {} as of {}".format(args[1], args[2]))
+            status = "NOK\n"
+        else:
+            index = load_index(dirpath)
+            n_files = len(index)
+            status = "{}{}\n".format(n_files, format_listing(index, digests=True))
+
+    response = "LCR " + status
+    if len(response.encode()) > MAX_UDP_REPLY:
+        log(WARNING, "Listing of {} too large for LCR".format(args[1]))
+        response = "LCR ERR\n"
+    print_connection_event(address, "Responding to list checksums request", "LCR " + str(n_files), "<-")
+    udp_socket.sendto(response.encode(), address)
+
+
+def list_user_snapshots(known_users, args, udp_socket, address):
+    """ List the snapshots of a folder of a user (LSN/LNR)
+
+    Returns ERR for a malformed request or a folder path that is not safe.
+    """
+
+    snapshots = []
+    if len(args) != 2 or not is_safe_path(args[1]) or is_internal(args[1]):
+        log(ERROR, "Malformed LSN: {}".format(args))
+        response = "LNR ERR\n"
+    else:
+        if args[0] in known_users:
+            snapshots = list_snapshots(os.path.join(args[0], args[1]))
+        response = "LNR {}{}\n".format(len(snapshots), "".join(" " + snap_id for snap_id in snapshots))
+    print_connection_event(address, "Responding to list snapshots request", response[:-1], "<-")
+    udp_socket.sendto(response.encode(), address)
+
+
+def report_usage(args, udp_socket, address):
+    """ Bytes stored by a user in this BS, and its quota (LSQ/LQR)
+
+    The quota is 0 if there is none.
+    """
+
+    response = "LQR ERR\n"
+    if len(args) == 1:
+        response = "LQR {} {}\n".format(*user_usage(args[0]))
+    print_connection_event(address, "Responding to usage request", response[:-1], "<-")
+    udp_socket.sendto(response.encode(), address)
+
 
 
 # Code to deal with client queries (TCP server)
 
-def deal_with_tcp(tcp_socket, known_users):
+def deal_with_tcp(tcp_socket, known_users, transfers, moved, engine, durability, keep):
     """ TCP server process function / program
 
     Used for dealing with TCP queries from clients. Because we may have
@@ -236,28 +546,96 @@ def deal_with_tcp(tcp_socket, known_users):
         exit(0)
 
 
-    def deal_with_client(client, known_users):
-        """ Code / function for forked worker """
+    def deal_with_client(client, known_users, transfers, moved, engine, durability, keep):
+        """ Code / function for forked worker
+
+        A client may send several UPL in the same session, and ends it by
+        closing the connection. A client may ask for version 2 of the
+        protocol (VER) before its AUT; from the reply to that AUT on,
+        messages are frames, and RSB does not end the session either. If
+        the VER offers CHECKSUM, restores in version 2 send the digests.
+        """
 
         conn = client[0]
         logged_in = False       # this var is False or contains the user id
-        while True:
-            try:
-                command = read_bytes_until(conn, " \n")
-                print_connection_event(client[1], "TCP request type: ", command, "  ")
-                if command == "AUT":
-                    logged_in = authenticate_user(known_users, client)
-                elif command == "UPL" and logged_in:
-                    backup_user_files(logged_in, client)
-                    break
-                elif command == "RSB" and logged_in:
-                    restore_user_files(logged_in, client)
+        version = next_version = 1
+        checksums = False       # the client checks the digests of the files restored
+        count("workers", 1)
+        try:
+            while True:
+                try:
+                    if version >= 2:
+                        message = recv_frame(conn)
+                        if message is None:
+                            break # connection closed by the client
+                        command, args, request_id = message
+                    else:
+                        # UPL reads its arguments along with the files
+                        command, args, request_id = read_bytes_until(conn, " \n"), None, 0
+                        if command == "":
+                            break # connection closed by the client
+                        if command in TEXT_LINE_COMMANDS:
+                            args = read_bytes_until(conn, "\n").split(" ")
+                    print_connection_event(client[1], "TCP request type: ", command, "  ")
+
+                    with timed(command if command in TCP_COMMANDS else "ERR"):
+                        if command == "VER":
+                            next_version = accept_version(args)
+                            checksums = CHECKSUM in args
+                            send_message(conn, version, ["VER", next_version], request_id)
+                        elif command == "AUT":
+                            logged_in, reply = authenticate_user(known_users, client, args)
+                            send_message(conn, version, reply, request_id)
+                        elif command == "UPL" and logged_in:
+                            add_to_counter(transfers, 1)
+                            try:
+                                with stream(logged_in, BACKUP_WEIGHT) as pace, \
+                                     account(logged_in) as charge:
+                                    backup_user_files(logged_in, client, version, args,
+                                                      request_id, moved, engine,
+                                                      durability, keep, pace, charge)
+                            finally:
+                                add_to_counter(transfers, -1)
+                        elif command == "RSB" and logged_in:
+                            add_to_counter(transfers, 1)
+                            try:
+                                with stream(logged_in, RESTORE_WEIGHT) as pace:
+                                    restore_user_files(logged_in, client, version, args,
+                                                       request_id, moved, pace, checksums)
+                            finally:
+                                add_to_counter(transfers, -1)
+                            if version == 1:
+                                break
+                        elif command == "MIG" and logged_in:
+                            add_to_counter(transfers, 1)
+                            try:
+                                with stream(logged_in, BACKUP_WEIGHT) as pace:
+                                    migrate_folder(logged_in, known_users, client, version,
+                                                   args, request_id, moved, pace)
+                            finally:
+                                add_to_counter(transfers, -1)
+                        elif command == "SNP" and logged_in and version >= 2:
+                            add_to_counter(transfers, 1)
+                            try:
+                                with stream(logged_in, BACKUP_WEIGHT) as pace:
+                                    receive_snapshot(logged_in, client, args, request_id,
+                                                     moved, durability, keep, pace)
+                            finally:
+                                add_to_counter(transfers, -1)
+                        else:
+                            send_message(conn, version, ["ERR"], request_id)
+
+                    if command != "VER":
+                        version = next_version
+                except (BrokenPipeError, ConnectionResetError):
+                    log(INFO, "{}: connection closed".format(client[1]))
+                    exit(0)
+                except ConnectionError as error:
+                    log(WARNING, "{}: {}".format(client[1], error))
                     break
-                else:
-                    unexpected_command(conn)
-            except (BrokenPipeError, ConnectionResetError):
-                print("{}: connection closed".format(client[1]))
-                exit(0)
+        finally:
+            count("workers", -1)
+            count_tcp_bytes(conn)
 
         conn.close() # EOC (end of code)
 
@@ -267,179 +645,662 @@ def deal_with_tcp(tcp_socket, known_users):
     signal(SIGTERM, signal_handler)
     while True:
         client = tcp_socket.accept()
+        count("connections")
         print_connection_event(client[1], "Got new TCP connection", "", "->")
         p_client = Process(target=deal_with_client,
-                           args=(client, known_users),
+                           args=(client, known_users, transfers, moved, engine,
+                                 durability, keep),
                            daemon=True)
         p_client.start()
 
 
-def authenticate_user(known_users, client):
-    """ Authenticates user, returns user id (AUT/AUR) """
-    username = read_bytes_until(client[0], " ")
-    password = read_bytes_until(client[0], "\n")
+def authenticate_user(known_users, client, args):
+    """ Authenticates user, returns (user id, reply) (AUT/AUR) """
+    username, password = (args + ["", ""])[:2]
 
     print_connection_event(client[1], "AUT args: ", [username, password], "  ")
 
-    users = dict(known_users)
+    users = known_users.copy()
 
-    res = False
-    status = "NOK\n"
+    status = "NOK"
     if username not in users:
-        print("User not known to this BS")
+        log(WARNING, "User not known to this BS")
     elif users[username] != password:
-        print("Password received does not match")
+        log(WARNING, "Password received does not match")
     else:
-        status = "OK\n"
+        status = "OK"
+
+
+    print_connection_event(client[1], "Response to auth_request", "AUR " + status)
+    return username, ["AUR", status]
 
 
-    response = "AUR " + status
-    print_connection_event(client[1], "Response to auth_request", response[:-1])
-    client[0].sendall(response.encode())
-    return username
 
+def read_file_header(sock, version):
+    """ Reads the name, mtime and size of the next file of an upload
 
+    In text, "name date time size " precedes the data; in version 2 a FIL
+    frame does.
+    """
 
-def backup_user_files(logged_in, client):
-    """ Receives files from user. (UPL/UPR) """
+    if version >= 2:
+        message = recv_frame(sock)
+        if message is None or message[0] != "FIL" or len(message[1]) != 3:
+            raise ConnectionError("Expected a FIL frame")
+        return tuple(message[1])
+
+    filename = read_bytes_until(sock, " ")
+    date = read_bytes_until(sock, " ")
+    hour = read_bytes_until(sock, " ") # do not forget hour
+    size = int(read_bytes_until(sock, " "))
+    return filename, parse_mtime(date, hour), size
+
+
+def backup_user_files(logged_in, client, version, args, request_id, moved, engine,
+                      durability, keep, pace, charge):
+    """ Receives files from user. (UPL/UPR)
+
+    With the "pack" engine, files up to PACK_MAX_FILE bytes are appended to
+    a pack segment of the folder instead of getting a file of their own.
+    Other files are received into temporary files, which are renamed into
+    place (and fsynced, per durability) in groups, see lib/storage.py.
+    File names may be paths relative to the folder ("sub/dir/file"), and
+    the subfolders are created as needed. Before changing a folder, its
+    current state is kept as a snapshot (at most hourly), of which the
+    newest keep are kept. Every chunk received is paced with pace (see
+    lib/bandwidth.py), and every file is charged to the quota of the user
+    with charge (see lib/quota.py) before it is received: files that do not
+    fit are refused. A folder being moved to another BS takes no uploads
+    (see migrate_folder): all of its files are refused. In text, the
+    arguments are read here, args is None.
+    """
 
-    folder = read_bytes_until(client[0], " ")
-    number_of_files = int(read_bytes_until(client[0], " "))
+    if version >= 2:
+        folder, number_of_files = args[0], int(args[1])
+    else:
+        folder = read_bytes_until(client[0], " ")
+        number_of_files = int(read_bytes_until(client[0], " "))
 
     print_connection_event(client[1], "Backup args: ", [folder, number_of_files], "  ")
 
+    dirpath = os.path.join(logged_in, folder)
     try:
-        os.makedirs(os.path.join(logged_in, folder))
+        os.makedirs(dirpath)
     except FileExistsError:
         pass
 
-    status = "OK\n"
-    for _i in range(0, number_of_files):
-        filename = read_bytes_until(client[0], " ")
-        date = read_bytes_until(client[0], " ")
-        date = date + " " + read_bytes_until(client[0], " ") # do not forget hour
-        size = int(read_bytes_until(client[0], " "))
-        print_connection_event(client[1], "    Receiving {}".format(filename), "", "  ")
+    with upload_lock(dirpath) as writable:
+        if not writable:
+            log(WARNING, "{} is moving to another BS, refusing its upload".format(dirpath))
+        status = receive_files(logged_in, client, version, dirpath, number_of_files,
+                               writable, moved, engine, durability, keep, pace, charge)
 
+    print_connection_event(client[1], "Response to backup request", "UPR " + status, "<-")
+    send_message(client[0], version, ["UPR", status], request_id)
 
-        # Opening file now
-        filepath = os.path.join(logged_in, folder, filename)
-        filefd = os.open(filepath, os.O_WRONLY | os.O_CREAT, mode=0o660)
 
+def receive_files(logged_in, client, version, dirpath, number_of_files, writable, moved,
+                  engine, durability, keep, pace, charge):
+    """ Receives the files of an upload into dirpath, returns the UPR status
 
-        for data in chunked_read_socket(client[0], size):
-            os.write(filefd, data)
+    Unless writable, every file is refused (read and dropped). The digest
+    of every file is computed as it is received, and kept in its entry.
+    """
 
-        if os.stat(filefd).st_size != size:
-            print("ERROR: Unable to fully write {}".format(filename))
-            status = "NOK\n"
-            break
-        print_connection_event(client[1], "     Received {}".format(filename), "", "  ")
-        os.close(filefd)
+    if keep and writable:
+        snap_id = take_snapshot(dirpath)
+        if snap_id is not None:
+            pruned = prune_snapshots(dirpath, keep)
+            print_connection_event(client[1], "Snapshot {} taken".format(snap_id),
+                                   pruned, "  ")
+
+    sizes = {filename: entry[1] for filename, entry in load_index(dirpath).items()}
+    in_flight = 0   # bytes charged for the file being received
+
+    status = "OK"
+    received = {}   # index entries of the files received
+    segment_fd = None
+    pending = []    # (fd, temp path, final path) of files not yet in place
+    last_commit = monotonic()
+    try:
+        for _i in range(0, number_of_files):
+            filename, file_mtime, size = read_file_header(client[0], version)
+            print_connection_event(client[1], "    Receiving {}".format(filename), "", "  ",
+                                   DEBUG)
+
+            growth = size - sizes.get(filename, 0)
+            refused = not writable or is_internal(filename) or not is_safe_path(filename)
+            if refused:
+                if writable:
+                    log(ERROR, "Refusing file name {}".format(filename))
+            elif not charge(growth):
+                log(WARNING, "User {} over quota, refusing {}".format(logged_in, filename))
+                refused = True
+            else:
+                in_flight = growth
+
+            if refused:
+                drained = 0
+                for data in throttled(chunked_read_socket(client[0], size), pace):
+                    if not data:
+                        break # peer went away
+                    drained += len(data)
+                status = "NOK"
+                if drained != size:
+                    log(ERROR, "Unable to fully receive {}".format(filename))
+                    break
+                if version == 1:
+                    client[0].recv(1)
+                continue
+
+            if engine == "pack" and size <= PACK_MAX_FILE:
+                if segment_fd is None:
+                    segment_fd, segment = open_segment(dirpath)
+
+                digest = new_digest()
+                chunks = []
+                for chunk in digested(throttled(chunked_read_socket(client[0], size), pace),
+                                      digest):
+                    if not chunk:
+                        break # peer went away
+                    chunks.append(chunk)
+                data = b"".join(chunks)
+                if len(data) != size:
+                    log(ERROR, "Unable to fully receive {}".format(filename))
+                    status = "NOK"
+                    break
+                offset = append(segment_fd, data)
+                received[filename] = (file_mtime, size, segment, offset, digest.hexdigest())
+
+            else:
+                filepath = os.path.join(dirpath, filename)
+                try:
+                    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+                except OSError:
+                    log(ERROR, "Unable to create the folder of {}".format(filename))
+                    status = "NOK"
+                    break
+
+                digest = new_digest()
+                written = write_temp(dirpath,
+                                     digested(throttled(chunked_read_socket(client[0], size),
+                                                        pace), digest),
+                                     size, file_mtime)
+                if written is None:
+                    log(ERROR, "Unable to fully write {}".format(filename))
+                    status = "NOK"
+                    break
+                pending.append((*written, filepath))
+                received[filename] = (file_mtime, size, None, None, digest.hexdigest())
+
+            sizes[filename] = size
+            in_flight = 0
+
+            if commit_due(durability, len(pending), last_commit):
+                commit_files(dirpath, pending, segment_fd, durability)
+                last_commit = monotonic()
 
-        # Set mtime to the sent one (and atime to now)
-        file_mtime = timegm(strptime(date, "%d.%m.%Y %H:%M:%S"))
-        os.utime(filepath, times=(timegm(gmtime()), file_mtime))
+            print_connection_event(client[1], "     Received {}".format(filename), "", "  ",
+                                   DEBUG)
+            add_to_counter(moved, size)
 
 
-        last = client[0].recv(1)
-        if __debug__:
-            assert last.decode() in (' ', '\n')
+            if version == 1:
+                last = client[0].recv(1)
+                if __debug__:
+                    assert last.decode() in (' ', '\n')
+    finally:
+        charge(-in_flight)
+        # Even if the client went away, the files fully received are kept
+        commit_files(dirpath, pending, segment_fd, durability)
+        update_index(dirpath, received, durable=(durability != "none"))
+        if segment_fd is not None:
+            close_segment(segment_fd)
+
+    return status
 
-    response = "UPR " + status
-    print_connection_event(client[1], "Response to backup request", response[:-1], "<-")
-    client[0].sendall(response.encode())
 
+def restore_user_files(logged_in, client, version, args, request_id, moved, pace,
+                       checksums=False):
+    """ Sends back files to user. (RSB/RSR)
 
-def restore_user_files(logged_in, client):
-    """ Sends back files to user. (RSB/RSR) """
+    "RSB folder snapshot_id" sends the folder as of a snapshot instead.
+    Every chunk sent is paced with pace (see lib/bandwidth.py). With
+    checksums, FIL frames have the digest of the file, if it has one.
+    """
 
     try:
-        folder = read_bytes_until(client[0], "\n")
-        print_connection_event(client[1], "Upload args: ", folder, "  ")
-    except:
+        folder, *as_of = args
+        print_connection_event(client[1], "Upload args: ", [folder, *as_of], "  ")
+    except ValueError:
         print_connection_event(client[1], "Error in request for restoration", "RBR ERR", "<-")
-        client[0].sendall("RBR ERR\n".encode())
-        exit(2)
+        send_message(client[0], version, ["RBR", "ERR"], request_id)
+        return
 
     dirpath = os.path.join(logged_in, folder)
-    if not os.path.isdir(dirpath):
+    if as_of and os.path.isdir(dirpath):
+        dirpath = find_snapshot(dirpath, as_of[0])
+    if dirpath is None or not os.path.isdir(dirpath):
         print_connection_event(client[1], "Directory not found", "RBR EOF", "<-")
-        client[0].sendall("RBR EOF\n".encode())
-        exit(1)
+        send_message(client[0], version, ["RBR", "EOF"], request_id)
+        return
+
+    # Segments opened while locked stay readable even if compacted meanwhile
+    load_index(dirpath)
+    with folder_lock(dirpath):
+        index = load_index(dirpath)
+        segment_fds = open_entries(dirpath, index)
 
-    file_list = [f for f in os.scandir(dirpath) if f.is_file()]
-    message = "RBR {}".format(len(file_list))
+    message = "RBR {}".format(len(index))
 
     print_connection_event(client[1], "Start sending back files", message, "<-")
-    client[0].sendall(message.encode())
+    if version >= 2:
+        send_frame(client[0], "RBR", [len(index)], request_id)
+    else:
+        client[0].sendall(message.encode())
 
-    for user_file in file_list:
+    try:
+        send_files(client, version, dirpath, index, segment_fds, request_id, moved, pace,
+                   checksums)
+    finally:
+        for segment_fd in segment_fds.values():
+            os.close(segment_fd)
+    if version == 1:
+        client[0].sendall("\n".encode())
+    print_connection_event(client[1], "Finished sending back files", message, "<-")
 
-        f_stat = user_file.stat()
-        f_time = strftime("%d.%m.%Y %H:%M:%S", gmtime(f_stat.st_mtime))
-        mess_part = " {} {} {} ".format(user_file.name, f_time, f_stat.st_size)
-        print_connection_event(client[1], "    Sending {}".format(user_file.name), "", "  ")
-        client[0].sendall(mess_part.encode())
 
-        filefd = os.open(user_file.path, os.O_RDONLY)
-        for data in chunked_read_fd(filefd, f_stat.st_size, 4096):
-            client[0].sendall(data)
-        print_connection_event(client[1], "       Sent {}".format(user_file.name), "", "  ")
+def send_files(peer, version, dirpath, index, segment_fds, request_id, moved, pace,
+               checksums=False):
+    """ Sends the files of index, each after its header, to peer (socket, address)
 
-    client[0].sendall("\n".encode())
-    print_connection_event(client[1], "Finished sending back files", message, "<-")
+    The headers are FIL frames in version 2, " name date time size " in
+    text, as both restores and uploads have them. segment_fds are the
+    segments used by the index (see open_entries). With checksums, FIL
+    frames of files with a digest have it as a fourth field.
+    """
+
+    for filename, entry in index.items():
+        mtime, size = entry[:2]
+        digest = entry_digest(entry) if checksums else None
+
+        print_connection_event(peer[1], "    Sending {}".format(filename), "", "  ", DEBUG)
+        if version >= 2:
+            fields = [filename, mtime, size] + ([digest] if digest else [])
+            send_frame(peer[0], "FIL", fields, request_id)
+        else:
+            f_time = strftime("%d.%m.%Y %H:%M:%S", gmtime(mtime))
+            peer[0].sendall(" {} {} {} ".format(filename, f_time, size).encode())
+
+        if is_packed(entry):
+            send_packed(peer[0], segment_fds[entry[2]], entry[3], size, pace)
+        else:
+            filefd = os.open(os.path.join(dirpath, filename), os.O_RDONLY)
+            try:
+                for data in throttled(chunked_read_fd(filefd, size, 4096), pace):
+                    peer[0].sendall(data)
+            finally:
+                os.close(filefd)
+        print_connection_event(peer[1], "       Sent {}".format(filename), "", "  ", DEBUG)
+        add_to_counter(moved, size)
+
+
+
+def migrate_folder(logged_in, known_users, client, version, args, request_id, moved, pace):
+    """ Copies a folder of the user straight to another BS, for the CS (MIG/MGR)
+
+    "MIG folder ip port rate" uploads the folder to the BS at ip port, over
+    a session of the user there, at most at rate bytes/s (0 for no limit,
+    besides pace). A first pass sends every file while the folder keeps
+    taking uploads; the last one sends what changed meanwhile, holding the
+    move lock of the folder (see lib/storage.py), so that it waits for the
+    uploads going on and makes new ones give up. The folder is then marked
+    as moved, and is left for the CS to delete. Each pass also copies the
+    snapshots of the folder not copied yet (see copy_snapshots).
+    """
+
+    try:
+        folder, ip, port, rate = args[0], args[1], int(args[2]), int(args[3])
+        print_connection_event(client[1], "Migration args: ", args, "  ")
+    except (IndexError, ValueError):
+        print_connection_event(client[1], "Error in request for migration", "MGR ERR", "<-")
+        send_message(client[0], version, ["MGR", "ERR"], request_id)
+        return
+
+    dirpath = os.path.join(logged_in, folder)
+    if not is_safe_path(folder) or is_internal(folder) or not os.path.isdir(dirpath):
+        print_connection_event(client[1], "Directory not found", "MGR NOK", "<-")
+        send_message(client[0], version, ["MGR", "NOK"], request_id)
+        return
+
+    status = "NOK"
+    pace = capped(pace, rate)
+    try:
+        bs_socket = tcp_client(ip, port)
+        try:
+            bs_socket.settimeout(MIGRATION_TIMEOUT)
+            first, reply = offer_version(bs_socket, ["AUT", logged_in, known_users[logged_in]])
+            if reply != ["AUR", "OK"]:
+                raise ConnectionError("not authenticated there")
+            bs_version = negotiated(first)
+            peer = (bs_socket, (ip, port))
+
+            sent = {}
+            copied = set()
+            copy_changes(peer, bs_version, dirpath, folder, sent, moved, pace)
+            copy_snapshots(peer, bs_version, dirpath, folder, sent, copied, moved, pace)
+            with move_lock(dirpath) as mark_moved:
+                copy_changes(peer, bs_version, dirpath, folder, sent, moved, pace)
+                copy_snapshots(peer, bs_version, dirpath, folder, sent, copied, moved, pace)
+                mark_moved()
+            status = "OK"
+        finally:
+            bs_socket.close()
+    except (OSError, KeyError) as error:
+        log(WARNING, "Could not move {} to BS {} {}: {}".format(dirpath, ip, port, error))
+
+    print_connection_event(client[1], "Response to migration request", "MGR " + status, "<-")
+    send_message(client[0], version, ["MGR", status], request_id)
+
+
+def sent_as(entry):
+    """ What copy_changes keeps of an entry it sent: (mtime, size, digest) """
+    return (entry[0], entry[1], entry_digest(entry))
+
+
+def copy_changes(peer, version, dirpath, folder, sent, moved, pace):
+    """ Uploads (UPL/UPR) to another BS the files of a folder not in sent
+
+    sent is {"filename": (mtime, size, digest)} of the files uploaded
+    already, and gets those uploaded now. Raises ConnectionError if the
+    upload fails.
+    """
+
+    load_index(dirpath)
+    with folder_lock(dirpath):
+        index = load_index(dirpath)
+        changed = {filename: entry for filename, entry in index.items()
+                   if sent_as(entry) != sent.get(filename)}
+        segment_fds = open_entries(dirpath, changed)
+
+    try:
+        if not changed:
+            return
+        if version >= 2:
+            send_frame(peer[0], "UPL", [folder, len(changed)])
+        else:
+            peer[0].sendall("UPL {} {}".format(folder, len(changed)).encode())
+        send_files(peer, version, dirpath, changed, segment_fds, 0, moved, pace)
+        if version == 1:
+            peer[0].sendall("\n".encode())
+    finally:
+        for segment_fd in segment_fds.values():
+            os.close(segment_fd)
+
+    reply = read_reply(peer[0], version)
+    if reply != ["UPR", "OK"]:
+        raise ConnectionError("upload answered {}".format(" ".join(reply)))
+    sent.update({filename: sent_as(entry) for filename, entry in changed.items()})
+
+
+def copy_snapshots(peer, version, dirpath, folder, sent, copied, moved, pace):
+    """ Copies to another BS the snapshots of a folder not in copied (SNP/SNR)
+
+    "SNP folder snapshot_id n" is followed by n files: those that are the
+    same as a file the other BS has (in sent, see copy_changes) go as an
+    LNK frame (name, mtime, size, digest), for it to link its copy, the
+    rest as in uploads. copied gets the snapshots copied now. Only version
+    2 has SNP: raises ConnectionError if the other BS does not speak it and
+    there are snapshots, or if a copy fails.
+    """
+
+    for snap_id in list_snapshots(dirpath):
+        if snap_id in copied:
+            continue
+        if version < 2:
+            raise ConnectionError("cannot copy snapshots to a BS of version 1")
+
+        snap_path = snapshot_path(dirpath, snap_id)
+        index = read_index(snap_path)
+        try:
+            segment_fds = open_entries(snap_path, index or {})
+        except FileNotFoundError:
+            index = None
+        if index is None:
+            continue # pruned meanwhile
+
+        linked = {filename: entry for filename, entry in index.items()
+                  if entry_digest(entry) and sent.get(filename) == sent_as(entry)}
+        others = {filename: entry for filename, entry in index.items()
+                  if filename not in linked}
+        try:
+            send_frame(peer[0], "SNP", [folder, snap_id, len(index)])
+            for filename, entry in linked.items():
+                send_frame(peer[0], "LNK", [filename, *sent_as(entry)])
+            send_files(peer, version, snap_path, others, segment_fds, 0, moved, pace)
+        finally:
+            for segment_fd in segment_fds.values():
+                os.close(segment_fd)
+
+        reply = read_reply(peer[0], version)
+        if reply != ["SNR", "OK"]:
+            raise ConnectionError("snapshot {} answered {}".format(snap_id, " ".join(reply)))
+        copied.add(snap_id)
+
+
+def receive_snapshot(logged_in, client, args, request_id, moved, durability, keep, pace):
+    """ Receives a snapshot of a folder from another BS (SNP/SNR)
+
+    See copy_snapshots. The snapshot is built aside, starting with links to
+    the files and pack segments of the folder, and put in place when all of
+    it arrived. Files that are not in the folder any more (LNK), or a
+    snapshot that it already has, make the reply NOK. Snapshots are not
+    counted in quotas; as those taken here, at most keep are kept.
+    """
+
+    try:
+        folder, snap_id, number_of_files = args[0], args[1], int(args[2])
+        print_connection_event(client[1], "Snapshot args: ", args, "  ")
+    except (IndexError, ValueError):
+        print_connection_event(client[1], "Error in snapshot copy", "SNR ERR", "<-")
+        send_frame(client[0], "SNR", ["ERR"], request_id)
+        return
+
+    dirpath = os.path.join(logged_in, folder)
+    tmp_path = os.path.join(dirpath, SNAPSHOT_DIR, "in." + snap_id)
+    live = None
+    if (keep and is_safe_path(folder) and not is_internal(folder)
+            and is_snapshot_id(snap_id) and os.path.isdir(dirpath)
+            and not os.path.exists(snapshot_path(dirpath, snap_id))):
+        rmtree(tmp_path, ignore_errors=True) # left by an earlier copy
+        os.makedirs(tmp_path)
+        live = link_folder(dirpath, tmp_path)
+        if live is None:
+            rmtree(tmp_path) # nothing stored in the folder
+    status = "OK" if live is not None else "NOK"
+
+    index = {}
+    pending = []    # (fd, temp path, final path) of files not yet in place
+    try:
+        for _i in range(number_of_files):
+            message = recv_frame(client[0])
+            if message is None or message[0] not in ("FIL", "LNK") \
+               or len(message[1]) != (3 if message[0] == "FIL" else 4):
+                raise ConnectionError("Expected a FIL or LNK frame")
+            filename, file_mtime, size = message[1][:3]
+
+            if message[0] == "LNK":
+                entry = live.get(filename) if live is not None else None
+                if entry is None or sent_as(entry) != tuple(message[1][1:]):
+                    status = "NOK"
+                else:
+                    index[filename] = entry
+                continue
+
+            target = os.path.join(tmp_path, filename)
+            if status == "OK" and (is_internal(filename) or not is_safe_path(filename)):
+                log(ERROR, "Refusing file name {}".format(filename))
+                status = "NOK"
+            chunks = throttled(chunked_read_socket(client[0], size), pace)
+            if status != "OK":
+                for data in chunks:
+                    if not data:
+                        raise ConnectionError("Connection closed")
+                continue
+
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            digest = new_digest()
+            written = write_temp(tmp_path, digested(chunks, digest), size, file_mtime)
+            if written is None:
+                raise ConnectionError("Unable to fully receive {}".format(filename))
+            pending.append((*written, target))
+            index[filename] = (file_mtime, size, None, None, digest.hexdigest())
+            add_to_counter(moved, size)
+
+        if status == "OK":
+            commit_files(tmp_path, pending, None, durability)
+            pending = []
+            # Links to files of the folder this snapshot does not have
+            for filename, entry in live.items():
+                if not is_packed(entry) and filename not in index:
+                    os.remove(os.path.join(tmp_path, filename))
+            save_index(tmp_path, index, durable=(durability != "none"))
+            os.rename(tmp_path, snapshot_path(dirpath, snap_id))
+            prune_snapshots(dirpath, keep)
+    finally:
+        for fd, temp_path, _target in pending:
+            discard_temp(fd, temp_path)
+        if live is not None:
+            rmtree(tmp_path, ignore_errors=True)
+
+    print_connection_event(client[1], "Response to snapshot copy", "SNR " + status, "<-")
+    send_frame(client[0], "SNR", [status], request_id)
 
 
 
 def main():
     """ BS main process """
 
-    manager = SyncManager()
-    manager.start(ignore_sigint)
-    known_users = manager.dict() # Shared dict across processes
-    my_ip = get_best_ip()
+    transfers = Value("i", 0)    # Active UPL/RSB transfers, across workers
+    moved = Value("q", 0)        # Bytes received/sent since start
+    my_ip = None                 # address to listen on, looked up if not given
     my_port = DEFAULT_BS_PORT
-    cs_host = my_ip
+    cs_host = None               # same as my_ip if not given
     cs_port = DEFAULT_CS_PORT
+    engine = "loose"             # how files are stored: "loose" or "pack"
+    durability = "session"       # one of DURABILITY_LEVELS
+    keep = SNAPSHOT_KEEP         # snapshots kept per folder, 0 for none
+    metrics_port = None          # HTTP port of the metrics endpoint, if any
+    log_levels = (INFO, {})      # minimum log level and sampling
+    total_rate = 0               # bandwidth cap (bytes/s) of all transfers, 0 for none
+    user_rate = 0                # bandwidth cap (bytes/s) of each user, 0 for none
+    quota = 0                    # bytes each user may store, 0 for no limit
+    log_json = False             # log records as JSON objects
+    scrub_rate = SCRUB_RATE      # bytes/s re-read by the scrubber, 0 for no scrubbing
 
 
     try:
-        options = getopt(argv[1:], "b:n:p:")[0]
+        options = getopt(argv[1:], "a:b:n:p:e:d:k:m:l:jt:u:q:s:")[0]
     except GetoptError as error:
         print(error)
         exit(2)
 
     for opt, arg in options:
-        if opt == '-b':
+        if opt == '-a':
+            my_ip = arg
+        elif opt == '-b':
             my_port = int(arg)
         elif opt == '-n':
             cs_host = arg
         elif opt == '-p':
             cs_port = int(arg)
+        elif opt == '-e':
+            engine = arg
+        elif opt == '-d':
+            durability = arg
+        elif opt == '-k':
+            keep = int(arg)
+        elif opt == '-m':
+            metrics_port = int(arg)
+        elif opt == '-l':
+            try:
+                log_levels = parse_levels(arg)
+            except ValueError as error:
+                print(error)
+                exit(2)
+        elif opt == '-j':
+            log_json = True
+        elif opt == '-t':
+            total_rate = parse_rate(arg)
+        elif opt == '-u':
+            user_rate = parse_rate(arg)
+        elif opt == '-q':
+            quota = parse_rate(arg)
+        elif opt == '-s':
+            scrub_rate = parse_rate(arg)
+
+    if engine not in ("loose", "pack"):
+        print("Unknown storage engine: {}".format(engine))
+        exit(2)
+    if durability not in DURABILITY_LEVELS:
+        print("Unknown durability level: {}".format(durability))
+        exit(2)
 
-
-
+    if my_ip is None:
+        my_ip = get_best_ip()
+    if cs_host is None:
+        cs_host = my_ip
 
     # Getting sockets for the servers ready
     udp_receiver = udp_server(my_ip, my_port)
     tcp_receiver = tcp_server(my_ip, my_port)
+    manager = SyncManager()
+    manager.start(ignore_sigint)
+    known_users = manager.dict() # Shared dict across processes
+    init_metrics("bs", TCP_COMMANDS + UDP_COMMANDS + ("ERR",), COUNTERS)
+    init_logging(*log_levels, log_json)
+    init_scheduler(total_rate, user_rate)
 
 
-    # Retrieving previously known users
+    # Retrieving previously known users, and what they store
     if os.path.isfile(BS_USER_SAVEFILE):
         known_users.update(restore_dict_from_file(BS_USER_SAVEFILE))
+    usage = manager.dict(load_usage(known_users.keys()))
+    init_quota(quota, usage)
 
+    p_metrics = None
+    p_scrub = None
     try:
         # "Forking"
         p_udp = Process(target=deal_with_udp, args=(udp_receiver, known_users),
                         name="UDP dealer")
-        p_tcp = Process(target=deal_with_tcp, args=(tcp_receiver, known_users),
+        p_tcp = Process(target=deal_with_tcp,
+                        args=(tcp_receiver, known_users, transfers, moved, engine,
+                              durability, keep),
                         name="TCP dealer")
+        p_compact = Process(target=compact_packs, args=(known_users,),
+                            name="Pack compactor")
+        p_reclaim = Process(target=reclaim_space, args=(transfers,),
+                            name="Trash reclaimer")
+        p_report = Process(target=report_to_cs,
+                           args=(cs_host, cs_port, my_ip, my_port, transfers, moved),
+                           name="CS reporter")
         p_udp.start()
         p_tcp.start()
-
-        register_in_cs(cs_host, cs_port, my_ip, my_port)
+        p_compact.start()
+        p_reclaim.start()
+        if scrub_rate:
+            p_scrub = Process(target=scrub_files, args=(known_users, scrub_rate),
+                              name="Scrubber")
+            p_scrub.start()
+        if metrics_port is not None:
+            p_metrics = Process(target=serve_metrics,
+                                args=(tcp_server(my_ip, metrics_port),),
+                                name="Metrics endpoint")
+            p_metrics.start()
+
+        register_in_cs(cs_host, cs_port, my_ip, my_port, current_load(transfers))
+        p_report.start()
         pause()
     except KeyboardInterrupt:
         unregister_from_cs(cs_host, cs_port, my_ip, my_port)
@@ -448,9 +1309,24 @@ def main():
         tcp_receiver.close()
         p_tcp.terminate()
         p_udp.terminate()
+        p_compact.terminate()
+        p_reclaim.terminate()
         p_tcp.join()
         p_udp.join()
+        p_compact.join()
+        p_reclaim.join()
+        if p_report.is_alive():
+            p_report.terminate()
+            p_report.join()
+        if p_scrub is not None:
+            p_scrub.terminate()
+            p_scrub.join()
+        if p_metrics is not None:
+            p_metrics.terminate()
+            p_metrics.join()
         backup_dict_to_file(known_users, BS_USER_SAVEFILE)
+        backup_dict_to_file(usage, BS_USAGE_SAVEFILE)
+        stop_logging()
 
 
 
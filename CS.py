@@ -1,25 +1,78 @@
 #!/usr/bin/env python3
 
 import socket, sys, getopt, os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from math import ceil
+from random import sample
+from time import time, monotonic, sleep
 from signal import signal, pause, SIGINT, SIGTERM, SIG_IGN
 from pickle import load, dump
-from multiprocessing import Process
+from multiprocessing import Process, active_children
 from multiprocessing.managers import SyncManager
-from lib.server import tcp_server, udp_server, udp_client
-from lib.utils  import (read_bytes_until, DEFAULT_CS_PORT, CS_KNOWN_BS_SAVEFILE,
+from lib.server import tcp_client, tcp_server, udp_server, udp_client
+from lib.metrics import (init_metrics, timed, count, count_tcp_bytes,
+                         format_sta, serve_metrics)
+from lib.placement import (rank_bs, least_loaded, account_placement, bs_liveness,
+                           plan_rebalance, account_move, shard_of, STRIPE_MIN_BYTES)
+from lib.bandwidth import parse_rate
+from lib.utils  import (DEFAULT_CS_PORT, CS_KNOWN_BS_SAVEFILE,
                         CS_VALID_USERS_SAVEFILE, CS_DIRS_LOCATION_SAVEFILE,
-                        backup_dict_to_file, restore_dict_from_file,
+                        CS_DIRS_DELETED_SAVEFILE,
+                        BS_HEARTBEAT_INTERVAL,
+                        restore_dict_from_file,
                         ignore_sigint, get_best_ip)
+from lib.metadata import Table, open_metadata, migrate_pickle, persist
+from lib.cluster import (RELAYED, parse_nodes, node_of, owns, relay, from_node,
+                         proxy_session)
+from lib.protocol import (read_message, send_message, accept_version, parse_entries,
+                          entry_fields, offer_version, negotiated, read_reply, send_chunked,
+                          recv_chunked, REDIRECT, CHECKSUM, CHUNKED)
+from lib.log import (log, init_logging, stop_logging, parse_levels,
+                     DEBUG, INFO, WARNING, ERROR)
+
+
+TCP_COMMANDS = ("AUT", "DLU", "BCK", "RST", "LSD", "LSF", "LSN", "DEL", "LDS", "BCM")
+UDP_COMMANDS = ("REG", "UNR", "STS", "HBT", "STA", "FWD")
+# Round trips of the queries of the CS to the BSs
+BS_QUERIES = ("BS_LSU", "BS_LSF", "BS_LSC", "BS_LSN", "BS_DLB", "BS_LSQ", "BS_MIG")
+COUNTERS = ("bytes_in", "bytes_out", "connections", "workers", "refused",
+            "redirected", "proxied", "migrated")
+
+# Admission control of TCP sessions, see admit
+MAX_SESSIONS = 64           # sessions served at once, by default
+BUSY_RETRY_AFTER = 1        # seconds to wait suggested to clients refused for load
+IP_BURST_SECONDS = 2        # a source IP may burst this many seconds of its rate
+MAX_TRACKED_IPS = 10000     # rate limit buckets kept before pruning the full ones
+REFUSED_LINGER = 1          # seconds a refused connection is kept open, draining
+MAX_LINGERING = 256         # refused connections kept open, at most
+MAX_FANOUT = 32             # queries to BSs in flight at once, for a single command
+
+# Rebalancing of the folders among the BSs, see rebalance
+REBALANCE_INTERVAL = 30     # seconds between rounds
+REBALANCE_CANDIDATES = 32   # folders of the fullest BS sized up for each move
+MIGRATION_TIMEOUT = 3600    # seconds a BS may take to move a folder
+
+PURGE_INTERVAL = 10         # seconds between retries of the deletions left behind
 
 
 # Function to deal with any protocol unexpected error
-def unexpected_command(my_socket):
+def unexpected_command(my_socket, address=None):
     """ Informs that there was a error. TCP and UDP compatible. """
-    my_socket.sendall("ERR\n".encode())
+    if not address:
+        my_socket.sendall("ERR\n".encode())
+    else:
+        my_socket.sendto("ERR\n".encode(), address)
 
 
 # Code to deal with queries from BS (UDP server)
-def deal_with_udp(udp_socket, known_bs):
+def deal_with_udp(udp_socket, known_bs, bs_load, bs_health, cluster):
+    """ UDP server process function / program
+
+    In a cluster (this node, nodes), the messages of the BSs are relayed
+    to the other nodes, which handle them as their own but do not answer.
+    """
+
     def signal_handler(_signum, _frame):
         udp_socket.close()
         exit(0)
@@ -28,43 +81,132 @@ def deal_with_udp(udp_socket, known_bs):
     signal(SIGINT, SIG_IGN)
     signal(SIGTERM, signal_handler)
 
+    # wake up at least once per heartbeat, to notice silent BSs
+    udp_socket.settimeout(BS_HEARTBEAT_INTERVAL)
+    last_sweep = time()
+
     while True:
-        response, address = udp_socket.recvfrom(32)
+        if time() - last_sweep >= BS_HEARTBEAT_INTERVAL:
+            sweep_bs_health(known_bs, bs_health)
+            last_sweep = time()
+
+        try:
+            response, address = udp_socket.recvfrom(256)
+        except socket.timeout:
+            continue
+
         args = response.decode().split(" ")
-        command = args[0]
+        command = args[0].rstrip("\n")
         args = args[1:]
 
-        if command == "REG":
-            add_bs(known_bs, args, udp_socket, address)
-        elif command == "UNR":
-            remove_bs(known_bs, args, udp_socket, address)
-        else:
-            unexpected_command(udp_socket)
+        relayed = command == "FWD" and cluster is not None and from_node(cluster, address)
+        if relayed:
+            command, args, address = args[0].rstrip("\n"), args[1:], None
+        elif cluster is not None and command in RELAYED:
+            relay(udp_socket, cluster, response)
+
+        with timed(command if command in UDP_COMMANDS else "ERR"):
+            if command == "REG":
+                add_bs(known_bs, bs_load, bs_health, args, udp_socket, address)
+            elif command == "UNR":
+                remove_bs(known_bs, bs_load, bs_health, args, udp_socket, address)
+            elif command == "STS":
+                update_bs_load(known_bs, bs_load, bs_health, args, learn=relayed)
+            elif command == "HBT":
+                heartbeat_bs(known_bs, bs_health, args)
+            elif command == "STA":
+                udp_socket.sendto(format_sta().encode(), address)
+            else:
+                unexpected_command(udp_socket, address)
+
+
+
+def bs_state(bs_health, bs):
+    """ Liveness of a BS ("alive", "suspect" or "dead"), as last marked """
+    return bs_health.get(bs, (0, "alive"))[1]
+
+
+def mark_bs_seen(bs_health, bs):
+    """ Any message from a BS proves it is alive """
+
+    if bs_state(bs_health, bs) != "alive":
+        log(INFO, "-> BS {} {} is alive again".format(*bs))
+    bs_health[bs] = (time(), "alive")
+
+
+def sweep_bs_health(known_bs, bs_health):
+    """ Marks as suspect or dead the BSs that went silent """
+
+    now = time()
+    for bs in known_bs.copy():
+        # BSs known before this CS started get a full grace period
+        last_seen, state = bs_health.get(bs, (now, "alive"))
+        new_state = bs_liveness(last_seen, now)
+
+        if new_state != state:
+            log(INFO, "-> BS {} {} is now {} (silent for {:.0f} s)".format(*bs, new_state, now - last_seen))
+        if new_state != state or bs not in bs_health:
+            bs_health[bs] = (last_seen, new_state)
+
+
+def heartbeat_bs(known_bs, bs_health, args):
+    """ Heartbeat of a BS (HBT, no response) """
+
+    port_bs = args[-1].split("\n")[0]
+
+    if len(args) != 2 or port_bs.isdigit() is False:
+        log(ERROR, "Malformed heartbeat received from BS server: {}".format(args))
+    elif (args[0], port_bs) not in known_bs:
+        log(ERROR, "Heartbeat from unknown BS {} {}".format(args[0], port_bs))
+    else:
+        mark_bs_seen(bs_health, (args[0], port_bs))
+
+
 
+def parse_bs_load(args):
+    """ Returns (free, total, active_transfers, throughput) from REG/STS args
 
+    Old BSs register without load fields; None is returned for those.
+    """
 
-def add_bs(known_bs, args, udp_socket, address):
+    fields = [arg.split("\n")[0] for arg in args[2:]]
+
+    if len(fields) != 4 or not all(field.isdigit() for field in fields):
+        return None
+
+    return tuple(int(field) for field in fields)
+
+
+
+def add_bs(known_bs, bs_load, bs_health, args, udp_socket, address):
 
     status = "ERR"
 
     ip_bs = args[0]
     port_bs = args[1].split("\n")[0]
+    load = parse_bs_load(args)
 
-    if len(args) != 2 or port_bs.isdigit() is False:
-        print("Error in arguments received from BS server: {} {}".format(ip_bs, port_bs))
+    if len(args) not in (2, 6) or port_bs.isdigit() is False:
+        log(ERROR, "Malformed arguments received from BS server: {} {}".format(ip_bs, port_bs))
     elif (ip_bs, port_bs) in known_bs:
-        print("Error: Already added BS {}".format(ip_bs))
+        log(ERROR, "Already added BS {}".format(ip_bs))
         status = "NOK"
     else:
         known_bs[(ip_bs, port_bs)] = 0
-        backup_dict_to_file(known_bs, CS_KNOWN_BS_SAVEFILE)
+        persist(known_bs, CS_KNOWN_BS_SAVEFILE)
         status = "OK"
 
-    print("-> BS added:\n  - ip: {}\n  - port: {}\n".format(ip_bs, port_bs))
-    udp_socket.sendto("RGR {}\n".format(status).encode(), address)
+    if status != "ERR":
+        mark_bs_seen(bs_health, (ip_bs, port_bs))
+        if load:
+            bs_load[(ip_bs, port_bs)] = load
+
+    log(INFO, "-> BS added:\n  - ip: {}\n  - port: {}".format(ip_bs, port_bs))
+    if address is not None: # relayed by another node otherwise
+        udp_socket.sendto("RGR {}\n".format(status).encode(), address)
 
 
-def remove_bs(known_bs, args, udp_socket, address):
+def remove_bs(known_bs, bs_load, bs_health, args, udp_socket, address):
 
     status = "ERR\n"
 
@@ -72,409 +214,1220 @@ def remove_bs(known_bs, args, udp_socket, address):
     port_bs = args[1].split("\n")[0]
 
     if len(args) != 2 or port_bs.isdigit() is False:
-        print("Error in arguments received from BS server: {} {}".format(ip_bs, port_bs))
+        log(ERROR, "Malformed arguments received from BS server: {} {}".format(ip_bs, port_bs))
     elif (ip_bs, port_bs) not in known_bs:
-        print("Error: User {} does not exist".format(ip_bs))
+        log(ERROR, "User {} does not exist".format(ip_bs))
         status = "NOK\n"
     else:
         del known_bs[(ip_bs, port_bs)]
-        backup_dict_to_file(known_bs, CS_KNOWN_BS_SAVEFILE)
+        bs_load.pop((ip_bs, port_bs), None)
+        bs_health.pop((ip_bs, port_bs), None)
+        persist(known_bs, CS_KNOWN_BS_SAVEFILE)
         status = "OK\n"
 
-    print("-> BS removed:\n  - ip: {}\n  - port: {}\n".format(ip_bs, port_bs))
-    udp_socket.sendto("UAR {}\n".format(status).encode(), address)
+    log(INFO, "-> BS removed:\n  - ip: {}\n  - port: {}".format(ip_bs, port_bs))
+    if address is not None:
+        udp_socket.sendto("UAR {}\n".format(status).encode(), address)
+
+
+def update_bs_load(known_bs, bs_load, bs_health, args, learn=False):
+    """ Stores the periodic load report of a BS (STS, no response)
+
+    With learn, an unknown BS is added (a node that missed its REG learns
+    it from the reports relayed by the others).
+    """
+
+    load = parse_bs_load(args)
+
+    if len(args) != 6 or load is None:
+        log(ERROR, "Malformed load report received from BS server: {}".format(args))
+    elif (args[0], args[1]) not in known_bs and learn:
+        known_bs[(args[0], args[1])] = 0
+        persist(known_bs, CS_KNOWN_BS_SAVEFILE)
+        bs_load[(args[0], args[1])] = load
+        mark_bs_seen(bs_health, (args[0], args[1]))
+        log(INFO, "Learned of BS {} {} from another node".format(args[0], args[1]))
+    elif (args[0], args[1]) not in known_bs:
+        log(ERROR, "Load report from unknown BS {} {}".format(args[0], args[1]))
+    else:
+        bs_load[(args[0], args[1])] = load
+        mark_bs_seen(bs_health, (args[0], args[1]))
+
+
+
+def admit(ip, ip_buckets, max_sessions, ip_rate):
+    """ Admission control of a new TCP session from ip
+
+    Returns 0 if it can be served now, else the seconds after which the
+    client should retry: if max_sessions sessions are being served already,
+    or if ip went over ip_rate new sessions per second (a token bucket per
+    source IP, holding IP_BURST_SECONDS of rate). 0 disables either limit.
+    """
+
+    if max_sessions and len(active_children()) >= max_sessions:
+        return BUSY_RETRY_AFTER
+
+    if ip_rate:
+        now = monotonic()
+        burst = max(1, ip_rate * IP_BURST_SECONDS)
+        tokens, last = ip_buckets.get(ip, (burst, now))
+        tokens = min(burst, tokens + (now - last) * ip_rate)
+        if tokens < 1:
+            ip_buckets[ip] = (tokens, now)
+            return ceil((1 - tokens) / ip_rate)
+        ip_buckets[ip] = (tokens - 1, now)
+
+        if len(ip_buckets) > MAX_TRACKED_IPS:
+            for other, (tokens, last) in list(ip_buckets.items()):
+                if tokens + (now - last) * ip_rate >= burst:
+                    del ip_buckets[other]
+    return 0
+
+
+def refuse(conn, retry_after):
+    """ Tells a client the CS is busy (BSY), without reading its request
+
+    The connection is only half closed: closing it with the request unread
+    would reset it, and the client could lose the reply. See drain_refused.
+    """
+
+    try:
+        conn.sendall("BSY {}\n".format(retry_after).encode())
+        conn.shutdown(socket.SHUT_WR)
+    except OSError:
+        pass
+
 
+def drain_refused(conn):
+    """ Closes a refused connection, after reading whatever the client sent """
 
+    conn.setblocking(False)
+    try:
+        while conn.recv(4096):
+            pass
+    except OSError:
+        pass
+    conn.close()
 
 
-def deal_with_tcp(tcp_socket, valid_users, dirs_location, known_bs):
+def deal_with_tcp(tcp_socket, valid_users, dirs_location, dirs_deleted, known_bs, bs_load,
+                  bs_health, replication, stripe_width, max_sessions, ip_rate, cluster):
 
     def signal_handler(_signum, _frame):
         tcp_socket.close()
         exit(0)
 
 
-    def deal_with_client(client, valid_users, dirs_location, known_bs):
+    def deal_with_client(client, valid_users, dirs_location, dirs_deleted, known_bs, bs_load,
+                         bs_health, replication, stripe_width, cluster):
         """ Code / function for forked worker """
 
         conn = client[0]
+        count("workers", 1)
+        try:
+            deal_with_commands(conn, client, valid_users, dirs_location, dirs_deleted, known_bs,
+                               bs_load, bs_health, replication, stripe_width, cluster)
+        finally:
+            count("workers", -1)
+            count_tcp_bytes(conn)
+
+        conn.close() # end of code
+
+
+    def deal_with_commands(conn, client, valid_users, dirs_location, dirs_deleted, known_bs,
+                           bs_load, bs_health, replication, stripe_width, cluster):
+        """ Serves the commands of a client, until one that ends the session
+
+        A client may ask for version 2 of the protocol (VER) before its AUT;
+        from the reply to that AUT on, messages are frames, and no command
+        ends the session: the client closes it when done. A client that
+        offers CHUNKED sends the manifest of a BCK, and takes its BKR, in
+        chunks. In a cluster, the session of a user owned by another node is
+        handed to it on its AUT.
+        """
+
         logged_in = False       # this var is False or contains the user id
+        version = next_version = 1
+        offered = None          # fields of the VER of the client, if any
+        chunked = False         # BCK and BKR in chunks (see send_chunked)
+        owner = None            # node the session is handed to, if any
         while True:
             try:
-                command = read_bytes_until(conn, " \n")
-
-                if command == "AUT":
-                    logged_in, password = authenticate_user(valid_users, conn)
-                elif command == "DLU" and logged_in:
-                    delete_user(logged_in, conn, dirs_location, valid_users)
-                    break
-                elif command == "BCK" and logged_in:
-                    backup_dir(logged_in, conn, known_bs, password, dirs_location)
-                    break
-                elif command == "RST" and logged_in:
-                    restore_dir(logged_in, conn, dirs_location)
-                    break
-                elif command == "LSD" and logged_in:
-                    list_user_dirs(logged_in, conn, dirs_location)
-                    break
-                elif command == "LSF" and logged_in:
-                    list_files_in_dir(logged_in, conn, dirs_location)
-                    break
-                elif command == "DEL" and logged_in:
-                    delete_dir(logged_in, conn, dirs_location)
-                    break
-                else:
-                    unexpected_command(conn)
+                message = read_message(conn, version)
+
+                if message is None:
+                    break # connection closed by the client
+                command, args, request_id = message
+
+                with timed(command if command in TCP_COMMANDS else "ERR"):
+                    try:
+                        if command == "VER":
+                            next_version = accept_version(args)
+                            offered = args
+                            chunked = next_version >= 2 and CHUNKED in args
+                            reply = ["VER", next_version] + ([CHUNKED] if chunked else [])
+                        elif command == "AUT" and not owns(cluster, args[0]):
+                            if version == 1:
+                                owner, aut = node_of(args[0], cluster[1]), args
+                                break
+                            reply = ["AUR", "NOK"] # a session in frames cannot move
+                        elif command == "AUT":
+                            logged_in, password, reply = authenticate_user(valid_users, args)
+                        elif command == "DLU" and logged_in:
+                            reply = delete_user(logged_in, dirs_location, valid_users)
+                        elif command == "BCK" and logged_in:
+                            if chunked:
+                                args = recv_chunked(conn, "BCK", args, 1, 3)
+                            reply = backup_dir(logged_in, args, version, known_bs, bs_load,
+                                               bs_health, password, dirs_location,
+                                               dirs_deleted, replication, stripe_width)
+                        elif command == "BCM" and logged_in:
+                            reply = backup_dirs(logged_in, args, version, known_bs, bs_load,
+                                                bs_health, password, dirs_location,
+                                                dirs_deleted, replication, stripe_width)
+                        elif command == "RST" and logged_in:
+                            reply = restore_dir(logged_in, args, dirs_location, bs_health, bs_load)
+                        elif command == "LSD" and logged_in:
+                            reply = list_user_dirs(logged_in, dirs_location)
+                        elif command == "LDS" and logged_in:
+                            reply = describe_user_dirs(logged_in, version, dirs_location,
+                                                       bs_health, bs_load)
+                        elif command == "LSF" and logged_in:
+                            reply = list_files_in_dir(logged_in, args, version, offered,
+                                                      dirs_location, bs_health, bs_load)
+                        elif command == "LSN" and logged_in:
+                            reply = list_dir_snapshots(logged_in, args, dirs_location,
+                                                       bs_health, bs_load)
+                        elif command == "DEL" and logged_in:
+                            reply = delete_dir(logged_in, args, dirs_location, dirs_deleted,
+                                               bs_health)
+                        else:
+                            reply = ["ERR"]
+                    except (IndexError, ValueError):
+                        log(WARNING, "Malformed {} from {}".format(command, client[1]))
+                        reply = ["ERR"]
+                    if command == "BCK" and chunked and len(reply) > 3:
+                        n_files = reply[3]
+                        send_chunked(conn, "BKR", reply[1:3], parse_entries(reply[4:], n_files, 2),
+                                     reply[4 + 3 * n_files:], request_id)
+                    else:
+                        send_message(conn, version, reply, request_id)
+
+                if command != "VER":
+                    version = next_version
+                if version == 1 and logged_in and command in TCP_COMMANDS[1:]:
+                    break # in text, each command but AUT ends the session
             except (BrokenPipeError, ConnectionResetError):
-                print("{}: connection closed\n".format(client[1]))
+                log(INFO, "{}: connection closed".format(client[1]))
                 exit(0)
+            except ConnectionError as error:
+                log(WARNING, "{}: {}".format(client[1], error))
+                break
 
-        conn.close() # end of code
+        if owner is not None:
+            hand_off(conn, client, owner, offered, aut)
 
 
     # Mask CTRL-C, handle SIGTERM (terminate, from father)
     signal(SIGINT, SIG_IGN)
     signal(SIGTERM, signal_handler)
+    ip_buckets = {}     # {ip: (tokens, last update)}, for the rate limit of admit
+    lingering = deque() # (deadline, connection) of refused connections
     while True:
-        client = tcp_socket.accept()
-        p_client = Process(target=deal_with_client, args=(client, valid_users, dirs_location, known_bs), daemon=True)
+        tcp_socket.settimeout(max(0.001, lingering[0][0] - monotonic()) if lingering else None)
+        try:
+            client = tcp_socket.accept()
+        except socket.timeout:
+            client = None
+
+        now = monotonic()
+        while lingering and (lingering[0][0] <= now or len(lingering) > MAX_LINGERING):
+            drain_refused(lingering.popleft()[1])
+        if client is None:
+            continue
+
+        count("connections")
+        retry_after = admit(client[1][0], ip_buckets, max_sessions, ip_rate)
+        if retry_after:
+            count("refused")
+            refuse(client[0], retry_after)
+            lingering.append((now + REFUSED_LINGER, client[0]))
+            continue
+
+        p_client = Process(target=deal_with_client,
+                           args=(client, valid_users, dirs_location, dirs_deleted, known_bs,
+                                 bs_load, bs_health, replication, stripe_width, cluster),
+                           daemon=True)
         p_client.start()
 
 
 
-def authenticate_user(valid_users, conn):
-    """ Authenticates user, returns (user,pass) (AUT/AUR) """
+def hand_off(conn, client, owner, offered, aut):
+    """ Hands a session over to the node that owns its user
 
-    username = read_bytes_until(conn, " ")
-    password = read_bytes_until(conn, "\n")
+    A client that follows redirects (REDIRECT in its VER) is told to go to
+    the owner; the sessions of other clients are proxied to it. If the owner
+    cannot be reached, the client is told to retry (BSY), as when busy.
+    """
 
-    print("-> AUT {} {}".format(username, password))
+    if offered is not None and REDIRECT in offered:
+        log(DEBUG, "{}: user {} redirected to {} {}".format(client[1], aut[0], *owner))
+        count("redirected")
+        conn.sendall("{} {} {}\n".format(REDIRECT, *owner).encode())
+        return
+
+    log(DEBUG, "{}: user {} proxied to {} {}".format(client[1], aut[0], *owner))
+    count("proxied")
+    try:
+        proxy_session(conn, owner, offered, aut)
+    except OSError as error:
+        log(WARNING, "Could not reach node {} {}: {}".format(*owner, error))
+        conn.sendall("BSY {}\n".format(BUSY_RETRY_AFTER).encode())
+
+
+def authenticate_user(valid_users, args):
+    """ Authenticates user, returns (user, pass, reply) (AUT/AUR) """
+
+    username, password = args[0], args[1]
+
+    log(INFO, "-> AUT {} {}".format(username, password))
 
     res = (False, False)
     status = "NOK"
     if username not in valid_users:
         valid_users[username] = password
-        backup_dict_to_file(valid_users, CS_VALID_USERS_SAVEFILE)
+        persist(valid_users, CS_VALID_USERS_SAVEFILE)
         res = (username, password)
         status = "NEW"
-        print("New user: {}".format(username))
+        log(INFO, "New user: {}".format(username))
     elif valid_users[username] != password:
-        print("Password received does not match")
+        log(WARNING, "Password received does not match")
     else:
         res = (username, password)
         status = "OK"
-        print("User {} logged in sucessfully".format(username))
+        log(INFO, "User {} logged in sucessfully".format(username))
 
-    response = "AUR {}\n".format(status)
-    conn.sendall(response.encode())
-    return res
+    return (*res, ["AUR", status])
 
 
 
-def delete_user(username, conn, dirs_location, valid_users):
+def delete_user(username, dirs_location, valid_users):
 
-    print(">> DLU")
-    status = "NOK\n"
+    log(INFO, ">> DLU")
+    status = "NOK"
 
-    if username in [f[0] for f in dict(dirs_location)]:
-        print("There is still information stored for user\n")
+    if user_dirs(dirs_location, username):
+        log(INFO, "There is still information stored for user")
     else:
         del valid_users[username]
-        backup_dict_to_file(valid_users, CS_VALID_USERS_SAVEFILE)
-        status = "OK\n"
-        print("User {} deleted sucessfully\n".format(username))
+        persist(valid_users, CS_VALID_USERS_SAVEFILE)
+        status = "OK"
+        log(INFO, "User {} deleted sucessfully".format(username))
+
+    return ["DLR", status]
+
+
+
+def as_shards(location):
+    """ Converts the location of a folder saved by older CSs to shards
+
+    Before replication a location was (ipBS, portBS); before striping it was
+    a tuple of those.
+    """
+
+    if isinstance(location[0], str):
+        return ((location,),)
+    elif isinstance(location[0][0], str):
+        return (tuple(location),)
+    return location
+
+
+def user_dirs(dirs_location, username):
+    """ {"folder": location} of the folders of the user """
+
+    if isinstance(dirs_location, Table):
+        return dict(dirs_location.items_of(username))
+    return {folder: location for (user, folder), location in dirs_location.copy().items()
+            if user == username}
+
+
+def dir_shards(dirs_location, username, folder):
+    """ Returns the shards of the user's folder
 
-    response = "DLR " + status
-    conn.sendall(response.encode())
+    Each shard is a tuple of the BSs (ip, port) holding a copy of it. A
+    folder that is not striped has a single shard.
+    """
 
+    return tuple(dirs_location.get((username, folder), ()))
 
 
-def backup_dir(username, conn, known_bs, password, dirs_location):
+def readable_replicas(replicas, bs_health, bs_load):
+    """ Replicas to read from, best first: alive ones, least loaded first,
+    then suspect ones; never dead ones """
 
-    flag = 0
-    folder = read_bytes_until(conn, " ")
-    nr_user_files = int(read_bytes_until(conn, " "))
-    print(">> BCK {} {}".format(folder, str(nr_user_files)))
-    user_dict = {} # {"filename": [date, time, size]}
-    bs_dict = {}   # {"filename": [date, time, size]}
-    string_of_files = ""
-    registered_in_bs = 0
+    load = bs_load.copy()
+    ordered = []
+    for state in ("alive", "suspect"):
+        candidates = [bs for bs in replicas if bs_state(bs_health, bs) == state]
+        while candidates:
+            ordered.append(least_loaded(candidates, load))
+            candidates.remove(ordered[-1])
+    return ordered
 
-    files_user = read_bytes_until(conn, "\n").split()
 
-    for i in range(nr_user_files):
-        filename = files_user[4*i]
-        date = files_user[4*i+1]
-        time = files_user[4*i+2]
-        size = files_user[4*i+3]
-        user_dict[filename] = [date, time, size]
-        string_of_files += " {} {} {} {}".format(filename, date, time, size)
+def readable_replica(replicas, bs_health, bs_load):
+    """ Least loaded replica to read from: alive if possible, never dead """
 
+    ordered = readable_replicas(replicas, bs_health, bs_load)
+    return ordered[0] if ordered else None
 
-    if (username, folder) in dirs_location:
-        flag = 1
-        ip_bs = dirs_location[(username, folder)][0]
-        port_bs = dirs_location[(username, folder)][1]
 
-        print("BCK {} {} {} {}".format(username, folder, ip_bs, port_bs))
+def query_shard_files(shard, username, folder, bs_health, bs_load, as_of=None,
+                      checksums=False):
+    """ Lists a shard of a folder from one of its replicas
 
-        bs_socket = udp_client(ip_bs, int(port_bs))
-        bs_socket.sendall("LSF {} {}\n".format(username, folder).encode())
-        response = bs_socket.recv(2048).decode().split()
+    Replicas are asked best first (see readable_replicas) until one has
+    files: clients that do not upload to every replica (text clients older
+    than replication) leave the others without the folder. Returns (BS,
+    listing), see query_bs_files, or (None, None) if no replica answered.
+    """
+
+    found = (None, None)
+    for bs in readable_replicas(shard, bs_health, bs_load):
+        listing = query_bs_files(bs, username, folder, as_of, checksums)
+        if listing:
+            return bs, listing
+        if listing is not None and found[0] is None:
+            found = (bs, listing)
+    return found
+
+
+def query_bs_files(bs, username, folder, as_of=None, checksums=False):
+    """ Asks a BS for the files of a folder (LSF/LFD)
+
+    Returns {"filename": (mtime, size)}, or None on error. With as_of,
+    a snapshot id, lists the folder as of then. With checksums, asks for
+    the digests too (LSC/LCR), and entries are (mtime, size, digest), the
+    digest "-" if unknown: BSs that do not know LSC, or whose listing does
+    not fit in a datagram, answer ERR, and are asked LSF instead.
+    """
+
+    query, answer = ("LSC", "LCR") if checksums else ("LSF", "LFD")
+    ip_bs, port_bs = bs
+    bs_socket = udp_client(ip_bs, int(port_bs))
+    snapshot = " " + as_of if as_of else ""
+    try:
+        with timed("BS_" + query):
+            bs_socket.sendall("{} {} {}{}\n".format(query, username, folder, snapshot).encode())
+            response = bs_socket.recv(65535).decode().split()
+    except (socket.timeout, ConnectionError):
+        log(WARNING, "BS {} {} did not answer {}".format(ip_bs, port_bs, query))
+        return None
+    finally:
         bs_socket.close()
-        command = response[0]
-
-        if command != "LFD":
-            print("Error in command")
-            exit(0)
-
-
-        nr_bs_files = int(response[1])
-        for i in range(nr_bs_files):
-            filename = response[2 + 4*i]
-            date = response[2 + 4*i + 1]
-            time = response[2 + 4*i + 2]
-            size = response[2 + 4*i + 3]
-            bs_dict[filename] = [date, time, size]
-
-
-        final_string_of_files = ""
-        nr_files_final = 0
-        for user_file in user_dict:
-            for bs_file in bs_dict:
-                if user_file == bs_file and user_dict[user_file] != bs_dict[bs_file]:
-                    final_string_of_files += " {} {} {} {}".format(user_file, bs_dict[user_file][0], bs_dict[user_file][1], bs_dict[user_file][2])
-                    nr_files_final += 1
-        if nr_files_final == 0:
-            print("No files to backup\n")
-        response = "BKR {} {} {}{}\n".format(ip_bs, port_bs, nr_files_final, final_string_of_files)
-        conn.sendall(response.encode())
-
-    if flag == 0:
-        ip_bs = ""
-        flag_bs = 0
-        flag_first_user = 1
-        first_user = ()
-        if not known_bs:
-            print("No BS available to backup [BKR EOF]\n")
-            conn.sendall("BKR EOF\n".encode())
-            return
-        known_bs_temp = dict(known_bs)
-        for (ip, port) in known_bs_temp:
-            '''verifica se e a primeira chave do dicionario
-               Se for, guarda caso os BS ja tenham sido usados para backup
-               o mesmo numero de vezes'''
-            if flag_first_user:
-                ip_bs, port_bs = (ip, port)
-                flag_first_user = 0
-            elif known_bs_temp[(ip, port)] < known_bs_temp[(ip_bs, port_bs)]:
-                ip_bs, port_bs = (ip, port)
-
-        known_bs[(ip_bs, port_bs)] += 1
-        print("BS with ip: {} and port: {} was chosen for backup".format(ip_bs, port_bs))
-
-        for (user, directory) in dict(dirs_location):
-            if dirs_location[(user, directory)] == (ip_bs, port_bs) and user == username:
-                print("User {} is already registered in BS with ip: {} and port: {}\n".format(username, ip_bs, port_bs))
-                registered_in_bs = 1
-                break
 
-        dirs_location[(username, folder)] = (ip_bs, port_bs)
-        backup_dict_to_file(dirs_location, CS_DIRS_LOCATION_SAVEFILE)
+    if checksums and response in (["ERR"], [answer, "ERR"]):
+        bs_dict = query_bs_files(bs, username, folder, as_of)
+        if bs_dict is None:
+            return None
+        return {filename: (*entry, "-") for filename, entry in bs_dict.items()}
 
-        if not registered_in_bs:
-            bs_socket = udp_client(ip_bs, int(port_bs))
-            response = "LSU {} {}\n".format(username, password)
-            bs_socket.sendall(response.encode())
-            command, status = bs_socket.recv(32).decode()[:-1].split()
-            bs_socket.close()
+    if not response or response[0] != answer or not response[1].isdigit():
+        log(ERROR, "Malformed {} reply from BS {} {}".format(query, ip_bs, port_bs))
+        return None
 
-            if command != "LUR":
-                print("Error in command\n")
-                exit(0)
-            elif status == "NOK\n":
-                print("Already knew user\n")
-                exit(0)
-            elif status == "ERR\n":
-                print("Error in arguments sent from CS to BS\n")
-                exit(0)
+    try:
+        entries = parse_entries(response[2:], int(response[1]), 1, checksums)
+    except (IndexError, ValueError):
+        log(ERROR, "Malformed {} reply from BS {} {}".format(query, ip_bs, port_bs))
+        return None
+    return {filename: tuple(entry) for filename, *entry in entries}
+
+
+def query_dir_files(shards, username, folder, bs_health, bs_load, as_of=None,
+                    checksums=False):
+    """ Merges the listings of one replica of each shard of a folder
+
+    Returns (BS listed for each shard, {"filename": (mtime, size)}), or
+    (None, None) if a shard cannot be listed. With checksums, entries have
+    digests, see query_bs_files.
+    """
+
+    readers = []
+    dir_dict = {}
+    for shard in shards:
+        bs, bs_dict = query_shard_files(shard, username, folder, bs_health, bs_load,
+                                        as_of, checksums)
+        if bs_dict is None:
+            return None, None
+        readers.append(bs)
+        dir_dict.update(bs_dict)
+    return readers, dir_dict
+
+
+def query_bs_snapshots(bs, username, folder):
+    """ Asks a BS for the snapshots of a folder (LSN/LNR)
+
+    Returns the list of snapshot ids, or None on error.
+    """
+
+    bs_socket = udp_client(bs[0], int(bs[1]))
+    try:
+        with timed("BS_LSN"):
+            bs_socket.sendall("LSN {} {}\n".format(username, folder).encode())
+            response = bs_socket.recv(65535).decode().split()
+    except (socket.timeout, ConnectionError):
+        log(WARNING, "BS {} {} did not answer LSN".format(*bs))
+        return None
+    finally:
+        bs_socket.close()
+
+    if len(response) < 2 or response[0] != "LNR" or not response[1].isdigit():
+        log(ERROR, "Malformed LSN reply from BS {} {}".format(*bs))
+        return None
+    return response[2:]
+
+
+def register_user_in_bs(bs, username, password):
+    """ Registers the user in a BS (LSU/LUR), returns True on success """
+
+    ip_bs, port_bs = bs
+    bs_socket = udp_client(ip_bs, int(port_bs))
+    try:
+        with timed("BS_LSU"):
+            bs_socket.sendall("LSU {} {}\n".format(username, password).encode())
+            reply = bs_socket.recv(32)
+        command, status = reply.decode()[:-1].split()
+    except (socket.timeout, ConnectionError, ValueError):
+        log(WARNING, "BS {} {} did not answer LSU".format(ip_bs, port_bs))
+        return False
+    finally:
+        bs_socket.close()
+
+    if command != "LUR":
+        log(ERROR, "Malformed LSU reply from BS {} {}".format(ip_bs, port_bs))
+    elif status == "NOK":
+        log(INFO, "Already knew user")
+    elif status == "ERR":
+        log(ERROR, "BS rejected the arguments sent from CS")
+    else:
+        log(INFO, "User {} was added to BS with ip: {} and port: {} sucessfully".format(username, ip_bs, port_bs))
+        return True
+    return False
+
+
+def quota_left(bs, username):
+    """ Bytes the user may still store in a BS (LSQ/LQR)
+
+    None if the BS has no quotas (or does not know LSQ), 0 if it did not
+    answer.
+    """
+
+    ip_bs, port_bs = bs
+    bs_socket = udp_client(ip_bs, int(port_bs))
+    try:
+        with timed("BS_LSQ"):
+            bs_socket.sendall("LSQ {}\n".format(username).encode())
+            reply = bs_socket.recv(64).decode().split()
+    except (socket.timeout, ConnectionError):
+        log(WARNING, "BS {} {} did not answer LSQ".format(ip_bs, port_bs))
+        return 0
+    finally:
+        bs_socket.close()
+
+    if len(reply) != 3 or reply[0] != "LQR" or reply[2] == "0":
+        return None
+    return max(0, int(reply[2]) - int(reply[1]))
+
+
+def drop_unwritten(username, folder, shards, listings, dirs_location):
+    """ Forgets the replicas of a folder that a text client left empty
+
+    Text clients older than replication upload only to the first BS of the
+    BKR reply. The replicas of a shard without files, while another of
+    them has files, are removed from the location of the folder, so that it
+    only has the replicas written. listings are {BS: listing}; returns the
+    shards without those replicas.
+    """
+
+    kept = [tuple(bs for bs in shard
+                  if listings[bs] or not any(listings[other] for other in shard))
+            for shard in shards]
+    dropped = {bs for shard in shards for bs in shard} - {bs for shard in kept for bs in shard}
+    if dropped:
+        log(WARNING, "{} of {} was not uploaded to BSs {}, forgetting them".format(
+            folder, username, " ".join("{} {}".format(*bs) for bs in dropped)))
+        location = dir_shards(dirs_location, username, folder)
+        dirs_location[(username, folder)] = tuple(tuple(bs for bs in shard if bs not in dropped)
+                                                  for shard in location)
+        persist(dirs_location, CS_DIRS_LOCATION_SAVEFILE)
+    return kept
+
+
+def backup_dir(username, args, version, known_bs, bs_load, bs_health, password,
+               dirs_location, dirs_deleted, replication, stripe_width):
+
+    folder = args[0]
+    nr_user_files = int(args[1])
+    log(INFO, ">> BCK {} {}".format(folder, str(nr_user_files)))
+    user_dict = {filename: (mtime, size) # {"filename": (mtime, size)}
+                 for filename, mtime, size in parse_entries(args[2:], nr_user_files, version)}
+    to_backup = list(user_dict)
+    dir_size = sum(size for _mtime, size in user_dict.values())
+
+
+    shards = dir_shards(dirs_location, username, folder)
+    if shards:
+        log(INFO, "BCK {} {} {}".format(username, folder, shards))
+
+        # Uploads go to every replica still alive that answers; the files
+        # that changed since last time are those that differ in any of them
+        listings = {}
+        for shard in shards:
+            for bs in shard:
+                if bs_state(bs_health, bs) != "dead":
+                    listings[bs] = query_bs_files(bs, username, folder)
+        shards = [tuple(bs for bs in shard if listings.get(bs) is not None)
+                  for shard in shards]
+
+        if not all(shards):
+            log(WARNING, "No replica of some shard of {} available [BKR EOF]".format(folder))
+            return ["BKR", "EOF"]
+
+        if version == 1:
+            shards = drop_unwritten(username, folder, shards, listings, dirs_location)
+
+        to_backup = [user_file for user_file in user_dict
+                     if any(user_dict[user_file] != listings[bs].get(user_file)
+                            for bs in shards[shard_of(user_file, len(shards))])]
+        if not to_backup:
+            log(INFO, "No files to backup")
+
+    else:
+        n_shards = stripe_width if dir_size >= STRIPE_MIN_BYTES else 1
+
+        # Not in the BSs still holding a deleted copy of the folder
+        left_behind = dirs_deleted.get((username, folder), ())
+        alive_bs = {bs: counter for bs, counter in known_bs.copy().items()
+                    if bs_state(bs_health, bs) == "alive" and bs not in left_behind}
+        ranking = rank_bs(alive_bs, bs_load.copy(), dir_size // n_shards)
+
+        # Take the best BSs in which the user can be registered, and in
+        # which their quota leaves room for the shard
+        chosen = []
+        user_folders = user_dirs(dirs_location, username)
+        for bs in ranking:
+            if len(chosen) == n_shards * replication:
+                break
+
+            registered_in_bs = any(bs in shard for location in user_folders.values()
+                                   for shard in as_shards(location))
+
+            if not (registered_in_bs or register_user_in_bs(bs, username, password)):
+                continue
+            room = quota_left(bs, username)
+            if room is None or room >= dir_size // n_shards:
+                chosen.append(bs)
             else:
-                print("User {} was added to BS with ip: {} and port: {} sucessfully\n".format(username, ip_bs, port_bs))
-        
-        response = "BKR {} {} {}{}\n".format(ip_bs, port_bs, nr_user_files, string_of_files)
-        conn.sendall(response.encode())
+                log(INFO, "User {} has {} bytes of quota left in BS {} {}".format(username, room, *bs))
+
+        if not chosen:
+            log(WARNING, "No BS available to backup [BKR EOF]")
+            return ["BKR", "EOF"]
+
+        # Fewer BSs than wanted: first give up stripes, then replicas
+        n_shards = max(1, min(n_shards, len(chosen) // replication))
+        n_replicas = min(replication, len(chosen) // n_shards)
+        if n_shards * n_replicas < n_shards * replication:
+            log(WARNING, "Only {} replicas of {} shards available for {}".format(n_replicas, n_shards, folder))
+
+        shards = [tuple(chosen[i * n_replicas:(i + 1) * n_replicas]) for i in range(n_shards)]
+
+        for shard in shards:
+            for bs in shard:
+                known_bs[bs] += 1
+                if bs in bs_load:
+                    bs_load[bs] = account_placement(bs_load[bs], dir_size // n_shards)
+                log(INFO, "BS with ip: {} and port: {} was chosen for backup".format(*bs))
+
+        dirs_location[(username, folder)] = tuple(shards)
+        persist(dirs_location, CS_DIRS_LOCATION_SAVEFILE)
+
+    # First replica of the first shard as in the original reply; all the
+    # shards, with all their replicas, at the end when there is more than one
+    reply = ["BKR", *shards[0][0], len(to_backup)]
+    for filename in to_backup:
+        reply += entry_fields(filename, *user_dict[filename], version)
+    if len(shards) > 1 or len(shards[0]) > 1:
+        reply.append(len(shards))
+        for shard in shards:
+            reply.append(len(shard))
+            reply += [field for bs in shard for field in bs]
+    return reply
+
+
+def backup_dirs(username, args, version, known_bs, bs_load, bs_health, password,
+                dirs_location, dirs_deleted, replication, stripe_width):
+    """ Backs up several folders at once (BCM/BMR)
+
+    args are the number of folders, then the arguments of a BCK for each.
+    The reply has, for each folder, the number of fields of its BKR reply
+    and those fields. The BSs of the folders already placed are asked for
+    their listings concurrently; new folders are placed one by one, so that
+    each placement sees the load of the previous ones.
+    """
+
+    width = 3 if version >= 2 else 4   # fields of a file entry
+    requests, i = [], 1
+    for _folder in range(int(args[0])):
+        n_files = int(args[i + 1])
+        requests.append(args[i:i + 2 + width * n_files])
+        i += 2 + width * n_files
+    log(INFO, ">> BCM {} folders".format(len(requests)))
+
+    def backup(request):
+        return backup_dir(username, request, version, known_bs, bs_load, bs_health, password,
+                          dirs_location, dirs_deleted, replication, stripe_width)
+
+    replies = [None] * len(requests)
+    placed = [j for j, request in enumerate(requests)
+              if dir_shards(dirs_location, username, request[0])]
+    if placed:
+        with ThreadPoolExecutor(max_workers=min(MAX_FANOUT, len(placed))) as executor:
+            for j, reply in zip(placed, executor.map(lambda j: backup(requests[j]), placed)):
+                replies[j] = reply
+    for j, request in enumerate(requests):
+        if replies[j] is None:
+            replies[j] = backup(request)
+
+    reply = ["BMR", len(requests)]
+    for folder_reply in replies:
+        reply += [len(folder_reply) - 1, *folder_reply[1:]]
+    return reply
 
 
 
 #check conditions of error
-def restore_dir(username, conn, dirs_location):
+def restore_dir(username, args, dirs_location, bs_health, bs_load):
 
-    flag = 0
-    folder = read_bytes_until(conn, "\n")
+    folder = args[0]
 
-    print("Restore {}".format(folder))
+    log(INFO, "Restore {}".format(folder))
 
-    if (username, folder) in dirs_location:
-        print("Entered")
-        flag = 1
-        ip_bs = dirs_location[(username, folder)][0]
-        port_bs = dirs_location[(username, folder)][1]
-        response = "RSR {} {}\n".format(ip_bs, port_bs)
-        print(response)
-        conn.sendall(response.encode())
+    # A replica may lack the folder (see query_shard_files), so replicas
+    # are only chosen among by their listings
+    shards = dir_shards(dirs_location, username, folder)
+    readers = [readable_replica(shard, bs_health, bs_load) if len(shard) == 1
+               else query_shard_files(shard, username, folder, bs_health, bs_load)[0]
+               for shard in shards]
 
-    if flag == 0:
-        print("RSR EOF")
-        response = "RSR EOF\n"
-        conn.sendall(response.encode())
+    if not readers or None in readers:
+        if shards:
+            log(WARNING, "No BS holding some shard of {} is available".format(folder))
+        log(INFO, "RSR EOF")
+        return ["RSR", "EOF"]
 
+    # One BS per shard; a folder that is not striped gets the usual reply
+    reply = ["RSR", *[field for bs in readers for field in bs]]
+    log(INFO, " ".join(reply))
+    return reply
 
-def list_user_dirs(username, conn, dirs_location):
 
-    print(">> LSD")
-    nr_files = 0
-    dirs_str = ""
+def list_user_dirs(username, dirs_location):
 
-    if dirs_location:
-        for (user, folder) in dict(dirs_location):
-            if user == username:
-                nr_files += 1
-                dirs_str += folder + " "
-                print(folder)
+    log(INFO, ">> LSD")
+    folders = list(user_dirs(dirs_location, username))
+    for folder in folders:
+        log(DEBUG, folder)
 
-    response = "LDR {} {}\n".format(str(nr_files), dirs_str)
-    print(response)
-    conn.sendall(response.encode())
+    reply = ["LDR", len(folders), *folders]
+    log(INFO, " ".join(str(field) for field in reply))
+    return reply
 
 
 
-def list_files_in_dir(username, conn, dirs_location):
+def describe_user_dirs(username, version, dirs_location, bs_health, bs_load):
+    """ Lists the folders of the user, with their files, bytes and last change (LDS/LDL)
 
-    flag = 0
-    folder = read_bytes_until(conn, " \n")
-    print(">> LSF {}".format(folder))
+    Every shard of every folder is listed by one of its replicas (see
+    query_shard_files), all the shards being asked at once (up to MAX_FANOUT), so that this takes about
+    the longest of their round trips rather than their sum. Each folder
+    comes as its number of files (NOK if some shard could not be listed)
+    and an entry like those of files: name, newest mtime and total bytes.
+    """
 
-    if (username, folder) in dirs_location:
-        flag = 1
-        ip_bs = dirs_location[(username, folder)][0]
-        port_bs = dirs_location[(username, folder)][1]
+    log(INFO, ">> LDS")
+    folders = user_dirs(dirs_location, username)
+    queries = [(folder, shard)
+               for folder, location in folders.items() for shard in as_shards(location)]
 
-        bs_socket = udp_client(ip_bs, int(port_bs))
-        bs_socket.sendall("LSF {} {}\n".format(username, folder).encode())
-        response = bs_socket.recv(2048).decode().split()
-        bs_socket.close()
+    def query(folder_shard):
+        folder, shard = folder_shard
+        return query_shard_files(shard, username, folder, bs_health, bs_load)[1]
+
+    listings = []
+    if queries:
+        with ThreadPoolExecutor(max_workers=min(MAX_FANOUT, len(queries))) as executor:
+            listings = list(executor.map(query, queries))
+
+    files = {folder: {} for folder in folders}  # {folder: merged listing, or None}
+    for (folder, _shard), listing in zip(queries, listings):
+        if listing is None or files[folder] is None:
+            files[folder] = None
+        else:
+            files[folder].update(listing)
+
+    reply = ["LDL", len(folders)]
+    for folder, listing in files.items():
+        if listing is None:
+            log(WARNING, "No replica of some shard of {} answered".format(folder))
+            reply += ["NOK", *entry_fields(folder, 0, 0, version)]
+        else:
+            newest = max((mtime for mtime, _size in listing.values()), default=0)
+            total = sum(size for _mtime, size in listing.values())
+            reply += [len(listing), *entry_fields(folder, newest, total, version)]
+    return reply
+
+
+def list_files_in_dir(username, args, version, offered, dirs_location, bs_health, bs_load):
+    """ Lists the files of a folder (LSF/LFD)
+
+    In version 2, if the client offered CHECKSUM (offered are the fields of
+    its VER), every file also has its digest.
+    """
+
+    folder, *as_of = args
+    as_of = as_of[0] if as_of else None
+    log(INFO, ">> LSF {} {}".format(folder, as_of or ""))
+    checksums = version >= 2 and offered is not None and CHECKSUM in offered
+
+    shards = dir_shards(dirs_location, username, folder)
+    readers, bs_dict = None, None
+    if shards:
+        readers, bs_dict = query_dir_files(shards, username, folder, bs_health, bs_load,
+                                           as_of, checksums)
+
+    if bs_dict is None:
+        if shards:
+            log(WARNING, "No replica of some shard of {} answered".format(folder))
+        return ["LFD", "NOK"]
+
+    reply = ["LFD", *readers[0], len(bs_dict)]
+    for filename, (mtime, size, *digest) in bs_dict.items():
+        reply += entry_fields(filename, mtime, size, version, *digest)
+    return reply
+
+
+
+def list_dir_snapshots(username, args, dirs_location, bs_health, bs_load):
+    """ Lists the snapshots of a folder (LSN/LNR)
+
+    Each BS snapshots its part of a striped folder on its own, so these
+    are the snapshots of any shard; restoring or listing as of one of them
+    gets, from each shard, its newest snapshot that is not newer.
+    """
+
+    folder = args[0]
+    log(INFO, ">> LSN {}".format(folder))
+
+    snapshots = set()
+    for shard in dir_shards(dirs_location, username, folder):
+        # The first replica with snapshots, as one may lack the folder
+        shard_snapshots = None
+        for bs in readable_replicas(shard, bs_health, bs_load):
+            bs_snapshots = query_bs_snapshots(bs, username, folder)
+            if bs_snapshots is not None:
+                shard_snapshots = bs_snapshots
+                if bs_snapshots:
+                    break
+        if shard_snapshots is None:
+            return ["LNR", "NOK"]
+        snapshots.update(shard_snapshots)
 
+    reply = ["LNR", len(snapshots), *sorted(snapshots)]
+    log(INFO, " ".join(str(field) for field in reply))
+    return reply
 
-        if response[0] != "LFD":
-            print("Error in command\n")
-            exit(0)
 
 
-        nr_bs_files = int(response[1])
-        conn.sendall("LFD {} {} {}".format(ip_bs, port_bs, nr_bs_files).encode())
+def delete_dir(username, args, dirs_location, dirs_deleted, bs_health):
+    """ Deletes a folder of the user from its BSs (DEL/DDR)
 
-        for i in range(nr_bs_files):
-            filename = response[2 + 4*i]
-            date = response[2 + 4*i + 1]
-            time = response[2 + 4*i + 2]
-            size = response[2 + 4*i + 3]
-            conn.sendall(" {} {} {} {}".format(filename, date, time, size).encode())
+    The folder is gone once a BS deleted its copy. The BSs that are dead or
+    did not answer are recorded in dirs_deleted, and asked again when they
+    come back (see purge_deleted).
+    """
 
-        conn.sendall("\n".encode())
+    log(INFO, ">> DEL")
 
-    if flag == 0:
-        response = "LFD NOK\n"
-        conn.sendall(response.encode())
+    status_del = "NOK"
+    folder = args[0]
+    left_behind = []
+
+    shards = dir_shards(dirs_location, username, folder)
+    if not shards:
+        log(INFO, "No such folder for the user {}".format(username))
+
+    for bs in [bs for shard in shards for bs in shard]:
+        if bs_state(bs_health, bs) == "dead":
+            log(WARNING, "BS {} {} is dead, its copy of {} is left behind".format(*bs, folder))
+            left_behind.append(bs)
+            continue
+
+        status = remove_from_bs(bs, username, folder)
+        if status == "ERR":
+            return ["ERR"]
+        elif status == "OK":
+            status_del = "OK"
+        elif status is None:
+            left_behind.append(bs)
+
+    if status_del == "OK":
+        if left_behind:
+            earlier = dirs_deleted.get((username, folder), ())
+            dirs_deleted[(username, folder)] = tuple(earlier) + tuple(
+                bs for bs in left_behind if bs not in earlier)
+            persist(dirs_deleted, CS_DIRS_DELETED_SAVEFILE)
+        del dirs_location[(username, folder)]
+        persist(dirs_location, CS_DIRS_LOCATION_SAVEFILE)
+        log(INFO, "Directory {} was sucessfully deleted".format(folder))
+
+    return ["DDR", status_del]
+
+
+def purge_deleted(dirs_deleted, dirs_location, bs_health):
+    """ Purger process function / program
+
+    Every PURGE_INTERVAL seconds, asks again the BSs left behind by
+    delete_dir to delete their copies of the folders, once they are not
+    dead. A BS is forgotten once it answers, whatever the status (NOK or
+    ERR if it has no copy, e.g. deleted just before it stopped answering).
+    """
 
+    def signal_handler(_signum, _frame):
+        exit(0)
 
 
-def delete_dir(username, conn, dirs_location):
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, signal_handler)
 
-    print(">> DEL")
+    while True:
+        sleep(PURGE_INTERVAL)
+
+        for (username, folder), left_behind in dirs_deleted.copy().items():
+            done = set()
+            for bs in left_behind:
+                if bs_state(bs_health, bs) == "dead":
+                    continue
+                # A copy backed up since then is not a leftover
+                if any(bs in shard for shard in dir_shards(dirs_location, username, folder)):
+                    done.add(bs)
+                elif remove_from_bs(bs, username, folder) is not None:
+                    log(INFO, "Copy of {} of {} left in BS {} {} deleted".format(folder, username, *bs))
+                    done.add(bs)
+
+            if done:
+                # It may have been deleted again, meanwhile
+                left = tuple(bs for bs in dirs_deleted.get((username, folder), ()) if bs not in done)
+                if left:
+                    dirs_deleted[(username, folder)] = left
+                else:
+                    dirs_deleted.pop((username, folder), None)
+                persist(dirs_deleted, CS_DIRS_DELETED_SAVEFILE)
 
-    status_del = "NOK"
-    flag = 0
-    folder = read_bytes_until(conn, " \n")
 
-    if (username, folder) in dirs_location:
-        flag = 1
-        ip_bs = dirs_location[(username, folder)][0]
-        port_bs = dirs_location[(username, folder)][1]
+def remove_from_bs(bs, username, folder):
+    """ Deletes the copy of the user's folder in a BS (DLB/DBR)
+
+    Returns the status of the reply, "ERR" if malformed, None if the BS did
+    not answer.
+    """
 
-        bs_socket = udp_client(ip_bs, int(port_bs))
-        bs_socket.sendall("DLB {} {}\n".format(username, folder).encode())
-        command, status = bs_socket.recv(8).decode().split(" ")
+    bs_socket = udp_client(bs[0], int(bs[1]))
+    try:
+        with timed("BS_DLB"):
+            bs_socket.sendall("DLB {} {}\n".format(username, folder).encode())
+            reply = bs_socket.recv(8)
+        command, status = reply.decode()[:-1].split(" ")
+    except (socket.timeout, ConnectionError, ValueError):
+        log(WARNING, "BS {} {} did not answer DLB".format(*bs))
+        return None
+    finally:
         bs_socket.close()
 
-        if command != "DBR":
-            print("Error in protocol\n")
-            conn.sendall("ERR\n".encode())
-        else:
-            if status == "NOK":
-                print("No such folder exists in the chosen BS\n")
-            else:
-                status_del = "OK"
-                del dirs_location[(username, folder)]
-                backup_dict_to_file(dirs_location, CS_DIRS_LOCATION_SAVEFILE)
-                print("Directory {} was sucessfully deleted\n".format(folder))
-            response = "DDR {}\n".format(status_del)
-            conn.sendall(response.encode())
+    if command != "DBR":
+        log(ERROR, "Malformed DLB reply from BS {} {}".format(*bs))
+        return "ERR"
+    elif status == "NOK":
+        log(INFO, "No such folder exists in BS {} {}".format(*bs))
+    return status
 
-    if flag == 0:
-        print("No such folder for the user {}\n".format(username))
-        response = "DDR {}\n".format(status_del)
-        conn.sendall(response.encode())
 
 
+def rebalance(valid_users, dirs_location, dirs_deleted, known_bs, bs_load, bs_health, cluster,
+              budget):
+    """ Rebalancer process function / program
 
+    Every REBALANCE_INTERVAL seconds, while the disks of the alive BSs are
+    unevenly used (see plan_rebalance), moves folders from the BS whose
+    disk is the fullest to the emptiest one, one at a time, at most at
+    budget bytes/s. Each move is of the largest of some folders of the
+    fullest BS that does not overshoot. In a cluster, every node moves
+    folders of its own users, and only its share of the bytes.
+    """
 
+    def signal_handler(_signum, _frame):
+        exit(0)
 
-def main():
 
-    manager = SyncManager()
-    manager.start(ignore_sigint)
-    known_bs = manager.dict()        # {("ip_BS", "port_BS"): counter}
-    valid_users = manager.dict()     # {"user": password}
-    dirs_location = manager.dict()   # {(username, "folder"): (ipBS, portBS)}
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, signal_handler)
+
+    failed = set()      # (user, folder, BS) moves that failed, not tried again
+    while True:
+        sleep(REBALANCE_INTERVAL)
+
+        loads = {bs: tuple(load) for bs, load in bs_load.copy().items()
+                 if bs in known_bs and bs_state(bs_health, bs) == "alive"}
+        while True:
+            plan = plan_rebalance(loads)
+            if plan is None:
+                break
+            src, dst, nbytes = plan
+            if cluster is not None:
+                nbytes //= len(cluster[1])
+
+            move = pick_folder(dirs_location, dirs_deleted, cluster, src, dst, nbytes, failed)
+            if move is None:
+                break
+            username, folder, size = move
+            if not migrate_dir(username, folder, src, dst, valid_users.get(username),
+                               dirs_location, budget):
+                failed.add((username, folder, dst))
+                break
+
+            # Until their next reports
+            loads[src], loads[dst] = account_move(loads[src], -size), account_move(loads[dst], size)
+
+
+def pick_folder(dirs_location, dirs_deleted, cluster, src, dst, nbytes, failed):
+    """ Returns (user, folder, bytes) of the folder to move from src to dst
+
+    That is the largest of up to REBALANCE_CANDIDATES folders with a copy
+    in src (and none in dst, not even a deleted one) of at most nbytes, or
+    None.
+    """
+
+    deleted = dirs_deleted.copy()
+    candidates = [key for key, shards in dirs_location.copy().items()
+                  if owns(cluster, key[0]) and (*key, dst) not in failed
+                  and any(src in shard for shard in shards)
+                  and not any(dst in shard for shard in shards)
+                  and dst not in deleted.get(key, ())]
+
+    best = None
+    for username, folder in sample(candidates, min(len(candidates), REBALANCE_CANDIDATES)):
+        bs_dict = query_bs_files(src, username, folder)
+        if bs_dict is None:
+            continue
+        size = sum(size for _mtime, size in bs_dict.values())
+        if size <= nbytes and (best is None or size > best[2]):
+            best = (username, folder, size)
+    return best
+
+
+def migrate_dir(username, folder, src, dst, password, dirs_location, budget):
+    """ Moves the copy of the user's folder in BS src to BS dst (MIG/MGR)
+
+    src copies the folder straight to dst (see BS.migrate_folder), at most
+    at budget bytes/s. Then its location is switched, in a single write,
+    unless the folder was deleted meanwhile, and the copy in src deleted.
+    Returns True if the folder moved.
+    """
+
+    log(INFO, "Moving {} of {} from BS {} {} to BS {} {}".format(folder, username, *src, *dst))
+    if password is None or not register_user_in_bs(dst, username, password):
+        return False
+    remove_from_bs(dst, username, folder) # leftovers of an earlier failed move
 
-    my_address = get_best_ip()
+    status = "ERR"
+    try:
+        bs_socket = tcp_client(src[0], int(src[1]))
+        try:
+            with timed("BS_MIG"):
+                first, reply = offer_version(bs_socket, ["AUT", username, password])
+                if reply == ["AUR", "OK"]:
+                    version = negotiated(first)
+                    send_message(bs_socket, version, ["MIG", folder, dst[0], dst[1], budget])
+                    bs_socket.settimeout(MIGRATION_TIMEOUT)
+                    reply = read_reply(bs_socket, version)
+                    if reply[0] == "MGR" and len(reply) == 2:
+                        status = reply[1]
+        finally:
+            bs_socket.close()
+    except (socket.timeout, OSError) as error:
+        log(WARNING, "BS {} {} could not move {}: {}".format(*src, folder, error))
+
+    shards = dir_shards(dirs_location, username, folder)
+    if status != "OK" or not any(src in shard for shard in shards):
+        log(WARNING, "{} of {} not moved to BS {} {} [MGR {}]".format(folder, username, *dst, status))
+        remove_from_bs(dst, username, folder)
+        return False
+
+    dirs_location[(username, folder)] = tuple(tuple(dst if bs == src else bs for bs in shard)
+                                              for shard in shards)
+    persist(dirs_location, CS_DIRS_LOCATION_SAVEFILE)
+    remove_from_bs(src, username, folder)
+    count("migrated")
+    log(INFO, "{} of {} moved to BS {} {}".format(folder, username, *dst))
+    return True
+
+
+
+
+
+
+def main():
+
+    my_address = None                # address to listen on, looked up if not given
     my_port = DEFAULT_CS_PORT
+    replication = 1                  # number of BSs holding each directory
+    stripe_width = 1                 # number of shards of large directories
+    metrics_port = None              # HTTP port of the Prometheus endpoint
+    log_levels = (INFO, {})          # minimum log level and sampling
+    log_json = False                 # log records as JSON objects
+    max_sessions = MAX_SESSIONS      # sessions served at once, 0 for no limit
+    ip_rate = 0                      # new sessions/s allowed per source IP, 0 for no limit
+    backlog = 128                    # connections waiting to be accepted, at most
+    metadata_db = None               # SQLite database of the metadata, instead of pickles
+    nodes = None                     # all the nodes of the cluster, if in one
+    budget = 0                       # bytes/s of folders moved among BSs, 0 for no rebalancing
 
 
     try:
-        a = getopt.getopt(sys.argv[1:], "p:")[0]
+        a = getopt.getopt(sys.argv[1:], "a:p:r:s:m:l:jc:i:q:d:n:b:")[0]
     except getopt.GetoptError as error:
         print(error)
         exit(2)
 
     for opt, arg in a:
-        if opt == '-p':
+        if opt == '-a':
+            my_address = arg
+        elif opt == '-p':
             my_port = int(arg)
+        elif opt == '-r':
+            replication = int(arg)
+        elif opt == '-s':
+            stripe_width = int(arg)
+        elif opt == '-m':
+            metrics_port = int(arg)
+        elif opt == '-l':
+            try:
+                log_levels = parse_levels(arg)
+            except ValueError as error:
+                print(error)
+                exit(2)
+        elif opt == '-j':
+            log_json = True
+        elif opt == '-c':
+            max_sessions = int(arg)
+        elif opt == '-i':
+            ip_rate = float(arg)
+        elif opt == '-q':
+            backlog = int(arg)
+        elif opt == '-d':
+            metadata_db = arg
+        elif opt == '-n':
+            try:
+                nodes = parse_nodes(arg)
+            except ValueError:
+                print("Nodes must be given as ip:port,ip:port,...")
+                exit(2)
+        elif opt == '-b':
+            budget = parse_rate(arg)
 
 
 
+    if my_address is None:
+        my_address = get_best_ip()
     print("My address is {}\n".format(my_address))
 
+    cluster = None                   # (this node, nodes)
+    if nodes is not None:
+        if (my_address, my_port) not in nodes:
+            print("{}:{} is not one of the nodes".format(my_address, my_port))
+            exit(2)
+        cluster = ((my_address, my_port), nodes)
+
     udp_receiver = udp_server(my_address, my_port)
-    tcp_receiver = tcp_server(my_address, my_port)
+    tcp_receiver = tcp_server(my_address, my_port, backlog=backlog)
+
+    # Only once the sockets are bound, so a failed start leaves nothing behind
+    manager = SyncManager()
+    manager.start(ignore_sigint)
+    bs_load = manager.dict()         # {("ip_BS", "port_BS"): (free, total, active, throughput)}
+    bs_health = manager.dict()       # {("ip_BS", "port_BS"): (last_seen, "alive"/"suspect"/"dead")}
+    init_metrics("cs", TCP_COMMANDS + UDP_COMMANDS + BS_QUERIES + ("ERR",), COUNTERS)
+    init_logging(*log_levels, log_json)
+
+
+    if metadata_db:
+        # Nothing to load; the pickle files of an earlier run are imported once
+        tables = open_metadata(metadata_db)
+        known_bs, valid_users, dirs_location = tables["bs"], tables["users"], tables["dirs"]
+        dirs_deleted = tables["deleted"]
+        for table, savefile, convert in ((known_bs, CS_KNOWN_BS_SAVEFILE, int),
+                                         (valid_users, CS_VALID_USERS_SAVEFILE, str),
+                                         (dirs_location, CS_DIRS_LOCATION_SAVEFILE, as_shards),
+                                         (dirs_deleted, CS_DIRS_DELETED_SAVEFILE, tuple)):
+            migrated = migrate_pickle(table, savefile, convert)
+            if migrated:
+                print("Migrated {} entries of {} to {}".format(migrated, savefile, metadata_db))
 
+    else:
+        known_bs = manager.dict()        # {("ip_BS", "port_BS"): counter}
+        valid_users = manager.dict()     # {"user": password}
+        dirs_location = manager.dict()   # {(username, "folder"): (((ipBS, portBS), ...), ...)}
+        dirs_deleted = manager.dict()    # {(username, "folder"): ((ipBS, portBS), ...)} yet to delete it
+
+        if os.path.isfile(CS_KNOWN_BS_SAVEFILE):
+            known_bs.update(restore_dict_from_file(CS_KNOWN_BS_SAVEFILE))
 
-    if os.path.isfile(CS_KNOWN_BS_SAVEFILE):
-        known_bs.update(restore_dict_from_file(CS_KNOWN_BS_SAVEFILE))
+        if os.path.isfile(CS_VALID_USERS_SAVEFILE):
+            valid_users.update(restore_dict_from_file(CS_VALID_USERS_SAVEFILE))
 
-    if os.path.isfile(CS_VALID_USERS_SAVEFILE):
-        valid_users.update(restore_dict_from_file(CS_VALID_USERS_SAVEFILE))
+        if os.path.isfile(CS_DIRS_LOCATION_SAVEFILE):
+            locations = restore_dict_from_file(CS_DIRS_LOCATION_SAVEFILE)
+            dirs_location.update({key: as_shards(location) for key, location in locations.items()})
 
-    if os.path.isfile(CS_DIRS_LOCATION_SAVEFILE):
-        dirs_location.update(restore_dict_from_file(CS_DIRS_LOCATION_SAVEFILE))
+        if os.path.isfile(CS_DIRS_DELETED_SAVEFILE):
+            dirs_deleted.update(restore_dict_from_file(CS_DIRS_DELETED_SAVEFILE))
 
 
+    p_metrics = p_rebalance = None
     try:
         # "Forking"
-        p_udp = Process(target=deal_with_udp, args=(udp_receiver, known_bs))
-        p_tcp = Process(target=deal_with_tcp, args=(tcp_receiver, valid_users, dirs_location, known_bs))
+        p_udp = Process(target=deal_with_udp,
+                        args=(udp_receiver, known_bs, bs_load, bs_health, cluster))
+        p_tcp = Process(target=deal_with_tcp,
+                        args=(tcp_receiver, valid_users, dirs_location, dirs_deleted, known_bs,
+                              bs_load, bs_health, replication, stripe_width, max_sessions,
+                              ip_rate, cluster))
+        p_purge = Process(target=purge_deleted, args=(dirs_deleted, dirs_location, bs_health))
         p_udp.start()
         p_tcp.start()
+        p_purge.start()
+
+        if budget:
+            p_rebalance = Process(target=rebalance,
+                                  args=(valid_users, dirs_location, dirs_deleted, known_bs,
+                                        bs_load, bs_health, cluster, budget))
+            p_rebalance.start()
+
+        if metrics_port is not None:
+            p_metrics = Process(target=serve_metrics,
+                                args=(tcp_server(my_address, metrics_port),))
+            p_metrics.start()
 
         pause()
     except KeyboardInterrupt:
@@ -484,13 +1437,23 @@ def main():
         udp_receiver.close()
         p_tcp.terminate()
         p_udp.terminate()
+        p_purge.terminate()
         p_tcp.join()
         p_udp.join()
-
-        backup_dict_to_file(known_bs, CS_KNOWN_BS_SAVEFILE)
-        backup_dict_to_file(valid_users, CS_VALID_USERS_SAVEFILE)
-        backup_dict_to_file(dirs_location, CS_DIRS_LOCATION_SAVEFILE)
-
+        p_purge.join()
+        if p_metrics is not None:
+            p_metrics.terminate()
+            p_metrics.join()
+        if p_rebalance is not None:
+            p_rebalance.terminate()
+            p_rebalance.join()
+
+        persist(known_bs, CS_KNOWN_BS_SAVEFILE)
+        persist(valid_users, CS_VALID_USERS_SAVEFILE)
+        persist(dirs_location, CS_DIRS_LOCATION_SAVEFILE)
+        persist(dirs_deleted, CS_DIRS_DELETED_SAVEFILE)
+
+        stop_logging()
         print()
 
 
@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" End-to-end benchmark over a local cluster.
+
+    Starts a CS (or a cluster of n_cs CS nodes) and n_bs BSs on this
+    machine (free ports, each in a temp directory of its own), and
+    n_clients simulated users, each a process
+    calling the functions of user.py over a synthetic corpus of its own,
+    with a weighted mix of commands, for some seconds. In a cluster, the
+    BSs and the users are spread over the nodes (so most users start their
+    sessions with a node that does not own them). Before each backup a
+    few files of the directory are rewritten, so that there is something
+    to upload.
+
+    Reports throughput and p50/p99 latency per command, CPU seconds and
+    peak RSS of the CS, of each BS and of the clients (with the processes
+    they fork; RSS is summed, so shared pages count once per process), and
+    the bytes that went through the loopback interface.
+
+    Usage (from the project root):
+        python3 -m bench.cluster [-b n_bs] [-c n_clients] [-t seconds]
+                                 [-m mix] [-d n_dirs] [-f n_files]
+                                 [-s file_size] [-x bs_args] [-n n_cs] [-j]
+
+    mix is a list of command=weight, e.g. backup=4,restore=2,filelist=2,
+    dirlist=1,delete=1; the commands are the ones of the user application
+    (dirlist-l for "dirlist -l", backup-all for a backup of all the
+    directories at once).
+"""
+
+import os
+import sys
+import json
+import socket
+import signal
+import subprocess
+from sys import argv
+from getopt import getopt, GetoptError
+from shutil import rmtree
+from random import Random
+from tempfile import mkdtemp
+from time import monotonic, sleep
+from multiprocessing import Process, Queue
+from lib.utils import get_best_ip
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_MIX = "backup=4,restore=2,filelist=2,dirlist=1,delete=1"
+CHURN_FILES = 2         # files rewritten before each backup
+SAMPLE_INTERVAL = 0.25  # seconds between /proc samples
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def free_port(host):
+    """ A port free for both TCP and UDP on host """
+
+    while True:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as tcp_sock:
+            tcp_sock.bind((host, 0))
+            port = tcp_sock.getsockname()[1]
+            try:
+                with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp_sock:
+                    udp_sock.bind((host, port))
+                return port
+            except OSError:
+                continue
+
+
+def wait_for_port(host, port, limit=10):
+    """ Waits until something accepts TCP connections on host:port """
+
+    deadline = monotonic() + limit
+    while monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            sleep(0.05)
+    raise RuntimeError("Nothing listening on {}:{}".format(host, port))
+
+
+def start_server(program, args, workdir):
+    """ Starts CS.py or BS.py in workdir, in a session of its own """
+
+    return subprocess.Popen([sys.executable, os.path.join(ROOT, program)] + args,
+                            cwd=workdir, stdin=subprocess.DEVNULL,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                            start_new_session=True)
+
+
+def stop_server(server):
+    """ CTRL-C (so that BSs unregister), then kills whatever is left """
+
+    try:
+        os.killpg(server.pid, signal.SIGINT)
+        server.wait(timeout=5)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        pass
+    try:
+        os.killpg(server.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    server.wait()
+
+
+def make_corpus(workdir, n_dirs, n_files, file_size, rnd):
+    """ Creates n_dirs directories of n_files files (some in subfolders) """
+
+    for i in range(n_dirs):
+        for j in range(n_files):
+            subdir = "sub{}".format(j % 3) if j % 2 else ""
+            path = os.path.join(workdir, "dir{}".format(i), subdir, "file{}".format(j))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as corpus_file:
+                corpus_file.write(rnd.randbytes(file_size))
+
+
+def parse_mix(mix):
+    """ "backup=4,restore=1" -> {"backup": 4, "restore": 1} """
+    return {command: int(weight) for command, weight in
+            (item.split("=") for item in mix.split(","))}
+
+
+def run_client(i, host, cs_port, workdir, mix, duration, n_dirs, n_files, file_size,
+               results):
+    """ Simulated user process: commands of mix, for duration seconds """
+
+    os.chdir(workdir)
+    sys.stdout = open(os.devnull, "w")
+    import user # from ROOT, with workdir as the current directory
+
+    rnd = Random(i)
+    make_corpus(workdir, n_dirs, n_files, file_size, rnd)
+    commands, weights = zip(*mix.items())
+    latencies = {command: [] for command in ("login",) + commands}
+    errors = {command: 0 for command in latencies}
+
+    username, password = "{:05d}".format(10000 + i), "pass{:04d}".format(i)
+    start = monotonic()
+    user.login_user([username, password], host, cs_port)
+    latencies["login"].append(monotonic() - start)
+
+    deadline = monotonic() + duration
+    while monotonic() < deadline:
+        command = rnd.choices(commands, weights)[0]
+        directory = "dir{}".format(rnd.randrange(n_dirs))
+
+        churned = {"backup": [directory],
+                   "backup-all": ["dir{}".format(d) for d in range(n_dirs)]}.get(command, [])
+        for churn_dir in churned:
+            for _i in range(CHURN_FILES):
+                name = "file{}".format(rnd.randrange(n_files))
+                with open(os.path.join(churn_dir, name), "wb") as corpus_file:
+                    corpus_file.write(rnd.randbytes(file_size))
+
+        start = monotonic()
+        try:
+            if command == "login":
+                user.login_user([username, password], host, cs_port)
+            elif command == "backup":
+                if user.backup_dir([directory], host, cs_port, username, password) is None:
+                    errors[command] += 1
+            elif command == "backup-all":
+                done = user.backup_dirs(churned, host, cs_port, username, password)
+                if done is None or None in done.values():
+                    errors[command] += 1
+            elif command == "restore":
+                user.restore_dir([directory], host, cs_port, username, password)
+            elif command == "filelist":
+                user.filelist_dir([directory], host, cs_port, username, password)
+            elif command == "dirlist":
+                user.list_dir([], host, cs_port, username, password)
+            elif command == "dirlist-l":
+                user.list_dir(["-l"], host, cs_port, username, password)
+            elif command == "delete":
+                user.delete_dir([directory], host, cs_port, username, password)
+        except (OSError, ValueError):
+            errors[command] += 1
+        latencies[command].append(monotonic() - start)
+
+    results.put((latencies, errors))
+
+
+def process_tree(root_pid):
+    """ Pids of root_pid and of all its descendants """
+
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open("/proc/{}/stat".format(entry)) as stat_file:
+                    ppid = int(stat_file.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+
+    pids, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack.extend(children.get(pid, []))
+    return pids
+
+
+def process_usage(pid):
+    """ (cpu seconds, rss bytes) of a process, or None if it is gone """
+
+    try:
+        with open("/proc/{}/stat".format(pid)) as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    # utime, stime, cutime, cstime and rss, counted from the state field
+    cpu = sum(int(value) for value in fields[11:15]) / CLOCK_TICKS
+    return cpu, int(fields[21]) * PAGE_SIZE
+
+
+def loopback_bytes():
+    """ Bytes received through the loopback interface so far """
+
+    with open("/proc/net/dev") as dev_file:
+        for line in dev_file:
+            name, _sep, counters = line.partition(":")
+            if name.strip() == "lo":
+                return int(counters.split()[0])
+    return 0
+
+
+def sample_groups(groups, cpu_seen, rss_peak):
+    """ Samples the CPU and RSS of each group of process trees """
+
+    for group, roots in groups.items():
+        rss = 0
+        for root in roots:
+            for pid in process_tree(root):
+                usage = process_usage(pid)
+                if usage is not None:
+                    cpu_seen[(group, pid)] = usage[0]
+                    rss += usage[1]
+        rss_peak[group] = max(rss_peak.get(group, 0), rss)
+
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile of values """
+
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def main():
+    n_bs, n_clients, duration, n_cs = 2, 4, 10, 1
+    mix, n_dirs, n_files, file_size = DEFAULT_MIX, 3, 20, 4096
+    bs_args, as_json = [], False
+
+    try:
+        options = getopt(argv[1:], "b:c:t:m:d:f:s:x:n:j")[0]
+    except GetoptError as error:
+        print(error)
+        exit(2)
+
+    for opt, arg in options:
+        if opt == '-b':
+            n_bs = int(arg)
+        elif opt == '-c':
+            n_clients = int(arg)
+        elif opt == '-t':
+            duration = float(arg)
+        elif opt == '-m':
+            mix = arg
+        elif opt == '-d':
+            n_dirs = int(arg)
+        elif opt == '-f':
+            n_files = int(arg)
+        elif opt == '-s':
+            file_size = int(arg)
+        elif opt == '-x':
+            bs_args = arg.split()
+        elif opt == '-n':
+            n_cs = int(arg)
+        elif opt == '-j':
+            as_json = True
+
+    mix = parse_mix(mix)
+    host = get_best_ip()    # where CS.py and BS.py listen
+    basedir = mkdtemp(prefix="bs_cluster.")
+    servers = {}
+    clients = []
+
+    try:
+        cs_ports = []
+        while len(cs_ports) < n_cs:
+            port = free_port(host)
+            if port not in cs_ports:
+                cs_ports.append(port)
+        nodes = ",".join("{}:{}".format(host, port) for port in cs_ports)
+        for i, cs_port in enumerate(cs_ports):
+            name = "cs{}".format(i) if n_cs > 1 else "cs"
+            os.mkdir(os.path.join(basedir, name))
+            servers[name] = start_server("CS.py", ["-p", str(cs_port)]
+                                         + (["-n", nodes] if n_cs > 1 else []),
+                                         os.path.join(basedir, name))
+        for cs_port in cs_ports:
+            wait_for_port(host, cs_port)
+
+        for i in range(n_bs):
+            bs_port = free_port(host)
+            workdir = os.path.join(basedir, "bs{}".format(i))
+            os.mkdir(workdir)
+            servers["bs{}".format(i)] = start_server(
+                "BS.py", ["-n", host, "-p", str(cs_ports[i % n_cs]), "-b", str(bs_port)] + bs_args,
+                workdir)
+            wait_for_port(host, bs_port)
+        sleep(0.5) # registrations
+
+        results = Queue()
+        sys.path.insert(0, ROOT)
+        for i in range(n_clients):
+            workdir = os.path.join(basedir, "user{}".format(i))
+            os.mkdir(workdir)
+            clients.append(Process(target=run_client,
+                                   args=(i, host, cs_ports[i % n_cs], workdir, mix, duration,
+                                         n_dirs, n_files, file_size, results)))
+
+        groups = {name: [server.pid] for name, server in servers.items()}
+        groups["clients"] = []
+        cpu_seen, rss_peak = {}, {}
+        lo_start = loopback_bytes()
+        start = monotonic()
+
+        for client in clients:
+            client.start()
+            groups["clients"].append(client.pid)
+
+        collected = []
+        while len(collected) < n_clients:
+            sample_groups(groups, cpu_seen, rss_peak)
+            while not results.empty():
+                collected.append(results.get())
+            sleep(SAMPLE_INTERVAL)
+        elapsed = monotonic() - start
+        lo_bytes = loopback_bytes() - lo_start
+
+        for client in clients:
+            client.join()
+
+    finally:
+        for client in clients:
+            if client.is_alive():
+                client.terminate()
+        for name in sorted(servers, reverse=True): # BSs before the CS
+            stop_server(servers[name])
+        rmtree(basedir, ignore_errors=True)
+
+    commands = {}
+    for command in ["login"] + list(mix):
+        latencies = [value for client_latencies, _errors in collected
+                     for value in client_latencies.get(command, [])]
+        if not latencies:
+            continue
+        commands[command] = {
+            "ops": len(latencies),
+            "errors": sum(errors.get(command, 0) for _latencies, errors in collected),
+            "ops_per_second": round(len(latencies) / elapsed, 2),
+            "p50_ms": round(1000 * percentile(latencies, 0.5), 2),
+            "p99_ms": round(1000 * percentile(latencies, 0.99), 2),
+        }
+
+    processes = {}
+    for group in groups:
+        processes[group] = {
+            "cpu_seconds": round(sum(cpu for (name, _pid), cpu in cpu_seen.items()
+                                     if name == group), 2),
+            "peak_rss_mib": round(rss_peak.get(group, 0) / 2**20, 1),
+        }
+
+    report = {
+        "config": {"n_bs": n_bs, "n_clients": n_clients, "seconds": duration,
+                   "mix": mix, "n_dirs": n_dirs, "n_files": n_files,
+                   "file_size": file_size, "bs_args": bs_args},
+        "elapsed_seconds": round(elapsed, 2),
+        "ops_per_second": round(sum(c["ops"] for c in commands.values()) / elapsed, 2),
+        "commands": commands,
+        "processes": processes,
+        "loopback_bytes": lo_bytes,
+    }
+
+    if as_json:
+        print(json.dumps(report, indent=2))
+        return
+
+    print("{} BSs, {} clients, {:.1f} s, {:.1f} ops/s, {:.1f} MiB on loopback\n".format(
+        n_bs, n_clients, elapsed, report["ops_per_second"], lo_bytes / 2**20))
+    print("{:<10} {:>8} {:>8} {:>10} {:>10} {:>10}".format(
+        "command", "ops", "errors", "ops/s", "p50 ms", "p99 ms"))
+    for command, stats in commands.items():
+        print("{:<10} {:>8} {:>8} {:>10} {:>10} {:>10}".format(
+            command, stats["ops"], stats["errors"], stats["ops_per_second"],
+            stats["p50_ms"], stats["p99_ms"]))
+    print("\n{:<10} {:>12} {:>14}".format("process", "cpu s", "peak rss MiB"))
+    for group, usage in processes.items():
+        print("{:<10} {:>12} {:>14}".format(group, usage["cpu_seconds"], usage["peak_rss_mib"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Durability benchmark of the Backup Server storage.
+
+    Stores the same batch of small files, as one UPL session would, with
+    each storage engine and durability level, and reports files/s. Run it
+    on the filesystem the BS will use (-t), as fsync costs nothing on tmpfs.
+
+    Usage (from the project root):
+        python3 -m bench.durability [-n n_files] [-s file_size] [-t dir] [-j]
+"""
+
+import os
+import json
+from sys import argv
+from getopt import getopt, GetoptError
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import monotonic, time
+from lib.storage import (DURABILITY_LEVELS, write_temp, commit_due, commit_files,
+                         update_index)
+from lib.packfile import open_segment, close_segment, append
+
+
+def store_session(dirpath, n_files, data, engine, durability):
+    """ Stores n_files files of content data like BS.backup_user_files """
+
+    received = {}
+    segment_fd = None
+    pending = []
+    last_commit = monotonic()
+    mtime = int(time())
+
+    for i in range(n_files):
+        filename = "file{}".format(i)
+        if engine == "pack":
+            if segment_fd is None:
+                segment_fd, segment = open_segment(dirpath)
+            offset = append(segment_fd, data)
+            received[filename] = (mtime, len(data), segment, offset)
+        else:
+            written = write_temp(dirpath, [data], len(data), mtime)
+            pending.append((*written, os.path.join(dirpath, filename)))
+            received[filename] = (mtime, len(data))
+
+        if commit_due(durability, len(pending), last_commit):
+            commit_files(dirpath, pending, segment_fd, durability)
+            last_commit = monotonic()
+
+    commit_files(dirpath, pending, segment_fd, durability)
+    update_index(dirpath, received, durable=(durability != "none"))
+    if segment_fd is not None:
+        close_segment(segment_fd)
+
+
+def main():
+    n_files, file_size, base_dir, as_json = 2000, 4096, None, False
+
+    try:
+        options = getopt(argv[1:], "n:s:t:j")[0]
+    except GetoptError as error:
+        print(error)
+        exit(2)
+
+    for opt, arg in options:
+        if opt == '-n':
+            n_files = int(arg)
+        elif opt == '-s':
+            file_size = int(arg)
+        elif opt == '-t':
+            base_dir = arg
+        elif opt == '-j':
+            as_json = True
+
+    data = os.urandom(file_size)
+    results = {"n_files": n_files, "file_size": file_size, "files_per_second": {}}
+
+    for engine in ("loose", "pack"):
+        for durability in DURABILITY_LEVELS:
+            dirpath = mkdtemp(prefix="bs_durability.", dir=base_dir)
+            try:
+                start = monotonic()
+                store_session(dirpath, n_files, data, engine, durability)
+                elapsed = monotonic() - start
+            finally:
+                rmtree(dirpath)
+            results["files_per_second"]["{}/{}".format(engine, durability)] = \
+                round(n_files / elapsed, 1)
+
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("{} files of {} bytes\n".format(n_files, file_size))
+    print("{:<16} {:>12}".format("", "files/s"))
+    for key, rate in results["files_per_second"].items():
+        print("{:<16} {:>12}".format(key, rate))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Goodput of the Central Server under overload.
+
+    Starts a CS on this machine and floods it with sessions (login and
+    dirlist, no BS involved) from n_clients processes of n_threads threads
+    each, for some seconds: once with no admission control (-c 0), once
+    with the given CS options (admission control on). Clients are those of
+    user.py, so refused sessions are retried with its backoff.
+
+    Reports, for each run, the sessions completed per second within those
+    seconds (goodput), those that failed (timeouts, resets) or gave up while the CS stayed
+    busy, the p50/p99 time to complete a session (backoff included), and
+    the sessions the CS refused.
+
+    Usage (from the project root):
+        python3 -m bench.overload [-c n_clients] [-w n_threads] [-t seconds]
+                                  [-x cs_args] [-j]
+"""
+
+import os
+import sys
+import json
+import socket
+from sys import argv
+from getopt import getopt, GetoptError
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import monotonic
+from threading import Thread
+from multiprocessing import Process, Queue
+from bench.cluster import (ROOT, free_port, wait_for_port, start_server, stop_server,
+                           percentile)
+from lib.utils import get_best_ip
+from lib.protocol import request
+
+
+def run_client(i, host, cs_port, n_threads, duration, results):
+    """ Client process: n_threads threads opening sessions back to back """
+
+    sys.stdout = open(os.devnull, "w")
+    sys.path.insert(0, ROOT)
+    import user
+
+    per_thread = []     # (outcomes, latencies) of each thread
+
+    def sessions(j):
+        outcomes = {"ok": 0, "failed": 0, "busy": 0}
+        latencies = []
+        per_thread.append((outcomes, latencies))
+        username, password = "{:05d}".format(10000 + i * n_threads + j), "pass{:04d}".format(j)
+        deadline = monotonic() + duration
+        while monotonic() < deadline:
+            start = monotonic()
+            try:
+                cs_socket, version, _response = user.connect_to_cs(host, cs_port,
+                                                                   username, password)
+                if cs_socket is None:
+                    outcomes["busy"] += 1
+                    continue
+                reply = request(cs_socket, version, ["LSD"])
+                cs_socket.close()
+            except OSError:
+                outcomes["failed"] += 1
+                continue
+            if reply[0] != "LDR":
+                outcomes["failed"] += 1
+            elif monotonic() <= deadline:
+                outcomes["ok"] += 1
+                latencies.append(monotonic() - start)
+
+    threads = [Thread(target=sessions, args=(j,)) for j in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    results.put(({key: sum(outcomes[key] for outcomes, _ in per_thread)
+                  for key in ("ok", "failed", "busy")},
+                 [latency for _, latencies in per_thread for latency in latencies]))
+
+
+def refused_sessions(host, cs_port):
+    """ Sessions the CS refused so far, from its metrics (STA) """
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.settimeout(2)
+        sock.sendto("STA\n".encode(), (host, cs_port))
+        reply = sock.recv(65535).decode().split()
+    return int(next((field.split("=")[1] for field in reply if field.startswith("refused=")), 0))
+
+
+def run(host, cs_args, n_clients, n_threads, duration):
+    """ One run against a fresh CS started with cs_args """
+
+    basedir = mkdtemp(prefix="cs_overload.")
+    server = None
+    clients = []
+    try:
+        cs_port = free_port(host)
+        server = start_server("CS.py", ["-p", str(cs_port), "-l", "error"] + cs_args, basedir)
+        wait_for_port(host, cs_port)
+
+        results = Queue()
+        clients = [Process(target=run_client, args=(i, host, cs_port, n_threads, duration, results))
+                   for i in range(n_clients)]
+        for client in clients:
+            client.start()
+        collected = [results.get() for _client in clients]
+        refused = refused_sessions(host, cs_port)
+        for client in clients:
+            client.join()
+    finally:
+        for client in clients:
+            if client.is_alive():
+                client.terminate()
+        if server is not None:
+            stop_server(server)
+        rmtree(basedir, ignore_errors=True)
+
+    outcomes = {key: sum(result[0][key] for result in collected) for key in ("ok", "failed", "busy")}
+    latencies = [latency for result in collected for latency in result[1]]
+    return {"cs_args": " ".join(cs_args),
+            "goodput": round(outcomes["ok"] / duration, 1),
+            "completed": outcomes["ok"], "failed": outcomes["failed"],
+            "gave_up": outcomes["busy"], "refused": refused,
+            "p50_ms": round(percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 1) if latencies else None}
+
+
+def main():
+    n_clients, n_threads, duration = 8, 16, 10
+    cs_args, as_json = ["-c", "16"], False
+
+    try:
+        options = getopt(argv[1:], "c:w:t:x:j")[0]
+    except GetoptError as error:
+        print(error)
+        exit(2)
+
+    for opt, arg in options:
+        if opt == '-c':
+            n_clients = int(arg)
+        elif opt == '-w':
+            n_threads = int(arg)
+        elif opt == '-t':
+            duration = float(arg)
+        elif opt == '-x':
+            cs_args = arg.split()
+        elif opt == '-j':
+            as_json = True
+
+    host = get_best_ip()
+    runs = {"without": run(host, ["-c", "0"], n_clients, n_threads, duration),
+            "with": run(host, cs_args, n_clients, n_threads, duration)}
+
+    if as_json:
+        print(json.dumps({"clients": n_clients * n_threads, "seconds": duration, "runs": runs},
+                         indent=2))
+        return
+
+    print("{} concurrent clients, {} s\n".format(n_clients * n_threads, duration))
+    columns = ("goodput", "completed", "failed", "gave_up", "refused", "p50_ms", "p99_ms")
+    print("{:<22}".format("admission control") + "".join("{:>11}".format(c) for c in columns))
+    for name, result in runs.items():
+        label = "{} ({})".format(name, result["cs_args"])
+        print("{:<22}".format(label) + "".join("{:>11}".format(str(result[c])) for c in columns))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Placement simulation harness.
+
+    Replays the placement of synthetic directories over a synthetic fleet
+    of Backup Servers, with the legacy policy (lowest use counter) and the
+    weighted policy of lib.placement, and reports how evenly disks fill up.
+    BS loads are only refreshed every BS_REPORT_INTERVAL simulated seconds,
+    like the STS reports seen by the CS.
+
+    Usage (from the project root):
+        python3 -m bench.placement_sim [-n n_bs] [-d n_dirs] [-w workload]
+                                       [-s seed] [-j]
+"""
+
+import json
+from sys import argv
+from getopt import getopt, GetoptError
+from random import Random
+from statistics import pstdev
+from heapq import heappush, heappop
+from lib.placement import choose_bs, account_placement
+from lib.utils import BS_REPORT_INTERVAL
+
+
+GiB = 1024 ** 3
+MiB = 1024 ** 2
+
+BS_CAPACITIES = (50 * GiB, 100 * GiB, 200 * GiB, 400 * GiB)
+BS_BANDWIDTH = 100 * MiB        # bytes/s that a BS can receive
+ARRIVALS_PER_SECOND = 2
+
+WORKLOADS = {
+    "uniform":   lambda rnd: rnd.uniform(1 * MiB, 2 * GiB),
+    "lognormal": lambda rnd: min(rnd.lognormvariate(19, 2), 40 * GiB),
+    "pareto":    lambda rnd: min(10 * MiB * rnd.paretovariate(1.2), 40 * GiB),
+}
+
+
+def counter_policy(known_bs, bs_load, dir_size):
+    """ The policy the CS used before: lowest use counter, ignoring load """
+    return min(known_bs, key=known_bs.get) if known_bs else None
+
+
+def make_fleet(n_bs, rnd):
+    """ Returns {(ip, port): capacity} for n_bs synthetic BSs """
+    return {("10.0.0.{}".format(i), str(59000 + i)): rnd.choice(BS_CAPACITIES)
+            for i in range(1, n_bs + 1)}
+
+
+def simulate(policy, fleet, sizes):
+    """ Places the directories of sizes over fleet using policy """
+
+    used = {bs: 0 for bs in fleet}
+    known_bs = {bs: 0 for bs in fleet}
+    transfers = []          # heap of (end_time, bs, size)
+    active = {bs: 0 for bs in fleet}
+    max_active = 0
+    rejected = 0
+    first_full = None
+    moved = {bs: 0 for bs in fleet}
+    reported = {}
+    next_report = 0
+
+    for i, size in enumerate(sizes):
+        now = i / ARRIVALS_PER_SECOND
+
+        while transfers and transfers[0][0] <= now:
+            _end, bs, _size = heappop(transfers)
+            active[bs] -= 1
+
+        if now >= next_report:
+            reported = {bs: (fleet[bs] - used[bs], fleet[bs], active[bs],
+                             moved[bs] // BS_REPORT_INTERVAL) for bs in fleet}
+            moved = {bs: 0 for bs in fleet}
+            next_report = now + BS_REPORT_INTERVAL
+
+        bs = policy(known_bs, reported, size)
+        if bs is None or used[bs] + size > fleet[bs]:
+            rejected += 1
+            if first_full is None:
+                first_full = i
+            continue
+
+        known_bs[bs] += 1
+        used[bs] += size
+        moved[bs] += size
+        active[bs] += 1
+        max_active = max(max_active, active[bs])
+        reported[bs] = account_placement(reported[bs], size)
+        heappush(transfers, (now + size / BS_BANDWIDTH, bs, size))
+
+    fill = [used[bs] / fleet[bs] for bs in fleet]
+    return {
+        "placed": len(sizes) - rejected,
+        "rejected": rejected,
+        "first_rejection": first_full,
+        "fill_min": round(min(fill), 4),
+        "fill_max": round(max(fill), 4),
+        "fill_stdev": round(pstdev(fill), 4),
+        "max_active_on_one_bs": max_active,
+    }
+
+
+def main():
+    n_bs, n_dirs, workload, seed, as_json = 8, 2000, "lognormal", 28, False
+
+    try:
+        options = getopt(argv[1:], "n:d:w:s:j")[0]
+    except GetoptError as error:
+        print(error)
+        exit(2)
+
+    for opt, arg in options:
+        if opt == '-n':
+            n_bs = int(arg)
+        elif opt == '-d':
+            n_dirs = int(arg)
+        elif opt == '-w':
+            workload = arg
+        elif opt == '-s':
+            seed = int(arg)
+        elif opt == '-j':
+            as_json = True
+
+    if workload not in WORKLOADS:
+        print("Unknown workload {} (one of {})".format(workload, ", ".join(WORKLOADS)))
+        exit(2)
+
+    rnd = Random(seed)
+    fleet = make_fleet(n_bs, rnd)
+    sizes = [int(WORKLOADS[workload](rnd)) for _i in range(n_dirs)]
+
+    results = {
+        "workload": workload, "n_bs": n_bs, "n_dirs": n_dirs, "seed": seed,
+        "counter": simulate(counter_policy, fleet, sizes),
+        "weighted": simulate(choose_bs, fleet, sizes),
+    }
+
+    if as_json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print("{} BSs, {} directories, {} workload\n".format(n_bs, n_dirs, workload))
+    print("{:<22} {:>12} {:>12}".format("", "counter", "weighted"))
+    for key in results["counter"]:
+        print("{:<22} {:>12} {:>12}".format(key, str(results["counter"][key]),
+                                            str(results["weighted"][key])))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Startup time of CS.py, BS.py and user.py.
+
+    Starts each program runs times, each time in a fresh temp directory, and
+    measures the time from starting it until it is of use: until the CS or
+    the BS answers an AUT on its TCP port (polling every POLL_INTERVAL
+    seconds), and until the user application is done with a command (exit,
+    which only starts and stops it, and login, which also talks to a CS).
+
+    Each program is timed with its address looked up (get_best_ip, as by
+    default) and given explicitly (-a for the servers, -n for the user
+    application). The start of the interpreter alone is the baseline.
+
+    Usage (from the project root):
+        python3 -m bench.startup [-r runs] [-j]
+"""
+
+import os
+import sys
+import json
+import socket
+import subprocess
+from sys import argv
+from getopt import getopt, GetoptError
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import monotonic, sleep
+from bench.cluster import (ROOT, free_port, wait_for_port, start_server, stop_server,
+                           percentile)
+from lib.utils import get_best_ip, read_bytes_until
+
+
+POLL_INTERVAL = 0.002   # seconds between attempts to reach a server starting
+START_LIMIT = 30        # seconds a program may take to start
+
+
+def time_server(program, args, host, port):
+    """ Seconds from starting program until it answers an AUT on host:port """
+
+    workdir = mkdtemp(prefix="startup.")
+    start = monotonic()
+    server = start_server(program, args, workdir)
+    try:
+        while monotonic() - start < START_LIMIT:
+            try:
+                with socket.create_connection((host, port), timeout=START_LIMIT) as sock:
+                    sock.sendall("AUT 00000 startup0\n".encode())
+                    if read_bytes_until(sock, "\n").startswith("AUR"):
+                        return monotonic() - start
+            except OSError:
+                pass
+            sleep(POLL_INTERVAL)
+        raise RuntimeError("{} did not start in {} s".format(program, START_LIMIT))
+    finally:
+        stop_server(server)
+        rmtree(workdir, ignore_errors=True)
+
+
+def time_program(command, stdin=""):
+    """ Seconds from starting command until it exits """
+
+    workdir = mkdtemp(prefix="startup.")
+    start = monotonic()
+    try:
+        subprocess.run(command, input=stdin.encode(), cwd=workdir, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, timeout=START_LIMIT, check=True)
+        return monotonic() - start
+    finally:
+        rmtree(workdir, ignore_errors=True)
+
+
+def summary(times):
+    """ p50 and max, in ms """
+    return {"p50_ms": round(percentile(times, 0.5) * 1000, 1),
+            "max_ms": round(max(times) * 1000, 1)}
+
+
+def run(host, runs):
+    """ Times every entry point runs times, returns {name: summary} """
+
+    results = {"interpreter": summary([time_program([sys.executable, "-c", "pass"])
+                                       for _run in range(runs)])}
+
+    for name, address in (("CS.py", []), ("CS.py -a", ["-a", host])):
+        times = []
+        for _run in range(runs):
+            port = free_port(host)
+            times.append(time_server("CS.py", ["-p", str(port)] + address, host, port))
+        results[name] = summary(times)
+
+    # The BSs register in a CS, which stays up for all of them
+    cs_dir = mkdtemp(prefix="startup.")
+    cs_port = free_port(host)
+    cs = start_server("CS.py", ["-p", str(cs_port), "-a", host], cs_dir)
+    try:
+        wait_for_port(host, cs_port)
+        for name, address in (("BS.py", []), ("BS.py -a", ["-a", host, "-n", host])):
+            times = []
+            for _run in range(runs):
+                port = free_port(host)
+                times.append(time_server("BS.py", ["-p", str(cs_port), "-b", str(port)] + address,
+                                         host, port))
+            results[name] = summary(times)
+
+        user_py = [sys.executable, os.path.join(ROOT, "user.py"), "-p", str(cs_port)]
+        for name, address, stdin in (("user.py exit", [], "exit\n"),
+                                     ("user.py -n exit", ["-n", host], "exit\n"),
+                                     ("user.py -n login", ["-n", host],
+                                      "login 12345 startup0\nexit\n")):
+            results[name] = summary([time_program(user_py + address, stdin)
+                                     for _run in range(runs)])
+    finally:
+        stop_server(cs)
+        rmtree(cs_dir, ignore_errors=True)
+    return results
+
+
+def main():
+    runs, as_json = 10, False
+
+    try:
+        options = getopt(argv[1:], "r:j")[0]
+    except GetoptError as error:
+        print(error)
+        exit(2)
+
+    for opt, arg in options:
+        if opt == '-r':
+            runs = int(arg)
+        elif opt == '-j':
+            as_json = True
+
+    host = get_best_ip()
+    results = run(host, runs)
+
+    if as_json:
+        print(json.dumps({"runs": runs, "startup": results}, indent=2))
+        return
+
+    print("Startup time, {} runs\n".format(runs))
+    print("{:<20}{:>10}{:>10}".format("program", "p50_ms", "max_ms"))
+    for name, result in results.items():
+        print("{:<20}{:>10}{:>10}".format(name, result["p50_ms"], result["max_ms"]))
+
+
+if __name__ == "__main__":
+    main()
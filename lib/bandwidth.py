@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Bandwidth scheduling of the transfers of the Backup Server.
+
+    Every UPL and RSB stream is registered, with its user and a weight, in
+    a table shared by all the processes of the BS. Each stream paces itself
+    with a token bucket, at a rate that is its fair share of the bandwidth:
+    the total rate is split among the users with active streams, in
+    proportion to the weight of their heaviest stream (so a user restoring
+    gets more than one backing up), and the share of each user is split
+    among their streams by weight. A user may also be capped on their own.
+
+    Shares are recomputed every RATE_REFRESH seconds as streams come and
+    go. Without any limit set, streams are not paced at all.
+"""
+
+from contextlib import contextmanager
+from multiprocessing import Array
+from time import monotonic, sleep
+from zlib import crc32
+from lib.metrics import count
+
+
+RESTORE_WEIGHT = 4          # restores get priority over backups
+BACKUP_WEIGHT = 1
+MAX_STREAMS = 256           # streams in the shared table, at most
+RATE_REFRESH = 0.1          # seconds between recomputations of a share
+BURST_SECONDS = 0.05        # a bucket holds at most this many seconds of rate
+BURST_MIN = 64 * 1024       # ... but never less than this many bytes
+RATE_SUFFIXES = {"K": 10**3, "M": 10**6, "G": 10**9}
+
+_scheduler = None           # (total rate, user rate, shared table)
+
+
+def parse_rate(rate):
+    """ Parses a rate in bytes/s, with an optional K, M or G suffix """
+
+    multiplier = RATE_SUFFIXES.get(rate[-1:].upper(), 1)
+    if multiplier != 1:
+        rate = rate[:-1]
+    return int(float(rate) * multiplier)
+
+
+def init_scheduler(total_rate=0, user_rate=0):
+    """ Creates the stream table of this server, before it forks
+
+    Rates are in bytes/s, 0 for no limit.
+    """
+
+    global _scheduler
+    # Slots of (user key, weight), user key 0 for a free slot
+    _scheduler = (total_rate, user_rate, Array("q", 2 * MAX_STREAMS))
+
+
+def fair_rate(streams, user, weight, total_rate, user_rate):
+    """ Rate of a stream of user, given all the active (user, weight) streams """
+
+    users = {}  # user: (heaviest stream, weight of all streams)
+    for other, other_weight in streams:
+        heaviest, total = users.get(other, (0, 0))
+        users[other] = (max(heaviest, other_weight), total + other_weight)
+
+    heaviest, total = users[user]
+    rate = float("inf")
+    if total_rate:
+        rate = total_rate * heaviest / sum(top for top, _ in users.values())
+    if user_rate:
+        rate = min(rate, user_rate)
+    return rate * weight / total
+
+
+@contextmanager
+def stream(user, weight):
+    """ Registers a stream of user for the block, yields its pace function
+
+    pace(n) must be called for every n bytes sent or received, and sleeps
+    as long as needed to keep the stream within its share.
+    """
+
+    if _scheduler is None or not (_scheduler[0] or _scheduler[1]):
+        yield lambda _nbytes: None
+        return
+
+    total_rate, user_rate, table = _scheduler
+    key = crc32(user.encode()) + 1
+    slot = None
+    with table.get_lock():
+        for i in range(0, len(table), 2):
+            if table[i] == 0:
+                table[i], table[i + 1] = key, weight
+                slot = i
+                break
+
+    bucket = {"tokens": 0, "last": monotonic(), "rate": 0, "refresh": 0}
+
+    def pace(nbytes):
+        now = monotonic()
+        if now >= bucket["refresh"]:
+            with table.get_lock():
+                slots = table[:]
+            streams = [(slots[i], slots[i + 1]) for i in range(0, len(slots), 2) if slots[i]]
+            if slot is None:
+                streams.append((key, weight)) # table full, still counts itself
+            bucket["rate"] = fair_rate(streams, key, weight, total_rate, user_rate)
+            bucket["refresh"] = now + RATE_REFRESH
+
+        rate = bucket["rate"]
+        burst = max(rate * BURST_SECONDS, BURST_MIN)
+        tokens = min(bucket["tokens"] + (now - bucket["last"]) * rate, burst) - nbytes
+        bucket["last"] = now
+        if tokens < 0:
+            wait = -tokens / rate
+            sleep(wait)
+            count("throttled_ms", int(wait * 1000))
+            bucket["last"] = now + wait
+            tokens = 0
+        bucket["tokens"] = tokens
+
+    count("streams", 1)
+    try:
+        yield pace
+    finally:
+        count("streams", -1)
+        if slot is not None:
+            with table.get_lock():
+                table[slot], table[slot + 1] = 0, 0
+
+
+def capped(pace, rate):
+    """ pace function that also keeps a single stream within rate bytes/s
+
+    Used for migrations, which the CS gives a budget of their own. With rate
+    0 it is pace itself.
+    """
+
+    if not rate:
+        return pace
+
+    start, paced = monotonic(), 0
+
+    def capped_pace(nbytes):
+        nonlocal paced
+        pace(nbytes)
+        paced += nbytes
+        wait = start + paced / rate - monotonic()
+        if wait > 0:
+            sleep(wait)
+            count("throttled_ms", int(wait * 1000))
+
+    return capped_pace
+
+
+def throttled(chunks, pace):
+    """ Passes chunks along, pacing each one """
+
+    for chunk in chunks:
+        pace(len(chunk))
+        yield chunk
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Checksums of the files stored by the Backup Server.
+
+    Every file gets the SHA-256 digest of its contents as it is received,
+    computed over the same chunks that are written, so it is never read
+    again for that. The digest is kept in the entry of the file in the
+    index of its folder (see lib/storage.py), and sent along with the file
+    in restores, so that the user application checks what it writes.
+
+    The scrubber of the BS re-reads the stored files in the background, at
+    a bounded rate, with verify_folder: files whose contents no longer
+    match their digest are dropped from the index, so that the next backup
+    sends them again, instead of being found corrupt only when restored.
+"""
+
+import os
+from hashlib import sha256
+from lib.storage import folder_lock, read_index, is_packed, entry_digest
+from lib.packfile import open_entries
+from lib.utils import chunked_read_fd
+
+
+VERIFY_CHUNK = 64 * 1024    # bytes read at a time by verify_folder
+
+
+def new_digest():
+    """ A new digest object, fed with update(bytes), read with hexdigest() """
+    return sha256()
+
+
+def digested(chunks, digest):
+    """ Passes chunks along, adding each to digest """
+
+    for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+
+def read_range(fd, size, offset):
+    """ Iterates over size bytes of a file from offset, in chunks """
+
+    while size > 0:
+        data = os.pread(fd, min(VERIFY_CHUNK, size), offset)
+        if not data:
+            return
+        offset += len(data)
+        size -= len(data)
+        yield data
+
+
+def verify_folder(dirpath, pace):
+    """ Re-reads the files of a folder that have a digest, and checks them
+
+    pace(nbytes) is called after every chunk read. Returns
+    {"filename": entry} of the files whose contents are missing or do not
+    match their digest.
+    """
+
+    # Segments opened while locked stay readable even if compacted meanwhile
+    with folder_lock(dirpath):
+        index = read_index(dirpath) or {} # no index, no digests either
+        segment_fds = open_entries(dirpath, index)
+
+    corrupt = {}
+    try:
+        for filename, entry in index.items():
+            digest = entry_digest(entry)
+            if digest is None:
+                continue # received before there were checksums
+
+            filefd = None
+            if is_packed(entry):
+                chunks = read_range(segment_fds[entry[2]], entry[1], entry[3])
+            else:
+                try:
+                    filefd = os.open(os.path.join(dirpath, filename), os.O_RDONLY)
+                except FileNotFoundError:
+                    corrupt[filename] = entry
+                    continue
+                chunks = chunked_read_fd(filefd, entry[1], VERIFY_CHUNK)
+
+            file_digest = new_digest()
+            read = 0
+            try:
+                for data in chunks:
+                    if not data:
+                        break # shorter than it should be
+                    file_digest.update(data)
+                    read += len(data)
+                    pace(len(data))
+            finally:
+                if filefd is not None:
+                    os.close(filefd)
+
+            if read != entry[1] or file_digest.hexdigest() != digest:
+                corrupt[filename] = entry
+    finally:
+        for segment_fd in segment_fds.values():
+            os.close(segment_fd)
+    return corrupt
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Partitioning of the users among the nodes of a Central Server cluster.
+
+    Several CSs can share the same BSs, each owning part of the users,
+    chosen by consistent hashing of the user id over the nodes (adding a
+    node moves only about 1/n of the users). Every node is given the same
+    list of nodes. Clients may open their sessions with any node: on the
+    AUT of a user it does not own, a node either tells the client where the
+    owner is ("RDR ip port", in place of the AUR), if the client offered to
+    follow redirects, or else proxies the whole session to the owner.
+
+    The messages of the BSs to a node (REG, UNR, STS, HBT) are relayed to
+    the other nodes as "FWD message", so every node knows every BS. Relays
+    are sent from the UDP socket of the node, and only taken from the
+    address of another node.
+"""
+
+from bisect import bisect
+from functools import lru_cache
+from select import select
+from lib.placement import ring_point
+from lib.server import tcp_client
+from lib.utils import read_bytes_until
+
+
+NODE_VNODES = 64            # points of each node in the ring
+RELAYED = ("REG", "UNR", "STS", "HBT")
+
+
+def parse_nodes(nodes):
+    """ "ip:port,ip:port..." -> ((ip, port), ...), sorted """
+
+    parsed = []
+    for node in nodes.split(","):
+        ip, port = node.rsplit(":", 1)
+        parsed.append((ip, int(port)))
+    return tuple(sorted(set(parsed)))
+
+
+@lru_cache(maxsize=8)
+def node_ring(nodes):
+    """ Returns (points, nodes): the sorted ring of the nodes """
+
+    ring = sorted((ring_point("{}:{}#{}".format(ip, port, vnode)), (ip, port))
+                  for ip, port in nodes for vnode in range(NODE_VNODES))
+    return [point for point, _node in ring], [node for _point, node in ring]
+
+
+def node_of(user, nodes):
+    """ The node, (ip, port), that owns user """
+
+    points, owners = node_ring(nodes)
+    return owners[bisect(points, ring_point(user)) % len(points)]
+
+
+def owns(cluster, user):
+    """ True if this node owns user; cluster is (this node, nodes), or None """
+    return cluster is None or node_of(user, cluster[1]) == cluster[0]
+
+
+def relay(udp_socket, cluster, message):
+    """ Sends a message of a BS (bytes) to the other nodes, as FWD
+
+    udp_socket is the one the node listens on, so that the relays come
+    from its address.
+    """
+
+    me, nodes = cluster
+    for node in nodes:
+        if node != me:
+            try:
+                udp_socket.sendto(b"FWD " + message, node)
+            except OSError:
+                pass # node down, it learns the BS from its next STS
+
+
+def from_node(cluster, address):
+    """ True if a datagram from address comes from another node """
+    return address != cluster[0] and address in cluster[1]
+
+
+def proxy_session(conn, owner, version_offered, aut):
+    """ Relays a session to the node that owns its user, until either end closes
+
+    The client already sent its VER (version_offered, the fields of the
+    VER line, or None) and AUT (aut, the fields), and got its reply to VER:
+    they are sent again to the owner, whose reply to VER is dropped. From
+    there on, bytes are copied both ways. Raises OSError if the owner
+    cannot be reached.
+    """
+
+    upstream = tcp_client(*owner)
+    try:
+        if version_offered is not None:
+            upstream.sendall("VER {}\n".format(" ".join(version_offered)).encode())
+        upstream.sendall("AUT {}\n".format(" ".join(aut)).encode())
+        if version_offered is not None:
+            read_bytes_until(upstream, "\n")
+
+        upstream.settimeout(None)
+        peer = {conn: upstream, upstream: conn}
+        try:
+            while True:
+                for sock in select(list(peer), [], [])[0]:
+                    data = sock.recv(65536)
+                    if not data:
+                        return
+                    peer[sock].sendall(data)
+        except OSError:
+            pass # either end went away
+    finally:
+        upstream.close()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Minimal Linux inotify binding, through ctypes.
+
+    Only what the backup daemon of the user needs: an inotify fd, watches
+    on directories, and the decoding of the events read from the fd. ctypes
+    is only imported on first use, so importing this module costs nothing
+    to the commands of the user application that do not watch.
+"""
+
+import os
+import struct
+
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event {int wd; uint32 mask; uint32 cookie; uint32 len; char name[];}
+_EVENT = struct.Struct("iIII")
+_READ_SIZE = 64 * 1024
+
+_libc = None
+
+
+def _lib():
+    """ Loads libc on first use """
+
+    global _libc
+    if _libc is None:
+        import ctypes
+        from ctypes.util import find_library
+        _libc = ctypes.CDLL(find_library("c") or None, use_errno=True)
+    return _libc
+
+
+def _check(result, what):
+    """ Raises OSError for a failed libc call """
+
+    if result < 0:
+        import ctypes # loaded already, by _lib
+        errno = ctypes.get_errno()
+        raise OSError(errno, "{}: {}".format(what, os.strerror(errno)))
+    return result
+
+
+def inotify_init():
+    """ Returns a new inotify fd """
+    return _check(_lib().inotify_init1(IN_CLOEXEC), "inotify_init1")
+
+
+def add_watch(fd, path, mask):
+    """ Watches path for the events of mask, returns the watch descriptor
+
+    Watching an inode already watched returns its existing descriptor.
+    """
+    return _check(_lib().inotify_add_watch(fd, os.fsencode(path), mask),
+                  "inotify_add_watch")
+
+
+def read_events(fd):
+    """ Reads the pending events, returns a list of (wd, mask, cookie, name)
+
+    Blocks until there is at least one event.
+    """
+
+    data = os.read(fd, _READ_SIZE)
+    events = []
+    offset = 0
+    while offset < len(data):
+        wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+        offset += _EVENT.size
+        name = data[offset:offset + length].rstrip(b"\0")
+        offset += length
+        events.append((wd, mask, cookie, os.fsdecode(name)))
+    return events
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Logging of the servers, off the request path.
+
+    Each server calls init_logging once, before starting its processes. A
+    log call then only puts a record in a bounded queue, without waiting:
+    if the queue is full the record is dropped (and the number dropped is
+    added to the next one that makes it). A single writer process formats
+    the records, as text lines or as JSON objects, and writes them out, so
+    lines of different workers never interleave.
+
+    Records below the minimum level are not even queued, and a level can be
+    sampled, keeping only one in every n of its records (counted per
+    process). Until init_logging is called (or in programs that never call
+    it, like the user application), records are printed right away.
+"""
+
+import json
+from os import getpid
+from sys import stdout
+from queue import Empty, Full
+from signal import signal, SIGINT, SIG_IGN
+from time import time, strftime, localtime
+
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LOG_QUEUE_SIZE = 10000      # records waiting for the writer, at most
+
+_log = None                 # (queue, minimum level, {level: n}, writer process)
+_seen = {}                  # records of each sampled level seen by this process
+_dropped = 0                # records this process could not queue
+
+
+def parse_levels(spec):
+    """ Parses "level[/n],..." into (minimum level, {level: n})
+
+    The minimum level is the lowest one listed; "/n" keeps one in every n
+    records of that level. E.g. "debug/100" logs all info and above, and a
+    hundredth of the debug records. Raises ValueError if malformed.
+    """
+
+    levels, sampling = [], {}
+    for part in spec.split(","):
+        name, _, every = part.partition("/")
+        if name not in LEVELS:
+            raise ValueError("Unknown log level: {}".format(name))
+        levels.append(LEVELS[name])
+        if every:
+            if int(every) < 1:
+                raise ValueError("Bad sampling for {}: {}".format(name, every))
+            sampling[LEVELS[name]] = int(every)
+    return min(levels), sampling
+
+
+def init_logging(level=INFO, sampling=None, json_output=False):
+    """ Starts the writer process, before the server forks """
+
+    from multiprocessing import Process, Queue # not needed by programs that never call this
+
+    global _log
+    queue = Queue(LOG_QUEUE_SIZE)
+    writer = Process(target=write_records, args=(queue, json_output), name="Log writer")
+    writer.start()
+    _log = (queue, level, sampling or {}, writer)
+
+
+def stop_logging():
+    """ Writes out what is still queued and stops the writer process """
+
+    global _log
+    if _log is None:
+        return
+    queue, _level, _sampling, writer = _log
+    _log = None
+    try:
+        queue.put(None, timeout=1)
+    except Full:
+        pass
+    writer.join(2)
+    if writer.is_alive():
+        writer.terminate()
+        writer.join()
+
+
+def log(level, message, **fields):
+    """ Logs message, with fields, if level is enabled (and sampled) """
+
+    global _dropped
+    if _log is None:
+        stdout.write(format_text(time(), level, message, fields))
+        return
+
+    queue, min_level, sampling, _writer = _log
+    if level < min_level:
+        return
+    every = sampling.get(level)
+    if every:
+        _seen[level] = _seen.get(level, 0) + 1
+        if _seen[level] % every != 1 % every:
+            return
+
+    if _dropped:
+        fields["dropped"] = _dropped
+    try:
+        queue.put_nowait((time(), level, getpid(), message, fields))
+        _dropped = 0
+    except Full:
+        _dropped += 1
+
+
+def level_name(level):
+    """ Name of a level, for the output """
+    return next((name for name, value in LEVELS.items() if value == level), str(level))
+
+
+def format_text(when, level, message, fields):
+    """ A record as a text line
+
+    Connection events (with address and direction fields) keep the layout
+    of print_connection_event; other fields are appended as key=value.
+    """
+
+    fields = dict(fields)
+    if "direction" in fields:
+        line = "{} {}: {} [{}]".format(fields.pop("direction"), fields.pop("address"),
+                                       message.ljust(34), fields.pop("args", ""))
+    else:
+        line = message
+    if level >= WARNING:
+        line = "{}: {}".format(level_name(level).upper(), line)
+    line += "".join(" {}={}".format(key, value) for key, value in fields.items())
+    return line + "\n"
+
+
+def format_json(when, level, pid, message, fields):
+    """ A record as a JSON object, in one line """
+
+    record = {"time": strftime("%Y-%m-%dT%H:%M:%S", localtime(when))
+                      + "{:.6f}".format(when % 1)[1:],
+              "level": level_name(level), "pid": pid, "message": message.strip()}
+    for key, value in fields.items():
+        if key == "address":
+            value = "{}:{}".format(*value)
+        if not isinstance(value, str) or value.strip():
+            record[key] = value
+    return json.dumps(record, default=str) + "\n"
+
+
+def write_records(queue, json_output):
+    """ Log writer process function / program
+
+    Writes the records as they come, in batches of whatever is queued,
+    until it gets None.
+    """
+
+    signal(SIGINT, SIG_IGN)
+
+    while True:
+        batch = [queue.get()]
+        try:
+            while batch[-1] is not None and len(batch) < 1000:
+                batch.append(queue.get_nowait())
+        except Empty:
+            pass
+
+        lines = []
+        for record in batch:
+            if record is None:
+                break
+            when, level, pid, message, fields = record
+            if json_output:
+                lines.append(format_json(when, level, pid, message, fields))
+            else:
+                lines.append(format_text(when, level, message, fields))
+        stdout.write("".join(lines))
+        stdout.flush()
+
+        if batch[-1] is None:
+            return
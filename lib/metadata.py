@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Metadata of the Central Server in SQLite.
+
+    An alternative to keeping the users, the BSs and the location of the
+    folders in SyncManager dicts, saved whole to pickle files: each is a
+    table of a database in WAL mode, with the same keys and values, seen
+    as a dict. Nothing is loaded at startup, every lookup is a query by
+    primary key (or by its first column, see items_of), and every change
+    is committed as it is made, so there is nothing to save at the end.
+
+    Each process (and each thread in it) opens its own connection, on first
+    use, so the tables can be passed to forked processes like the
+    SyncManager dicts, and used from thread pools.
+"""
+
+import os
+import threading
+from collections.abc import MutableMapping
+from pickle import dumps, loads
+from lib.utils import backup_dict_to_file, restore_dict_from_file
+
+
+BUSY_TIMEOUT = 10           # seconds to wait for a write lock held by another process
+
+# name: (columns, key columns, value column); WITHOUT ROWID, so rows are
+# stored in the primary key index itself
+TABLES = {
+    "users": ("user TEXT PRIMARY KEY, password TEXT NOT NULL",
+              ("user",), "password"),
+    "bs": ("ip TEXT, port TEXT, folders INTEGER NOT NULL, PRIMARY KEY (ip, port)",
+           ("ip", "port"), "folders"),
+    "dirs": ("user TEXT, folder TEXT, location BLOB NOT NULL, PRIMARY KEY (user, folder)",
+             ("user", "folder"), "location"),
+    "deleted": ("user TEXT, folder TEXT, bs BLOB NOT NULL, PRIMARY KEY (user, folder)",
+                ("user", "folder"), "bs"),
+}
+PICKLED = ("dirs", "deleted")         # tables whose values are pickled
+
+_local = threading.local()  # connections of each thread: {path: (pid, connection)}
+
+
+def connect(path):
+    """ The connection of this thread to the database at path """
+
+    if not hasattr(_local, "connections"):
+        _local.connections = {}
+    pid, db = _local.connections.get(path, (None, None))
+    if pid != os.getpid():
+        import sqlite3 # not loaded by CSs that do not use it
+        db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        _local.connections[path] = (os.getpid(), db)
+    return db
+
+
+class Table(MutableMapping):
+    """ A table of the metadata database, as a dict """
+
+    def __init__(self, path, name):
+        self.path, self.name = path, name
+        _columns, self.key_columns, self.value = TABLES[name]
+        self.where = " AND ".join("{} = ?".format(column) for column in self.key_columns)
+
+    def _key(self, key):
+        return key if len(self.key_columns) > 1 else (key,)
+
+    def _encode(self, value):
+        return dumps(value) if self.name in PICKLED else value
+
+    def _decode(self, value):
+        return loads(value) if self.name in PICKLED else value
+
+    def __getitem__(self, key):
+        row = connect(self.path).execute(
+            "SELECT {} FROM {} WHERE {}".format(self.value, self.name, self.where),
+            self._key(key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return self._decode(row[0])
+
+    def __setitem__(self, key, value):
+        row = (*self._key(key), self._encode(value))
+        connect(self.path).execute(
+            "INSERT OR REPLACE INTO {} VALUES ({})".format(self.name, ", ".join("?" * len(row))),
+            row)
+
+    def __delitem__(self, key):
+        cursor = connect(self.path).execute(
+            "DELETE FROM {} WHERE {}".format(self.name, self.where), self._key(key))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return connect(self.path).execute(
+            "SELECT 1 FROM {} WHERE {}".format(self.name, self.where),
+            self._key(key)).fetchone() is not None
+
+    def __iter__(self):
+        rows = connect(self.path).execute(
+            "SELECT {} FROM {}".format(", ".join(self.key_columns), self.name)).fetchall()
+        return iter([row if len(self.key_columns) > 1 else row[0] for row in rows])
+
+    def __len__(self):
+        return connect(self.path).execute(
+            "SELECT COUNT(*) FROM {}".format(self.name)).fetchone()[0]
+
+    def copy(self):
+        """ The whole table, as a dict (as DictProxy.copy) """
+
+        rows = connect(self.path).execute(
+            "SELECT {}, {} FROM {}".format(", ".join(self.key_columns), self.value, self.name))
+        n_keys = len(self.key_columns)
+        return {(row[:n_keys] if n_keys > 1 else row[0]): self._decode(row[n_keys])
+                for row in rows}
+
+    def update(self, other=(), **kwargs):
+        """ Sets many keys, in a single transaction """
+
+        items = list(dict(other, **kwargs).items())
+        db = connect(self.path)
+        db.execute("BEGIN")
+        try:
+            for key, value in items:
+                self[key] = value
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def items_of(self, first):
+        """ [(rest of the key, value)] of the rows whose key starts with first
+
+        Uses the primary key index, e.g. the folders of a user in "dirs".
+        """
+
+        rest = self.key_columns[1:]
+        rows = connect(self.path).execute(
+            "SELECT {}, {} FROM {} WHERE {} = ?".format(", ".join(rest), self.value,
+                                                        self.name, self.key_columns[0]),
+            (first,))
+        return [(row[0] if len(rest) == 1 else row[:-1], self._decode(row[-1]))
+                for row in rows]
+
+
+def open_metadata(path):
+    """ Creates the database at path if needed, returns {name: Table} """
+
+    db = connect(path)
+    for name, (columns, _keys, _value) in TABLES.items():
+        db.execute("CREATE TABLE IF NOT EXISTS {} ({}) WITHOUT ROWID".format(name, columns))
+    return {name: Table(path, name) for name in TABLES}
+
+
+def migrate_pickle(table, pickle_file, convert=lambda value: value):
+    """ Imports the dict saved in pickle_file into table, once
+
+    The file is then renamed to pickle_file.migrated, so that it is not
+    imported again. Returns the number of keys imported.
+    """
+
+    if not os.path.isfile(pickle_file):
+        return 0
+    saved = restore_dict_from_file(pickle_file)
+    table.update({key: convert(value) for key, value in saved.items()})
+    os.rename(pickle_file, pickle_file + ".migrated")
+    return len(saved)
+
+
+def persist(mapping, pickle_file):
+    """ Saves a dict to pickle_file; tables are saved as they change """
+
+    if not isinstance(mapping, Table):
+        backup_dict_to_file(mapping, pickle_file)
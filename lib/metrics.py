@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Runtime metrics of the servers, shared by all their processes.
+
+    Each server calls init_metrics once, before starting its processes:
+    the counters live in a shared array, so the processes it forks (and
+    the ones those fork, like the per-connection workers) all add to the
+    same numbers. Per command there is a count, an error count, the total
+    time and a latency histogram; besides those, plain counters (bytes,
+    connections) and gauges (active workers).
+
+    They can be read with a UDP STA query (see format_sta) or scraped, in
+    Prometheus text format, from the HTTP endpoint of serve_metrics.
+"""
+
+import socket
+from bisect import bisect_left
+from contextlib import contextmanager
+from multiprocessing import Array
+from signal import signal, SIGINT, SIGTERM, SIG_IGN
+from struct import unpack_from
+from time import monotonic
+
+
+# Upper bounds, in seconds, of the latency histogram buckets (plus +Inf)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+# Counters that go down too (see count), exported as gauges
+GAUGES = ("workers", "streams")
+
+_COUNT, _ERRORS, _SUM_US, _BUCKETS = 0, 1, 2, 3
+_SLOTS = _BUCKETS + len(LATENCY_BUCKETS) + 1
+
+_metrics = None     # (prefix, commands, counters, shared array)
+
+
+def init_metrics(prefix, commands, counters):
+    """ Creates the metrics of this server, before it forks
+
+    prefix names the server ("cs", "bs"), commands are the names timed with
+    timed/observe, counters the names used with count.
+    """
+
+    global _metrics
+    commands, counters = tuple(commands), tuple(counters)
+    _metrics = (prefix, commands, counters,
+                Array("q", len(commands) * _SLOTS + len(counters)))
+
+
+def observe(command, seconds, error=False):
+    """ Accounts one command that took seconds """
+
+    if _metrics is None or command not in _metrics[1]:
+        return
+    base = _metrics[1].index(command) * _SLOTS
+    bucket = bisect_left(LATENCY_BUCKETS, seconds)
+    values = _metrics[3]
+    with values.get_lock():
+        values[base + _COUNT] += 1
+        values[base + _ERRORS] += int(error)
+        values[base + _SUM_US] += int(seconds * 1e6)
+        values[base + _BUCKETS + bucket] += 1
+
+
+@contextmanager
+def timed(command):
+    """ Times the block as one command, an error if it raises """
+
+    start = monotonic()
+    try:
+        yield
+    except BaseException as error:
+        observe(command, monotonic() - start, not isinstance(error, SystemExit)
+                or error.code not in (0, None))
+        raise
+    observe(command, monotonic() - start)
+
+
+def count(counter, amount=1):
+    """ Adds amount (maybe negative, for gauges) to a counter """
+
+    if _metrics is None:
+        return
+    index = len(_metrics[1]) * _SLOTS + _metrics[2].index(counter)
+    values = _metrics[3]
+    with values.get_lock():
+        values[index] += amount
+
+
+def count_tcp_bytes(sock):
+    """ Counts the bytes sent and received so far over a TCP socket
+
+    Read from the kernel's TCP_INFO right before the socket is closed, when
+    the last bytes written may not even be sent yet: so bytes_sent (less
+    the retransmitted ones) plus notsent_bytes where the kernel has them,
+    else bytes_acked. Counters "bytes_out" and "bytes_in".
+    """
+
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 256)
+    except OSError:
+        return
+    if len(info) < 136:
+        return
+    written, received = unpack_from("QQ", info, 120)
+    if len(info) >= 216:
+        not_sent = unpack_from("I", info, 144)[0]
+        sent, retransmitted = unpack_from("QQ", info, 200)
+        written = sent - retransmitted + not_sent
+    count("bytes_out", written)
+    count("bytes_in", received)
+
+
+def read_metrics():
+    """ Returns ({command: (count, errors, sum_seconds, buckets)}, {counter: value}) """
+
+    _prefix, commands, counters, values = _metrics
+    with values.get_lock():
+        values = values[:]
+
+    per_command = {}
+    for i, command in enumerate(commands):
+        base = i * _SLOTS
+        per_command[command] = (values[base + _COUNT], values[base + _ERRORS],
+                                values[base + _SUM_US] / 1e6,
+                                values[base + _BUCKETS:base + _SLOTS])
+    offset = len(commands) * _SLOTS
+    return per_command, {counter: values[offset + i] for i, counter in enumerate(counters)}
+
+
+def percentile(buckets, fraction):
+    """ Upper bound (in ms) of the bucket holding the fraction percentile """
+
+    target = fraction * sum(buckets)
+    seen = 0
+    for bound, in_bucket in zip(LATENCY_BUCKETS, buckets):
+        seen += in_bucket
+        if seen >= target:
+            return bound * 1000
+    return float("inf")
+
+
+def format_sta():
+    """ The STA reply: "STR command=count/errors/p50_ms/p99_ms ... counter=value ..."
+
+    Only the commands seen so far are listed.
+    """
+
+    per_command, counters = read_metrics()
+    fields = ["{}={}/{}/{:g}/{:g}".format(command, n, errors, percentile(buckets, 0.5),
+                                          percentile(buckets, 0.99))
+              for command, (n, errors, _sum, buckets) in per_command.items() if n]
+    fields += ["{}={}".format(counter, value) for counter, value in counters.items()]
+    return "STR {}\n".format(" ".join(fields))
+
+
+def format_prometheus():
+    """ All the metrics, in the Prometheus text exposition format """
+
+    prefix = _metrics[0]
+    per_command, counters = read_metrics()
+    lines = ["# TYPE {}_request_seconds histogram".format(prefix)]
+    for command, (n, _errors, total, buckets) in per_command.items():
+        cumulative = 0
+        for bound, in_bucket in zip(LATENCY_BUCKETS + ("+Inf",), buckets):
+            cumulative += in_bucket
+            lines.append('{}_request_seconds_bucket{{command="{}",le="{}"}} {}'.format(
+                prefix, command, bound, cumulative))
+        lines.append('{}_request_seconds_sum{{command="{}"}} {}'.format(prefix, command, total))
+        lines.append('{}_request_seconds_count{{command="{}"}} {}'.format(prefix, command, n))
+
+    lines.append("# TYPE {}_request_errors_total counter".format(prefix))
+    for command, (_n, errors, _total, _buckets) in per_command.items():
+        lines.append('{}_request_errors_total{{command="{}"}} {}'.format(prefix, command, errors))
+
+    for counter, value in counters.items():
+        lines.append("# TYPE {}_{} {}".format(prefix, counter,
+                                              "gauge" if counter in GAUGES else "counter"))
+        lines.append("{}_{} {}".format(prefix, counter, value))
+    return "\n".join(lines) + "\n"
+
+
+def serve_metrics(http_socket):
+    """ Metrics endpoint process function / program
+
+    Answers every HTTP request on http_socket (a listening TCP socket) with
+    the metrics in Prometheus format.
+    """
+
+    def signal_handler(_signum, _frame):
+        http_socket.close()
+        exit(0)
+
+
+    signal(SIGINT, SIG_IGN)
+    signal(SIGTERM, signal_handler)
+
+    while True:
+        conn, _address = http_socket.accept()
+        try:
+            conn.settimeout(5)
+            conn.recv(4096) # the request itself does not matter
+            body = format_prometheus().encode()
+            conn.sendall("HTTP/1.0 200 OK\r\n"
+                         "Content-Type: text/plain; version=0.0.4\r\n"
+                         "Content-Length: {}\r\n\r\n".format(len(body)).encode() + body)
+        except OSError:
+            pass
+        finally:
+            conn.close()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Packfile storage engine of the Backup Server, for small files.
+
+    Instead of one inode per file, small files are appended to a few large
+    segments per folder (.bs_pack.<n>), and the folder index records where
+    each one lives: {"filename": (mtime, size, segment, offset[, digest])}. Segments
+    are only appended to; replaced files leave garbage behind, which
+    compact_folder reclaims by copying the live files to a new segment.
+
+    Writers hold a shared flock on the segment they append to, until their
+    index update is done. The compactor only touches segments it can lock
+    exclusively, and never the newest one.
+"""
+
+import os
+from fcntl import flock, LOCK_SH, LOCK_EX, LOCK_NB, LOCK_UN
+from lib.storage import (INTERNAL_PREFIX, folder_lock, read_index, save_index,
+                         is_packed)
+
+
+PACK_PREFIX = INTERNAL_PREFIX + "pack."
+PACK_MAX_FILE = 64 * 1024               # larger files are stored loose
+PACK_SEGMENT_BYTES = 64 * 1024 * 1024   # start a new segment after this
+
+# Compact a segment when this fraction of it (and at least that many bytes)
+# belongs to files that were replaced or removed
+COMPACT_GARBAGE_RATIO = 0.5
+COMPACT_MIN_GARBAGE = 1024 * 1024
+COMPACT_INTERVAL = 60                   # seconds between compaction passes
+PACE_CHUNK = 64 * 1024                  # bytes per sendfile of a paced send
+
+
+def segment_path(dirpath, segment):
+    """ Path of segment number segment of a folder """
+    return os.path.join(dirpath, "{}{}".format(PACK_PREFIX, segment))
+
+
+def list_segments(dirpath):
+    """ Returns the numbers of the segments of a folder, sorted """
+
+    return sorted(int(name[len(PACK_PREFIX):]) for name in os.listdir(dirpath)
+                  if name.startswith(PACK_PREFIX) and name[len(PACK_PREFIX):].isdigit())
+
+
+def open_segment(dirpath):
+    """ Opens the segment new files should go to, for appending
+
+    Returns (fd, segment), with a shared lock held on the segment; release
+    it with close_segment once the index points to what was appended.
+    """
+
+    while True:
+        segments = list_segments(dirpath)
+        segment = segments[-1] if segments else 0
+        path = segment_path(dirpath, segment)
+        if segments and os.stat(path).st_size >= PACK_SEGMENT_BYTES:
+            segment += 1
+            path = segment_path(dirpath, segment)
+
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, mode=0o660)
+        flock(fd, LOCK_SH)
+
+        # The compactor may have removed it between listing and locking
+        try:
+            if os.stat(path).st_ino == os.fstat(fd).st_ino:
+                return fd, segment
+        except FileNotFoundError:
+            pass
+        close_segment(fd)
+
+
+def close_segment(fd):
+    """ Releases a segment opened with open_segment """
+    flock(fd, LOCK_UN)
+    os.close(fd)
+
+
+def append(fd, data):
+    """ Appends data to an open segment, returns the offset it was written at
+
+    O_APPEND makes each write land at the end of the segment, even with
+    other processes appending to it too.
+    """
+
+    written = os.write(fd, data)
+    if written != len(data):
+        raise OSError("Short write to pack segment")
+    return os.lseek(fd, 0, os.SEEK_CUR) - written
+
+
+def open_entries(dirpath, index):
+    """ Opens, for reading, the segments used by the entries of index
+
+    Returns {segment: fd}. Must be called with the folder locked, so that
+    the compactor does not remove a segment in between.
+    """
+
+    segments = {entry[2] for entry in index.values() if is_packed(entry)}
+    return {segment: os.open(segment_path(dirpath, segment), os.O_RDONLY)
+            for segment in segments}
+
+
+def segment_garbage(dirpath, index):
+    """ Returns {segment: (size, garbage bytes)} for the segments of a folder """
+
+    live = {}
+    for entry in index.values():
+        if is_packed(entry):
+            live[entry[2]] = live.get(entry[2], 0) + entry[1]
+
+    usage = {}
+    for segment in list_segments(dirpath):
+        size = os.stat(segment_path(dirpath, segment)).st_size
+        usage[segment] = (size, size - live.get(segment, 0))
+    return usage
+
+
+def compact_folder(dirpath):
+    """ Rewrites the live files of mostly garbage segments into a new one
+
+    Returns the number of bytes reclaimed.
+    """
+
+    reclaimed = 0
+    with folder_lock(dirpath):
+        index = read_index(dirpath)
+        if index is None:
+            return 0
+
+        usage = segment_garbage(dirpath, index)
+        candidates = [segment for segment, (size, garbage) in usage.items()
+                      if garbage >= COMPACT_MIN_GARBAGE
+                      and garbage >= COMPACT_GARBAGE_RATIO * size]
+
+        # Never the newest segment, and only those no writer is using
+        locked = {}
+        for segment in candidates:
+            if segment == max(usage):
+                continue
+            fd = os.open(segment_path(dirpath, segment), os.O_RDONLY)
+            try:
+                flock(fd, LOCK_EX | LOCK_NB)
+                locked[segment] = fd
+            except BlockingIOError:
+                os.close(fd)
+
+        if not locked:
+            return 0
+
+        out_fd, out_segment = open_segment(dirpath)
+        try:
+            for filename, entry in index.items():
+                if is_packed(entry) and entry[2] in locked:
+                    data = os.pread(locked[entry[2]], entry[1], entry[3])
+                    offset = append(out_fd, data)
+                    index[filename] = (entry[0], entry[1], out_segment, offset, *entry[4:])
+            # The old segments are removed next: the index must be on disk
+            os.fsync(out_fd)
+            save_index(dirpath, index, durable=True)
+        finally:
+            close_segment(out_fd)
+
+        for segment, fd in locked.items():
+            reclaimed += usage[segment][1]
+            os.remove(segment_path(dirpath, segment))
+            flock(fd, LOCK_UN)
+            os.close(fd)
+
+    return reclaimed
+
+
+def send_packed(sock, segment_fd, offset, size, pace=None):
+    """ Sends size bytes of a segment, from offset, straight to a socket
+
+    With pace (see lib/bandwidth.py), sends at most PACE_CHUNK bytes at a
+    time, pacing each.
+    """
+
+    while size > 0:
+        sent = os.sendfile(sock.fileno(), segment_fd, offset,
+                           size if pace is None else min(size, PACE_CHUNK))
+        if pace is not None:
+            pace(sent)
+        if sent == 0:
+            raise ConnectionError("Segment ended before the file did")
+        offset += sent
+        size -= sent
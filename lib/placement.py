@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Placement policy used by the CS to choose Backup Servers.
+
+    Every BS reports (free_bytes, total_bytes, active_transfers, throughput)
+    when it registers and periodically after that. The CS keeps the last
+    report of each BS and, for every new directory, ranks the candidates with a
+    weighted score (lower is better) kept in a heap. Directories placed
+    already are moved by the rebalancer of the CS from the BS whose disk is
+    the fullest to the emptiest one, while they differ enough.
+"""
+
+from heapq import heapify, heappop
+from bisect import bisect
+from hashlib import md5
+from functools import lru_cache
+from lib.utils import BS_HEARTBEAT_INTERVAL
+
+
+# Weights of each term of the score. Disk dominates, so that no BS fills up
+# while others sit idle; load and throughput spread concurrent transfers.
+DISK_WEIGHT = 0.8
+LOAD_WEIGHT = 0.15
+THROUGHPUT_WEIGHT = 0.05
+
+# Never place a directory that would leave less than this free on a BS
+MIN_FREE_BYTES = 64 * 1024 * 1024
+
+# Load assumed for a BS that has not reported yet (old BS, or lost report)
+UNKNOWN_LOAD = (None, None, 0, 0)
+
+# Seconds without news from a BS after which it is suspect, and then dead.
+# Suspect BSs get no new directories; dead ones are not even contacted.
+SUSPECT_AFTER = 3 * BS_HEARTBEAT_INTERVAL
+DEAD_AFTER = 6 * BS_HEARTBEAT_INTERVAL
+
+# Directories of at least this size are striped over several BSs (if the
+# CS is configured with a stripe width above 1)
+STRIPE_MIN_BYTES = 256 * 1024 * 1024
+
+# The rebalancer moves directories between two BSs while the fractions of
+# their disks in use differ by more than this
+REBALANCE_GAP = 0.1
+
+# Points of each shard in the consistent hashing ring
+RING_VNODES = 64
+
+
+def bs_score(load, max_active, max_throughput):
+    """ Weighted score of a BS, in [0, 1] (lower is better) """
+
+    free, total, active, throughput = load
+
+    disk = 0.5 if free is None or not total else 1 - free / total
+    busy = active / max_active if max_active else 0
+    rate = throughput / max_throughput if max_throughput else 0
+
+    return DISK_WEIGHT * disk + LOAD_WEIGHT * busy + THROUGHPUT_WEIGHT * rate
+
+
+def rank_bs(known_bs, bs_load, dir_size=0):
+    """ Returns the BSs able to hold dir_size bytes, best first
+
+    known_bs is {(ip, port): use_counter} and bs_load is
+    {(ip, port): (free_bytes, total_bytes, active_transfers, throughput)}.
+    The use counter is only used to break ties, which keeps the old
+    round-robin behaviour when no BS reports its load.
+    """
+
+    loads = {bs: tuple(bs_load.get(bs, UNKNOWN_LOAD)) for bs in known_bs}
+    loads = {bs: load for bs, load in loads.items()
+             if load[0] is None or load[0] - dir_size >= MIN_FREE_BYTES}
+
+    if not loads:
+        return []
+
+    max_active = max(load[2] for load in loads.values())
+    max_throughput = max(load[3] for load in loads.values())
+
+    heap = [(bs_score(load, max_active, max_throughput),
+             known_bs[bs], bs) for bs, load in loads.items()]
+    heapify(heap)
+
+    return [heappop(heap)[2] for _i in range(len(heap))]
+
+
+def choose_bs(known_bs, bs_load, dir_size=0):
+    """ Returns the best BS to hold a new directory, or None if none fits """
+
+    ranking = rank_bs(known_bs, bs_load, dir_size)
+    return ranking[0] if ranking else None
+
+
+def least_loaded(candidates, bs_load):
+    """ Returns the candidate BS with fewest active transfers, to read from
+
+    Ties are broken by throughput and then by the order of candidates.
+    """
+
+    return min(candidates, key=lambda bs: tuple(bs_load.get(bs, UNKNOWN_LOAD))[2:])
+
+
+def ring_point(key):
+    """ Position of key in the hashing ring (stable across processes) """
+    return int.from_bytes(md5(key.encode()).digest()[:8], "big")
+
+
+@lru_cache(maxsize=32)
+def hash_ring(n_shards):
+    """ Returns (points, shards): the sorted ring for n_shards shards """
+
+    ring = sorted((ring_point("shard{}:{}".format(shard, vnode)), shard)
+                  for shard in range(n_shards) for vnode in range(RING_VNODES))
+    return [point for point, _shard in ring], [shard for _point, shard in ring]
+
+
+def shard_of(filename, n_shards):
+    """ Index of the shard that stores filename, by consistent hashing
+
+    The ring only depends on the number of shards, so the CS and the clients
+    agree on it, and the replicas of a shard can change without moving files.
+    """
+
+    if n_shards == 1:
+        return 0
+
+    points, shards = hash_ring(n_shards)
+    return shards[bisect(points, ring_point(filename)) % len(points)]
+
+
+def disk_use(load):
+    """ Fraction of the disk of a BS in use, from its load """
+
+    free, total = load[:2]
+    return 1 - free / total
+
+
+def plan_rebalance(bs_load):
+    """ Returns (fullest BS, emptiest BS, bytes to move), or None if balanced
+
+    Only the BSs that report their disk are considered. The bytes are those
+    that would leave both BSs with the same fraction of their disks in use
+    (and the emptiest with MIN_FREE_BYTES free, at least).
+    """
+
+    loads = {bs: load for bs, load in bs_load.items() if load[0] is not None and load[1]}
+    if len(loads) < 2:
+        return None
+
+    fullest = max(loads, key=lambda bs: disk_use(loads[bs]))
+    emptiest = min(loads, key=lambda bs: disk_use(loads[bs]))
+    if disk_use(loads[fullest]) - disk_use(loads[emptiest]) < REBALANCE_GAP:
+        return None
+
+    (free_from, total_from), (free_to, total_to) = loads[fullest][:2], loads[emptiest][:2]
+    balanced = ((total_from - free_from) * total_to - (total_to - free_to) * total_from) \
+               // (total_from + total_to)
+    return fullest, emptiest, min(balanced, free_to - MIN_FREE_BYTES)
+
+
+def account_move(load, nbytes):
+    """ Load of a BS right after nbytes were moved into it (out, if negative) """
+
+    free, total, active, throughput = load
+    return (free - nbytes, total, active, throughput)
+
+
+def bs_liveness(last_seen, now):
+    """ Returns "alive", "suspect" or "dead", given the last time seen """
+
+    silence = now - last_seen
+    if silence >= DEAD_AFTER:
+        return "dead"
+    elif silence >= SUSPECT_AFTER:
+        return "suspect"
+    return "alive"
+
+
+def account_placement(load, dir_size):
+    """ Load of a BS right after a directory was placed on it
+
+    Used by the CS so that placements made before the next report of that
+    BS already see the space and the transfer they are going to use.
+    """
+
+    free, total, active, throughput = load
+    if free is not None:
+        free -= dir_size
+    return (free, total, active + 1, throughput)
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Framing of the TCP protocol, in text (version 1) and binary (version 2).
+
+    Connections start in the text protocol: messages are lines of fields
+    separated by spaces, mtimes are "dd.mm.YYYY HH:MM:SS" (two fields). A
+    client that speaks version 2 sends "VER 2" right before its AUT. A
+    server that speaks it answers "VER 2" (older servers answer ERR, once
+    per field), and from its reply to that AUT on, both ends send frames:
+
+        header: payload length (u32), command (3 ASCII bytes),
+                request id (u32), number of fields (u16)
+        fields: a type byte and the value, "i" int64, "s" u32 length and
+                UTF-8, "b" u32 length and bytes
+
+    So every field is read in O(1), without scanning for separators, and
+    mtimes are integers (seconds, UTC). Replies carry the request id of
+    their request; in version 2 the session stays open after each reply,
+    so a client may send several requests without waiting for the replies
+    (they are served in order) and match the replies by id.
+
+    File contents are not fields: each file goes as a FIL frame (name,
+    mtime, size) followed by its size raw bytes, so that it can be streamed,
+    or sent with sendfile.
+
+    After the version, the VER line may list capabilities of the client:
+    REDIRECT ("RDR") says that it follows redirects to another CS node (see
+    lib/cluster.py), which come as "RDR ip port" in place of the AUR.
+    CHECKSUM ("SUM") asks for the digests of the files (see lib/checksum.py):
+    in version 2, FIL frames of restores and the entries of LFD then have
+    a fourth field, the hex digest ("-" in LFD if a file has none).
+    CHUNKED ("CNK") says that the client sends the manifest of a BCK, and
+    takes its BKR, in chunks (see send_chunked); a server that can do so
+    lists it after the version in its reply, "VER 2 CNK", so that older
+    servers, and the clients that did not offer it, are not affected.
+"""
+
+import struct
+from calendar import timegm
+from time import strptime, strftime, gmtime
+from lib.utils import read_bytes_until
+
+
+PROTOCOL_VERSION = 2        # highest version spoken
+REDIRECT = "RDR"            # capability of following redirects, and the reply
+CHECKSUM = "SUM"            # capability of checking the digests of files
+CHUNKED = "CNK"             # capability of sending manifests in chunks
+CHUNK_BYTES = 1024 * 1024   # size of the entries of each chunk, about, at most
+TEXT_DATE_FORMAT = "%d.%m.%Y %H:%M:%S"
+MAX_FRAME = 16 * 1024 * 1024
+MAX_FIELDS = 0xFFFF         # fields of a frame, at most (u16 in the header)
+
+_HEADER = struct.Struct("!I3sIH")
+_INT = struct.Struct("!q")
+_LENGTH = struct.Struct("!I")
+
+
+def format_mtime(mtime):
+    """ An mtime as in the text protocol, "dd.mm.YYYY HH:MM:SS" """
+    return strftime(TEXT_DATE_FORMAT, gmtime(mtime))
+
+
+def parse_mtime(date, time):
+    """ The mtime of the "dd.mm.YYYY" "HH:MM:SS" fields of the text protocol """
+    return timegm(strptime(date + " " + time, TEXT_DATE_FORMAT))
+
+
+def entry_fields(name, mtime, size, version, digest=None):
+    """ Fields of a file entry: name, mtime and size (and digest, if given) """
+
+    if version >= 2:
+        fields = [name, mtime, size]
+    else:
+        fields = [name, *format_mtime(mtime).split(" "), size]
+    if digest is not None:
+        fields.append(digest)
+    return fields
+
+
+def parse_entries(fields, n_entries, version, digests=False):
+    """ Parses n_entries file entries from fields, returns [(name, mtime, size)]
+
+    With digests, entries have a digest field, and are (name, mtime, size, digest).
+    """
+
+    if digests:
+        if version >= 2:
+            return [tuple(fields[4*i:4*i + 4]) for i in range(n_entries)]
+        return [(fields[5*i], parse_mtime(fields[5*i + 1], fields[5*i + 2]),
+                 int(fields[5*i + 3]), fields[5*i + 4]) for i in range(n_entries)]
+    if version >= 2:
+        return [(fields[3*i], fields[3*i + 1], fields[3*i + 2]) for i in range(n_entries)]
+    return [(fields[4*i], parse_mtime(fields[4*i + 1], fields[4*i + 2]), int(fields[4*i + 3]))
+            for i in range(n_entries)]
+
+
+def recv_exact(sock, size):
+    """ Reads exactly size bytes, or fewer if the connection closes first """
+
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            return bytes(data[:received])
+        received += n
+    return bytes(data)
+
+
+def encode_frame(command, fields=(), request_id=0):
+    """ A frame, as bytes """
+
+    parts = []
+    for field in fields:
+        if isinstance(field, int):
+            parts += [b"i", _INT.pack(field)]
+        else:
+            tag = b"b"
+            if isinstance(field, str):
+                field, tag = field.encode(), b"s"
+            parts += [tag, _LENGTH.pack(len(field)), field]
+    payload = b"".join(parts)
+    return _HEADER.pack(len(payload), command.encode(), request_id, len(fields)) + payload
+
+
+def send_frame(sock, command, fields=(), request_id=0):
+    """ Sends a frame """
+    sock.sendall(encode_frame(command, fields, request_id))
+
+
+def recv_frame(sock):
+    """ Reads a frame, returns (command, fields, request_id)
+
+    Returns None if the connection closed; raises ConnectionError for a
+    frame cut short or malformed.
+    """
+
+    header = recv_exact(sock, _HEADER.size)
+    if not header:
+        return None
+    if len(header) < _HEADER.size:
+        raise ConnectionError("Frame header cut short")
+    length, command, request_id, n_fields = _HEADER.unpack(header)
+    if length > MAX_FRAME:
+        raise ConnectionError("Frame of {} bytes is too large".format(length))
+    payload = recv_exact(sock, length)
+    if len(payload) < length:
+        raise ConnectionError("Frame cut short")
+
+    fields = []
+    offset = 0
+    try:
+        for _i in range(n_fields):
+            tag = payload[offset:offset + 1]
+            offset += 1
+            if tag == b"i":
+                fields.append(_INT.unpack_from(payload, offset)[0])
+                offset += _INT.size
+                continue
+            size = _LENGTH.unpack_from(payload, offset)[0]
+            offset += _LENGTH.size
+            value = payload[offset:offset + size]
+            offset += size
+            fields.append(value.decode() if tag == b"s" else value)
+    except (struct.error, UnicodeDecodeError) as error:
+        raise ConnectionError("Malformed frame: {}".format(error))
+    return command.decode("ascii", "replace"), fields, request_id
+
+
+def send_chunked(sock, command, head, entries, tail=(), request_id=0):
+    """ Sends a message with many file entries as several frames
+
+    Each frame has the head fields, a number of entries and those entries
+    (tuples of fields), of about CHUNK_BYTES (and MAX_FIELDS fields) at
+    most; the last one, the end marker, has no entries but the tail fields.
+    entries may be a generator: only a chunk is held at a time. Returns the
+    number of entries sent.
+    """
+
+    chunk, chunk_bytes, sent = [], 0, 0
+    for entry in entries:
+        chunk.append(entry)
+        chunk_bytes += sum(len(str(field)) + 9 for field in entry)
+        if (chunk_bytes >= CHUNK_BYTES
+                or len(head) + 1 + (len(chunk) + 1) * len(entry) > MAX_FIELDS):
+            send_frame(sock, command, [*head, len(chunk), *(field for entry in chunk
+                                                            for field in entry)], request_id)
+            sent += len(chunk)
+            chunk, chunk_bytes = [], 0
+
+    if chunk:
+        send_frame(sock, command, [*head, len(chunk), *(field for entry in chunk
+                                                        for field in entry)], request_id)
+        sent += len(chunk)
+    send_frame(sock, command, [*head, 0, *tail], request_id)
+    return sent
+
+
+def recv_chunked(sock, command, fields, n_head, width):
+    """ Reads the rest of a message sent with send_chunked
+
+    fields are those of its first frame, with n_head head fields and
+    entries of width fields. Returns the fields of the message as if sent
+    in a single frame: the head, the number of entries, the entries and the
+    tail. Raises ConnectionError if the frames are cut short or malformed.
+    """
+
+    head, entries = fields[:n_head], []
+    while True:
+        if len(fields) <= n_head or not isinstance(fields[n_head], int) or fields[n_head] < 0:
+            raise ConnectionError("Malformed {} chunk".format(command))
+        n_entries = fields[n_head]
+        if n_entries == 0:
+            return [*head, len(entries) // width, *entries, *fields[n_head + 1:]]
+        entries += fields[n_head + 1:n_head + 1 + width * n_entries]
+
+        message = recv_frame(sock)
+        if message is None or message[0] != command or message[1][:n_head] != head:
+            raise ConnectionError("{} cut short".format(command))
+        fields = message[1]
+
+
+def read_message(sock, version):
+    """ Reads a message, returns (command, fields, request_id), None at the end
+
+    In text the fields are all strings; the request id is always 0.
+    """
+
+    if version >= 2:
+        return recv_frame(sock)
+    line = read_bytes_until(sock, "\n")
+    if line == "":
+        return None
+    command, *fields = line.split(" ")
+    return command, fields, 0
+
+
+def send_message(sock, version, message, request_id=0):
+    """ Sends a message, a list of the command and its fields """
+
+    if version >= 2:
+        send_frame(sock, message[0], message[1:], request_id)
+    else:
+        sock.sendall((" ".join(str(field) for field in message) + "\n").encode())
+
+
+def offer_version(sock, message, capabilities=()):
+    """ Client side: sends "VER 2" (and capabilities) and message (an AUT) in text
+
+    Returns (reply to VER, reply to message); the version is 2 if the
+    first is ["VER", "2"]. A server that refuses the session (BSY) sends
+    nothing else, and the second is None.
+    """
+
+    offer = [str(PROTOCOL_VERSION), *capabilities]
+    sock.sendall("VER {}\n".format(" ".join(offer)).encode())
+    send_message(sock, 1, message)
+
+    first = read_bytes_until(sock, "\n").split(" ")
+    if first[0] == "BSY":
+        return first, None
+    if first[0] == "ERR":
+        for _field in offer:
+            read_bytes_until(sock, "\n") # older servers answer ERR to "VER" and to each field
+    return first, read_bytes_until(sock, "\n").split(" ")
+
+
+def negotiated(reply):
+    """ Client side: the version agreed, from the server's reply to VER
+
+    Capabilities the server takes up (CHUNKED) may follow the version.
+    """
+
+    if len(reply) >= 2 and reply[0] == "VER" and reply[1].isdigit():
+        return min(int(reply[1]), PROTOCOL_VERSION)
+    return 1
+
+
+def read_reply(sock, version):
+    """ Client side: reads a reply, as [command, fields...]
+
+    Returns [""] if the connection closed before the reply.
+    """
+
+    reply = read_message(sock, version)
+    return [reply[0], *reply[1]] if reply else [""]
+
+
+def request(sock, version, message, request_id=0):
+    """ Client side: sends message, returns the reply (see read_reply) """
+
+    send_message(sock, version, message, request_id)
+    return read_reply(sock, version)
+
+
+def accept_version(fields):
+    """ Server side: the version to use for a "VER" request with fields """
+    return PROTOCOL_VERSION if str(PROTOCOL_VERSION) in fields else 1
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Storage quotas of the users of the Backup Server.
+
+    The bytes each user stores on the BS (the sizes in the indexes of their
+    folders; snapshots are not counted) are kept in a table shared by all
+    the processes of the BS, updated as uploads are accepted and folders
+    deleted, so that checking a quota never walks any folder. The table is
+    saved to BS_USAGE_SAVEFILE after every change, and rebuilt from the
+    indexes only when there is no saved table.
+
+    Uploads take the size of each file (less that of the file it replaces)
+    from the quota before receiving it. Not to go to the shared table for
+    every file, they reserve RESERVE_STEP bytes at a time (or just what
+    they need, near the quota), and give back what they did not use when
+    they end.
+"""
+
+import os
+from contextlib import contextmanager
+from multiprocessing import Lock
+from pickle import UnpicklingError
+from lib.storage import load_index
+from lib.utils import BS_USAGE_SAVEFILE, backup_dict_to_file, restore_dict_from_file
+
+
+RESERVE_STEP = 64 * 1024 * 1024
+
+_quota = None               # (quota, shared {user: bytes}, lock)
+
+
+def init_quota(quota, usage):
+    """ Sets the quota of every user (bytes, 0 for none), before forking
+
+    usage is the shared {user: bytes} table, see load_usage.
+    """
+
+    global _quota
+    _quota = (quota, usage, Lock())
+
+
+def folder_usage(dirpath):
+    """ Bytes stored in a folder, from its index """
+    return sum(entry[1] for entry in load_index(dirpath).values())
+
+
+def load_usage(users, usage_file=BS_USAGE_SAVEFILE):
+    """ {user: bytes} saved in usage_file, or else added up from the folders of users """
+
+    try:
+        return restore_dict_from_file(usage_file)
+    except (OSError, EOFError, UnpicklingError):
+        pass
+
+    usage = {}
+    for user in users:
+        if os.path.isdir(user):
+            usage[user] = sum(folder_usage(folder.path) for folder in os.scandir(user)
+                              if folder.is_dir())
+    return usage
+
+
+def user_usage(user):
+    """ (bytes stored, quota) of user """
+
+    quota, usage, _lock = _quota
+    return usage.get(user, 0), quota
+
+
+def reserve(user, wanted, least):
+    """ Adds up to wanted bytes, but at least least, to the usage of user
+
+    Returns the bytes added, 0 if not even least fit in the quota.
+    """
+
+    quota, usage, lock = _quota
+    with lock:
+        used = usage.get(user, 0)
+        granted = min(wanted, quota - used) if quota else wanted
+        if granted < least:
+            return 0
+        usage[user] = used + granted
+        return granted
+
+
+def release(user, nbytes, forget=False):
+    """ Takes nbytes from the usage of user (or forgets the user), and saves it """
+
+    _limit, usage, lock = _quota
+    with lock:
+        if forget:
+            usage.pop(user, None)
+        else:
+            usage[user] = max(0, usage.get(user, 0) - nbytes)
+        backup_dict_to_file(usage, BS_USAGE_SAVEFILE)
+
+
+@contextmanager
+def account(user):
+    """ Accounts the files of an upload of user
+
+    Yields charge(nbytes), which takes nbytes from the quota (negative to
+    give them back) and returns False, taking nothing, if they do not fit.
+    """
+
+    credit = 0          # reserved and not used yet
+
+    def charge(nbytes):
+        nonlocal credit
+        if nbytes > credit:
+            missing = nbytes - credit
+            granted = reserve(user, max(missing, RESERVE_STEP), missing)
+            if not granted:
+                return False
+            credit += granted
+        credit -= nbytes
+        return True
+
+    try:
+        yield charge
+    finally:
+        release(user, credit)
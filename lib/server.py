@@ -26,9 +26,9 @@ def tcp_client(host, port, timeout=5):
     return sock
 
 
-def tcp_server(host, port, timeout=None):
+def tcp_server(host, port, timeout=None, backlog=128):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     sock.settimeout(timeout)
     sock.bind((host, port))
-    sock.listen()
+    sock.listen(backlog)
     return sock
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Point-in-time snapshots of the user folders kept by the Backup Server.
+
+    A snapshot is a folder of its own, .bs_snap/<id> inside the user folder,
+    with a copy of the index and hardlinks to the files and pack segments
+    of the folder at the time it was taken. Uploads never write to a file
+    in place (they rename new files over old ones, or append to segments),
+    so unchanged files are shared and a snapshot only costs its links.
+
+    Snapshot ids are the UTC time they were taken, as YYYYMMDDHHMMSS, so
+    they sort by age; asking for the folder as of some time gets the newest
+    snapshot taken at or before it.
+
+    Snapshots also move along with their folder to another BS (see
+    BS.migrate_folder). There, a snapshot starts as links to the files the
+    folder already has (link_folder), and only the files that differ are
+    sent.
+"""
+
+import os
+from shutil import rmtree
+from time import time, strftime, strptime, gmtime
+from calendar import timegm
+from lib.storage import (INTERNAL_PREFIX, folder_lock, read_index, save_index,
+                         index_version, is_packed, forget_folder)
+from lib.packfile import list_segments, segment_path
+
+
+SNAPSHOT_DIR = INTERNAL_PREFIX + "snap"
+SNAPSHOT_ID_FORMAT = "%Y%m%d%H%M%S"
+SNAPSHOT_INTERVAL = 3600        # at most one snapshot per folder per hour
+SNAPSHOT_KEEP = 24              # default number of snapshots kept per folder
+
+
+def is_snapshot_id(snap_id):
+    """ True for strings shaped like snapshot ids """
+    return len(snap_id) == 14 and snap_id.isdigit()
+
+
+def snapshot_path(dirpath, snap_id):
+    """ Path of a snapshot of a folder """
+    return os.path.join(dirpath, SNAPSHOT_DIR, snap_id)
+
+
+def list_snapshots(dirpath):
+    """ Returns the ids of the snapshots of a folder, oldest first """
+
+    try:
+        return sorted(name for name in os.listdir(os.path.join(dirpath, SNAPSHOT_DIR))
+                      if is_snapshot_id(name))
+    except FileNotFoundError:
+        return []
+
+
+def find_snapshot(dirpath, as_of):
+    """ Path of the newest snapshot taken at or before as_of, or None """
+
+    if not is_snapshot_id(as_of):
+        return None
+    older = [snap_id for snap_id in list_snapshots(dirpath) if snap_id <= as_of]
+    return snapshot_path(dirpath, older[-1]) if older else None
+
+
+def take_snapshot(dirpath, min_interval=SNAPSHOT_INTERVAL):
+    """ Snapshots a folder, unless it did not change since the last one
+
+    No snapshot is taken either if the last one is less than min_interval
+    seconds old. Returns the id of the new snapshot, or None.
+    """
+
+    now = time()
+    version = index_version(dirpath)
+    if version is None:
+        return None # nothing stored yet
+
+    snapshots = list_snapshots(dirpath)
+    snap_id = strftime(SNAPSHOT_ID_FORMAT, gmtime(now))
+    if snapshots:
+        last = timegm(strptime(snapshots[-1], SNAPSHOT_ID_FORMAT))
+        if now - last < min_interval or version[1] / 1e9 < last or snap_id <= snapshots[-1]:
+            return None
+
+    tmp_path = os.path.join(dirpath, SNAPSHOT_DIR, "tmp." + snap_id)
+    try:
+        os.makedirs(tmp_path)
+    except FileExistsError:
+        return None # another upload is taking it
+
+    try:
+        index = link_folder(dirpath, tmp_path)
+        if index is None:
+            rmtree(tmp_path)
+            return None
+        save_index(tmp_path, index)
+    except BaseException:
+        rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    os.rename(tmp_path, snapshot_path(dirpath, snap_id))
+    return snap_id
+
+
+def link_folder(dirpath, target):
+    """ Hardlinks the files and pack segments of a folder into target
+
+    Returns the index of what was linked, or None if the folder has no
+    index. The index is not saved in target.
+    """
+
+    with folder_lock(dirpath):
+        index = read_index(dirpath)
+        if index is None:
+            return None
+
+        for segment in list_segments(dirpath):
+            os.link(segment_path(dirpath, segment), segment_path(target, segment))
+
+        for relpath, entry in list(index.items()):
+            if is_packed(entry):
+                continue
+            linked = os.path.join(target, relpath)
+            os.makedirs(os.path.dirname(linked), exist_ok=True)
+            try:
+                os.link(os.path.join(dirpath, relpath), linked)
+            except FileNotFoundError:
+                del index[relpath]
+                continue
+
+            # Another upload may have replaced it since the index was saved,
+            # then its digest is not known
+            f_stat = os.stat(linked)
+            if tuple(entry[:2]) != (int(f_stat.st_mtime), f_stat.st_size):
+                index[relpath] = (int(f_stat.st_mtime), f_stat.st_size)
+    return index
+
+
+def prune_snapshots(dirpath, keep):
+    """ Removes all but the newest keep snapshots of a folder
+
+    Returns the ids of the snapshots removed.
+    """
+
+    snapshots = list_snapshots(dirpath)
+    pruned = snapshots[:max(0, len(snapshots) - keep)]
+    for snap_id in pruned:
+        rmtree(snapshot_path(dirpath, snap_id), ignore_errors=True)
+        forget_folder(snapshot_path(dirpath, snap_id))
+    return pruned
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" On-disk layout of the user folders kept by the Backup Server.
+
+    Each folder has a metadata index, {"filename": (mtime, size)}, pickled
+    in the folder itself (entries of files kept by the packfile engine also
+    say where they are, see lib/packfile.py). Uploads update it incrementally, so listing a
+    folder never needs to stat its files. Files received since there are
+    checksums have entries (mtime, size, segment, offset, digest), with
+    segment and offset None if the file is not packed (see lib/checksum.py). Files used by the BS itself have
+    names starting with INTERNAL_PREFIX, which users cannot upload.
+
+    Uploads hold a shared lock of the folder's MOVE_LOCK file, which a
+    migration to another BS takes exclusively for its last pass (see
+    upload_lock and move_lock); once moved, the file says so, and the
+    folder takes no more uploads.
+
+    Files are received into temporary files and renamed into place once
+    complete, so a crash never leaves a torn file behind. How much of that
+    is also fsynced to disk depends on the durability level:
+        "none":    nothing is fsynced (fastest, may lose recent uploads)
+        "session": fsyncs are grouped, at most every GROUP_COMMIT_FILES
+                   files or GROUP_COMMIT_SECONDS, and at the end of a UPL
+        "file":    every file is fsynced before the next one is received
+"""
+
+import os
+from fcntl import flock, LOCK_EX, LOCK_SH, LOCK_NB, LOCK_UN
+from contextlib import contextmanager
+from pickle import load, dump, UnpicklingError
+from time import strftime, gmtime, time, monotonic
+from secrets import token_hex
+
+
+INTERNAL_PREFIX = ".bs_"
+INDEX_FILE = INTERNAL_PREFIX + "index"
+TEMP_PREFIX = INTERNAL_PREFIX + "tmp."
+TRASH_DIR = INTERNAL_PREFIX + "trash"   # removed folders, until reclaimed
+MOVE_LOCK = INTERNAL_PREFIX + "move"    # locked by uploads and migrations
+
+DURABILITY_LEVELS = ("none", "session", "file")
+GROUP_COMMIT_FILES = 256        # also bounds the temp files kept open
+GROUP_COMMIT_SECONDS = 1
+TEMP_MAX_AGE = 3600             # older temp files are left by crashed uploads
+
+# {dirpath: ((index inode, index mtime), n_files, listing)}, per process
+_listing_cache = {}
+
+
+def is_packed(entry):
+    """ True for index entries of files stored in a pack segment """
+    return len(entry) > 2 and entry[2] is not None
+
+
+def entry_digest(entry):
+    """ Hex digest of the contents of the file of an index entry, or None """
+    return entry[4] if len(entry) > 4 else None
+
+
+def is_internal(filename):
+    """ True for files (or paths) that belong to the BS and not to the user """
+    return any(part.startswith(INTERNAL_PREFIX) for part in filename.split("/"))
+
+
+@contextmanager
+def folder_lock(dirpath):
+    """ Exclusive lock over a folder, across processes """
+
+    dirfd = os.open(dirpath, os.O_RDONLY)
+    try:
+        flock(dirfd, LOCK_EX)
+        yield
+    finally:
+        flock(dirfd, LOCK_UN)
+        os.close(dirfd)
+
+
+@contextmanager
+def upload_lock(dirpath):
+    """ Shared lock of the uploads to a folder, across processes
+
+    Yields False, without waiting, if the folder is being moved to another
+    BS (or was already): the upload must then leave it as it is.
+    """
+
+    fd = os.open(os.path.join(dirpath, MOVE_LOCK), os.O_RDWR | os.O_CREAT, 0o660)
+    try:
+        try:
+            flock(fd, LOCK_SH | LOCK_NB)
+        except BlockingIOError:
+            yield False
+        else:
+            yield os.fstat(fd).st_size == 0
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def move_lock(dirpath):
+    """ Exclusive lock of a migration over the uploads to a folder
+
+    Waits for the uploads going on, and makes new ones give up. Yields
+    mark_moved(), which keeps uploads away even after the lock is released.
+    """
+
+    fd = os.open(os.path.join(dirpath, MOVE_LOCK), os.O_RDWR | os.O_CREAT, 0o660)
+    try:
+        flock(fd, LOCK_EX)
+        yield lambda: os.write(fd, b"moved")
+    finally:
+        os.close(fd)
+
+
+def scan_index(dirpath):
+    """ Builds the index of a folder from its files (stat of each one)
+
+    Files in subfolders are indexed by their path relative to the folder.
+    """
+
+    index = {}
+    for root, dirs, files in os.walk(dirpath):
+        dirs[:] = [name for name in dirs if not is_internal(name)]
+        relroot = os.path.relpath(root, dirpath)
+        for name in files:
+            path = os.path.join(root, name)
+            if not is_internal(name) and os.path.isfile(path):
+                f_stat = os.stat(path)
+                relpath = name if relroot == "." else relroot + "/" + name
+                index[relpath] = (int(f_stat.st_mtime), f_stat.st_size)
+    return index
+
+
+def fsync_dir(dirpath):
+    """ Makes the entries (creations, renames) of a directory durable """
+
+    dirfd = os.open(dirpath, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
+def save_index(dirpath, index, durable=False):
+    """ Atomically replaces the index of a folder """
+
+    tmp_path = os.path.join(dirpath, INDEX_FILE + ".tmp")
+    with open(tmp_path, "wb") as savefile:
+        dump(index, savefile)
+        if durable:
+            savefile.flush()
+            os.fsync(savefile.fileno())
+    os.replace(tmp_path, os.path.join(dirpath, INDEX_FILE))
+    if durable:
+        fsync_dir(dirpath)
+
+
+def read_index(dirpath):
+    """ Returns the saved index of a folder, or None if it has none """
+
+    try:
+        with open(os.path.join(dirpath, INDEX_FILE), "rb") as savefile:
+            return load(savefile)
+    except (FileNotFoundError, EOFError, UnpicklingError):
+        return None
+
+
+def load_index(dirpath):
+    """ Returns the index of a folder, building it if it has none yet """
+
+    index = read_index(dirpath)
+    if index is None:
+        # Folder stored before there were indexes (or a torn index)
+        with folder_lock(dirpath):
+            index = scan_index(dirpath)
+            save_index(dirpath, index)
+    return index
+
+
+def update_index(dirpath, entries, durable=False):
+    """ Adds or replaces {"filename": (mtime, size)} entries of the index
+
+    A loose file replaced by a packed one is removed.
+    """
+
+    with folder_lock(dirpath):
+        index = read_index(dirpath)
+        if index is None:
+            index = scan_index(dirpath)
+
+        replaced_loose = [filename for filename, entry in entries.items()
+                          if is_packed(entry) and filename in index
+                          and not is_packed(index[filename])]
+
+        index.update(entries)
+        save_index(dirpath, index, durable)
+
+        for filename in replaced_loose:
+            try:
+                os.remove(os.path.join(dirpath, filename))
+            except FileNotFoundError:
+                pass
+
+
+def drop_entries(dirpath, entries):
+    """ Removes {"filename": entry} entries from the index, unless they changed
+
+    Returns the entries removed. Loose files are left where they are, for
+    the next upload of the same name to replace.
+    """
+
+    with folder_lock(dirpath):
+        index = read_index(dirpath)
+        if index is None:
+            return {}
+
+        dropped = {filename: entry for filename, entry in entries.items()
+                   if index.get(filename) == entry}
+        for filename in dropped:
+            del index[filename]
+        if dropped:
+            save_index(dirpath, index, durable=True)
+    return dropped
+
+
+def write_temp(dirpath, chunks, size, mtime):
+    """ Writes the chunks of a file to a new temporary file of a folder
+
+    Returns (fd, temp_path) with the fd still open, for commit_files, or
+    None (and no temp file) if fewer than size bytes arrived.
+    """
+
+    tmp_path = os.path.join(dirpath, TEMP_PREFIX + token_hex(8))
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, mode=0o660)
+    try:
+        written = 0
+        for data in chunks:
+            if not data:
+                break # peer went away
+            os.write(fd, data)
+            written += len(data)
+
+        if written == size:
+            # Set mtime to the sent one (and atime to now)
+            os.utime(fd, times=(time(), mtime))
+            return fd, tmp_path
+    except BaseException:
+        discard_temp(fd, tmp_path)
+        raise
+
+    discard_temp(fd, tmp_path)
+    return None
+
+
+def discard_temp(fd, tmp_path):
+    """ Closes and removes a temporary file """
+    os.close(fd)
+    os.remove(tmp_path)
+
+
+def commit_due(durability, n_pending, since):
+    """ True when written files should be committed now
+
+    n_pending is how many were written since the last commit, at since
+    (a monotonic() time).
+    """
+
+    if durability != "session":
+        return True
+    return (n_pending >= GROUP_COMMIT_FILES
+            or monotonic() - since >= GROUP_COMMIT_SECONDS)
+
+
+def commit_files(dirpath, pending, segment_fd, durability):
+    """ Moves written files into place, with a single round of fsyncs
+
+    pending is a list of (fd, temp_path, final_path), emptied here;
+    segment_fd the pack segment appended to since the last commit, if any.
+    """
+
+    durable = durability != "none"
+
+    # Every directory that got new entries, up to the folder itself
+    touched = {dirpath}
+    for _fd, _tmp_path, final_path in pending:
+        parent = os.path.dirname(final_path)
+        while parent not in touched and len(parent) > len(dirpath):
+            touched.add(parent)
+            parent = os.path.dirname(parent)
+
+    try:
+        if durable:
+            for fd, _tmp_path, _final_path in pending:
+                os.fsync(fd)
+            if segment_fd is not None:
+                os.fsync(segment_fd)
+
+        while pending:
+            fd, tmp_path, final_path = pending.pop(0)
+            os.close(fd)
+            os.replace(tmp_path, final_path)
+    finally:
+        # Only left if something failed
+        for fd, tmp_path, _final_path in pending:
+            discard_temp(fd, tmp_path)
+        pending.clear()
+
+    if durable:
+        for directory in touched:
+            fsync_dir(directory)
+
+
+def remove_stale_temps(dirpath):
+    """ Removes temporary files of a folder older than TEMP_MAX_AGE
+
+    Goes by ctime, as the mtime of a temp file is the one sent by the user.
+    """
+
+    limit = time() - TEMP_MAX_AGE
+    for entry in os.scandir(dirpath):
+        if entry.name.startswith(TEMP_PREFIX):
+            try:
+                if entry.stat().st_ctime < limit:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def format_listing(index, digests=False):
+    """ Returns the " filename date time size" listing of an index
+
+    With digests, each file also has its digest (or "-").
+    """
+
+    if digests:
+        return "".join(" {} {} {} {}".format(filename,
+                                             strftime("%d.%m.%Y %H:%M:%S", gmtime(entry[0])),
+                                             entry[1], entry_digest(entry) or "-")
+                       for filename, entry in index.items())
+    return "".join(" {} {} {}".format(filename,
+                                      strftime("%d.%m.%Y %H:%M:%S", gmtime(entry[0])),
+                                      entry[1])
+                   for filename, entry in index.items())
+
+
+def index_version(dirpath):
+    """ Identifies the current index file of a folder (None if missing) """
+
+    try:
+        i_stat = os.stat(os.path.join(dirpath, INDEX_FILE))
+    except FileNotFoundError:
+        return None
+    return (i_stat.st_ino, i_stat.st_mtime_ns)
+
+
+def cached_listing(dirpath):
+    """ Returns (n_files, listing) of a folder, formatted at most once
+
+    The listing is kept in memory until the index of the folder changes,
+    which costs a single stat per call.
+    """
+
+    version = index_version(dirpath)
+    if version is None:
+        load_index(dirpath)
+        version = index_version(dirpath)
+
+    # Taken before loading: if the index changes meanwhile, next call reloads
+    cached = _listing_cache.get(dirpath)
+    if cached is None or cached[0] != version:
+        index = load_index(dirpath)
+        cached = (version, len(index), format_listing(index))
+        _listing_cache[dirpath] = cached
+
+    return cached[1], cached[2]
+
+
+def trash_folder(dirpath, owner=None):
+    """ Removes a folder at once, by moving it into TRASH_DIR
+
+    The rename is atomic, and waits for whoever holds the lock of the
+    folder (an upload committing, a restore, the compactor). Its files are
+    left for reclaim_trash to remove. With owner, its name in the trash
+    says so, for the space it took to be given back later (see
+    unaccounted_trash).
+    """
+
+    name = token_hex(8) if owner is None else "{}.{}".format(token_hex(8), owner)
+    os.makedirs(TRASH_DIR, exist_ok=True)
+    with folder_lock(dirpath):
+        os.rename(dirpath, os.path.join(TRASH_DIR, name))
+    forget_folder(dirpath)
+
+
+def unaccounted_trash():
+    """ Yields (owner, bytes) of each folder trashed with an owner
+
+    The bytes are those of its files, as they would be indexed (the folders
+    trashed so have no index). The owner is then dropped from its name.
+    """
+
+    if not os.path.isdir(TRASH_DIR):
+        return
+
+    for folder in os.scandir(TRASH_DIR):
+        token, _dot, owner = folder.name.partition(".")
+        if owner:
+            nbytes = sum(entry[1] for entry in scan_index(folder.path).values())
+            os.rename(folder.path, os.path.join(TRASH_DIR, token))
+            yield owner, nbytes
+
+
+def reclaim_trash(pace):
+    """ Removes the folders in TRASH_DIR, calling pace() after every file
+
+    Returns the number of files removed.
+    """
+
+    if not os.path.isdir(TRASH_DIR):
+        return 0
+
+    removed = 0
+    for folder in os.scandir(TRASH_DIR):
+        for root, dirs, files in os.walk(folder.path, topdown=False):
+            for name in files:
+                os.remove(os.path.join(root, name))
+                removed += 1
+                pace()
+            for name in dirs:
+                path = os.path.join(root, name)
+                if os.path.islink(path):
+                    os.remove(path)
+                else:
+                    os.rmdir(path)
+        os.rmdir(folder.path)
+    return removed
+
+
+def forget_folder(dirpath):
+    """ Drops the cached listings of a removed folder (and of its snapshots) """
+
+    for cached in [path for path in _listing_cache
+                   if path == dirpath or path.startswith(dirpath + os.sep)]:
+        del _listing_cache[cached]
@@ -4,17 +4,22 @@
 
 from os import read
 from socket import timeout, gethostname, gethostbyname_ex
-from ipaddress import IPv4Address
 from signal import signal, SIGINT, SIG_IGN
 from pickle import load, dump
+from lib.log import log, INFO
 
 DEFAULT_CS_PORT = 58028
 DEFAULT_BS_PORT = 59000
 
+BS_REPORT_INTERVAL = 10     # seconds between load reports (STS) of a BS
+BS_HEARTBEAT_INTERVAL = 2   # seconds between heartbeats (HBT) of a BS
+
 BS_USER_SAVEFILE = "./BS_users.pickle"
+BS_USAGE_SAVEFILE = "./BS_usage.pickle"
 CS_KNOWN_BS_SAVEFILE = "./CS_known_bs.pickle"
 CS_VALID_USERS_SAVEFILE = "./CS_valid_users.pickle"
 CS_DIRS_LOCATION_SAVEFILE = "./CS_dirs_location.pickle"
+CS_DIRS_DELETED_SAVEFILE = "./CS_dirs_deleted.pickle"
 
 
 def read_bytes_until(conn, separators=" "):
@@ -36,6 +41,11 @@ def read_bytes_until(conn, separators=" "):
         print("read_bytes_until: Already had \"{}\"".format(res))
         raise
 
+def is_safe_path(relpath):
+    """ True for relative paths ("dir/file") that stay inside their folder """
+    return all(part not in ("", ".", "..") for part in relpath.split("/"))
+
+
 def chunked_read_fd(filefd, size_to_read, chunk_size=1024):
     """ Iterates over file, returns chunks
 
@@ -83,12 +93,18 @@ def restore_dict_from_file(pickle_file):
         return load(savefile)
 
 
-def print_connection_event(address, message, other, direction="->"):
-    print("{} {}: {} {}".format(direction, address, message.ljust(34), "[{}]".format(other)))
+def print_connection_event(address, message, other, direction="->", level=INFO):
+    log(level, message, address=address, args=other, direction=direction)
 
 
 def get_best_ip():
-    """ Best IP: Public if possible """
+    """ Best IP: Public if possible
+
+    Resolves the host name, which may block for long on hosts with a poor
+    resolver; the servers skip it when given their address (-a).
+    """
+
+    from ipaddress import IPv4Address # only needed here
 
     candidate_IPs = gethostbyname_ex(gethostname())[2]
 
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Moving a folder between BSs keeps its snapshots.
+
+    Starts a CS and two BSs on this machine (as bench/cluster.py does),
+    backs up a directory twice with user.py, so that its BS takes a
+    snapshot, and then, as the CS would when rebalancing, has that BS move
+    the folder to the other one (MIG). The snapshot restored from the
+    other BS must be the directory as of the first backup.
+
+    Usage (from the project root):
+        python3 -m unittest tests.test_migration
+"""
+
+import os
+import sys
+import socket
+import subprocess
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from bench.cluster import ROOT, free_port, wait_for_port, start_server, stop_server
+from lib.protocol import offer_version, negotiated, request
+
+
+HOST = "127.0.0.1"
+USER, PASSWORD = "12345", "abcdefgh"
+
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = mkdtemp(prefix="test_migration.")
+        self.servers = []
+        cs_port = free_port(HOST)
+        self.cs_port = cs_port
+        self.start("CS.py", ["-a", HOST, "-p", str(cs_port)], "cs")
+        wait_for_port(HOST, cs_port)
+
+        self.bs_ports = []
+        for i in range(2):
+            bs_port = free_port(HOST)
+            self.start("BS.py", ["-a", HOST, "-n", HOST, "-p", str(cs_port),
+                                 "-b", str(bs_port), "-e", "pack"], "bs{}".format(i))
+            wait_for_port(HOST, bs_port)
+            self.bs_ports.append(bs_port)
+
+
+    def tearDown(self):
+        for server in self.servers:
+            stop_server(server)
+        rmtree(self.workdir, ignore_errors=True)
+
+
+    def start(self, program, args, name):
+        """ Starts a server in a directory of its own """
+
+        workdir = os.path.join(self.workdir, name)
+        os.mkdir(workdir)
+        self.servers.append(start_server(program, args, workdir))
+
+
+    def user(self, workdir, commands):
+        """ Runs user.py in workdir, logged in, with commands """
+
+        script = "login {} {}\n{}\nexit\n".format(USER, PASSWORD, "\n".join(commands))
+        subprocess.run([sys.executable, os.path.join(ROOT, "user.py"), "-n", HOST,
+                        "-p", str(self.cs_port)],
+                       input=script.encode(), cwd=workdir, timeout=60, check=True,
+                       stdout=subprocess.DEVNULL)
+
+
+    def test_snapshots_move_with_folder(self):
+        client = os.path.join(self.workdir, "client")
+        folder = os.path.join(client, "d")
+        os.makedirs(folder)
+        first = {"small": os.urandom(1000), "big": os.urandom(300000)}
+        for name, data in first.items():
+            with open(os.path.join(folder, name), "wb") as f:
+                f.write(data)
+        self.user(client, ["backup d"])
+
+        with open(os.path.join(folder, "small"), "wb") as f:
+            f.write(os.urandom(2000))
+        with open(os.path.join(folder, "new"), "wb") as f:
+            f.write(os.urandom(500))
+        os.utime(os.path.join(folder, "small"), (0, 1))
+        self.user(client, ["backup d"])
+
+        src, dst = (self.bs_ports if os.path.isdir(os.path.join(self.workdir, "bs0", USER, "d"))
+                    else self.bs_ports[::-1])
+        src_dir = os.path.join(self.workdir, "bs{}".format(self.bs_ports.index(src)), USER, "d")
+        snapshots = os.listdir(os.path.join(src_dir, ".bs_snap"))
+        self.assertEqual(len(snapshots), 1)
+
+        # As the CS: register the user in dst, and move the folder there
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as udp:
+            udp.settimeout(5)
+            udp.sendto("LSU {} {}\n".format(USER, PASSWORD).encode(), (HOST, dst))
+            self.assertEqual(udp.recv(64), b"LUR OK\n")
+        with socket.create_connection((HOST, src), timeout=30) as bs_socket:
+            first_reply, reply = offer_version(bs_socket, ["AUT", USER, PASSWORD])
+            self.assertEqual(reply, ["AUR", "OK"])
+            reply = request(bs_socket, negotiated(first_reply), ["MIG", "d", HOST, dst, 0])
+        self.assertEqual(reply, ["MGR", "OK"])
+
+        restored = os.path.join(self.workdir, "restored")
+        os.mkdir(restored)
+        sys.path.insert(0, ROOT)
+        import user # deferred: it is a program, only needed here
+        cwd = os.getcwd()
+        os.chdir(restored)
+        try:
+            user.download_files((HOST, dst), USER, PASSWORD, "d", snapshots[0])
+        finally:
+            os.chdir(cwd)
+
+        self.assertEqual(sorted(os.listdir(os.path.join(restored, "d"))), sorted(first))
+        for name, data in first.items():
+            with open(os.path.join(restored, "d", name), "rb") as f:
+                self.assertEqual(f.read(), data)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# RC 2018/19 IST
+# Grupo 28
+""" Manifests sent in chunks (send_chunked/recv_chunked).
+
+    A manifest of more entries than fit in a single frame goes over a
+    socket pair, and must be read back as if sent in a single frame.
+
+    Usage (from the project root):
+        python3 -m unittest tests.test_protocol
+"""
+
+import socket
+import threading
+import unittest
+from lib.protocol import send_chunked, recv_chunked, send_frame, recv_frame, MAX_FIELDS
+
+
+class ChunkedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.sender, self.receiver = socket.socketpair()
+
+    def tearDown(self):
+        self.sender.close()
+        self.receiver.close()
+
+
+    def send(self, entries, tail=()):
+        """ Sends a BCK in chunks from another thread, returns the thread """
+
+        sender = threading.Thread(target=send_chunked,
+                                  args=(self.sender, "BCK", ["dir"], iter(entries), tail))
+        sender.start()
+        return sender
+
+
+    def test_many_entries(self):
+        entries = [("d{}/file{}".format(i // 1000, i), 1600000000 + i, i) for i in range(50000)]
+        self.assertGreater(3 * len(entries), MAX_FIELDS)
+
+        sender = self.send(entries, ("tail", 7))
+        command, fields, _request_id = recv_frame(self.receiver)
+        self.assertEqual(command, "BCK")
+        message = recv_chunked(self.receiver, "BCK", fields, 1, 3)
+        sender.join()
+
+        self.assertEqual(message[:2], ["dir", len(entries)])
+        self.assertEqual(message[2:2 + 3 * len(entries)],
+                         [field for entry in entries for field in entry])
+        self.assertEqual(message[2 + 3 * len(entries):], ["tail", 7])
+
+
+    def test_empty(self):
+        sender = self.send([])
+        _command, fields, _request_id = recv_frame(self.receiver)
+        sender.join()
+        self.assertEqual(recv_chunked(self.receiver, "BCK", fields, 1, 3), ["dir", 0])
+
+
+    def test_cut_short(self):
+        send_frame(self.sender, "BCK", ["dir", 1, "file", 0, 0])
+        self.sender.close()
+        _command, fields, _request_id = recv_frame(self.receiver)
+        with self.assertRaises(ConnectionError):
+            recv_chunked(self.receiver, "BCK", fields, 1, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
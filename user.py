@@ -1,34 +1,141 @@
 #!/usr/bin/env python3
 
 import sys, getopt, os
+from itertools import islice
+from select import select
 from socket import gethostname, gethostbyname, timeout
-from time import strptime, strftime, gmtime
+from random import uniform
+from time import strftime, gmtime, monotonic, sleep
 from calendar import timegm
 from lib.server import tcp_client
+from lib.inotify import (inotify_init, add_watch, read_events, IN_ATTRIB,
+                         IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_ONLYDIR,
+                         IN_ISDIR, IN_IGNORED, IN_Q_OVERFLOW)
+from lib.protocol import (offer_version, negotiated, request, read_reply, send_frame,
+                          recv_frame, send_chunked, recv_chunked, parse_entries, parse_mtime,
+                          format_mtime, entry_fields, REDIRECT, CHECKSUM, CHUNKED)
 from lib.utils import (read_bytes_until, chunked_read_socket, chunked_read_fd,
-                       get_best_ip)
+                       get_best_ip, is_safe_path)
 
 
-def authenticate(cs_socket, user, password):
+# Watch mode (--watch): push changes once there were none for WATCH_DEBOUNCE
+# seconds, or WATCH_MAX_DELAY seconds after the first one, whichever first
+WATCH_DEBOUNCE = 2
+WATCH_MAX_DELAY = 30
+WATCH_RETRY = 10        # seconds before retrying after a failed push
+WATCH_EVENTS = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+# A busy CS (BSY) is retried this many times, waiting at most BUSY_MAX_WAIT
+BUSY_RETRIES = 5
+BUSY_MAX_WAIT = 30
+
+# A CS node may redirect the session of a user to another one (the owner
+# of the user, in a cluster) this many times in a row, at most
+MAX_REDIRECTS = 2
+
+# Batch backups: files in a single BCM, BSs uploaded to at the same time
+BATCH_MAX_FILES = 100000
+BATCH_MAX_BS = 32
+
+cs_nodes = {}   # {(cs host, cs port, user): (host, port) of the node it redirected to}
+cs_granted = {} # {(cs host, cs port, user): capabilities the CS took up in its VER}
+
+
+def authenticate(bs_socket, user, password):
+    """ Authenticates a BS session (AUT/AUR), offering version 2 of the protocol
+
+    Checking the digests of restored files is offered too. Returns the
+    version agreed, or 0 if authentication failed.
+    """
 
     if(user=="" and password==""):
         print("You have to be logged in to use this command\n")
-        return False
+        return 0
 
-    cs_socket.sendall("AUT {} {}\n".format(user, password).encode())
+    first, response = offer_version(bs_socket, ["AUT", user, password], (CHECKSUM,))
+
+    if response != ["AUR", "OK"]:
+        print("Authentication failed\n")
+        bs_socket.close()
+        return 0
+
+    return negotiated(first)
+
+
+def connect_to_cs(host, port, user, password):
+    """ Opens a session with the CS, authenticating as user (AUT/AUR)
+
+    A CS too busy to take the session answers "BSY seconds" and closes it.
+    The session is then retried, after at least those seconds, doubling the
+    wait on every refusal, with random jitter so that the clients refused
+    together do not all come back together. Version 2 of the protocol is
+    offered along with the AUT, and so is following redirects: a CS node
+    that does not own the user answers "RDR ip port" instead of the AUR,
+    and the sessions of the user go to that node from then on. Listings
+    with the digests of the files, and sending manifests in chunks, are
+    asked for too. Returns
+    (socket, version, AUR reply), or (None, None, None) if the CS stayed
+    busy.
+    """
+
+    wait = 0
+    redirects = 0
+    attempt = 0
+    while attempt <= BUSY_RETRIES:
+        node = cs_nodes.get((host, port, user), (host, port))
+        try:
+            cs_socket = tcp_client(*node)
+        except OSError:
+            if node == (host, port):
+                raise
+            del cs_nodes[(host, port, user)] # node gone, ask again
+            continue
+
+        first, response = offer_version(cs_socket, ["AUT", user, password],
+                                        (REDIRECT, CHECKSUM, CHUNKED))
+        if response is not None and response[0] == REDIRECT and redirects < MAX_REDIRECTS:
+            cs_socket.close()
+            cs_nodes[(host, port, user)] = (response[1], int(response[2]))
+            redirects += 1
+            continue
+        if first[0] != "BSY":
+            cs_granted[(host, port, user)] = first[2:]
+            return cs_socket, negotiated(first), response
+
+        cs_socket.close()
+        attempt += 1
+        retry_after = first[1] if len(first) > 1 else ""
+        retry_after = int(retry_after) if retry_after.isdigit() else 1
+        wait = min(BUSY_MAX_WAIT, max(retry_after, 2 * wait))
+        sleep(uniform(wait, 1.5 * wait))
 
-    response = read_bytes_until(cs_socket, "\n")
+    print("The CS is busy, try again later\n")
+    return None, None, None
 
-    if response != "AUR OK":
+
+def cs_session(host, port, user, password):
+    """ Opens an authenticated session with the CS
+
+    Returns (socket, protocol version), or (None, None).
+    """
+
+    if(user=="" and password==""):
+        print("You have to be logged in to use this command\n")
+        return None, None
+
+    cs_socket, version, response = connect_to_cs(host, port, user, password)
+    if cs_socket is None:
+        return None, None
+
+    if response != ["AUR", "OK"]:
         print("Authentication failed\n")
         cs_socket.close()
-        return False
+        return None, None
 
-    return True
+    return cs_socket, version
 
-def login_user(args, host, port):
-    cs_socket = tcp_client(host, port)
 
+def login_user(args, host, port):
     if (len(args) != 2 or len(args[0]) != 5 or len(args[1]) != 8 or not args[0].isdigit()
             or not args[1].isalnum()):
 
@@ -38,16 +145,17 @@ def login_user(args, host, port):
     user = args[0]
     password = args[1]
 
-    cs_socket.sendall("AUT {} {}\n".format(user, password).encode())
-
-    response = read_bytes_until(cs_socket, "\n")
+    cs_socket, _version, response = connect_to_cs(host, port, user, password)
+    if cs_socket is None:
+        return "", ""
+    cs_socket.close()
 
-    if response == "AUR OK":
+    if response == ["AUR", "OK"]:
         print("Logged in successfully\n")
-    elif response == "AUR NOK":
+    elif response == ["AUR", "NOK"]:
         print("Incorrect password\n")
         user, password = "", ""
-    elif response == "AUR NEW":
+    elif response == ["AUR", "NEW"]:
         print("Logged in with a new user\n")
 
     return user, password
@@ -55,20 +163,17 @@ def login_user(args, host, port):
 
 
 def delete_user(host, port, user, password):
-    cs_socket = tcp_client(host, port)
-
-    if not authenticate(cs_socket, user, password):
+    cs_socket, version = cs_session(host, port, user, password)
+    if cs_socket is None:
         return user, password
 
-    cs_socket.sendall("DLU\n".encode())
-
-    response = read_bytes_until(cs_socket, "\n")
+    response = request(cs_socket, version, ["DLU"])
 
-    if response == "DLR OK":
+    if response == ["DLR", "OK"]:
         print("User was deleted\n")
         user, password = "", ""
 
-    elif response == "DLR NOK":
+    elif response == ["DLR", "NOK"]:
         print("User couldn't be deleted\n")
 
     cs_socket.close()
@@ -76,10 +181,40 @@ def delete_user(host, port, user, password):
     return user, password
 
 
+def walk_tree(directory, report_skipped=False):
+    """ Yields (relative path, stat) of every file under directory, lazily
+
+    Only the directories being walked are open at any time, so memory use
+    does not grow with the size of the tree. Symbolic links to directories
+    are not followed, and names with spaces (which the protocol cannot
+    carry) are skipped.
+    """
+
+    stack = [("", os.scandir(directory))]
+    while stack:
+        prefix, entries = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            entries.close()
+            stack.pop()
+        elif " " in entry.name:
+            if report_skipped:
+                print("Skipping {}{}: spaces are not allowed in names".format(prefix, entry.name))
+        elif entry.is_dir(follow_symlinks=False):
+            stack.append((prefix + entry.name + "/", os.scandir(entry.path)))
+        elif entry.is_file():
+            yield prefix + entry.name, entry.stat()
+
+
 def backup_dir(args, host, port, user, password):
-    cs_socket = tcp_client(host, port)
+    """ Backs up a directory (BCK/BKR, then UPL/UPR with the BSs)
+
+    Returns the shards of the directory, each a list of (ip, port) of its
+    replicas, or None if the backup could not be done.
+    """
 
-    if not authenticate(cs_socket, user, password):
+    cs_socket, version = cs_session(host, port, user, password)
+    if cs_socket is None:
         return
 
     # Validates the arguments for the function
@@ -96,151 +231,594 @@ def backup_dir(args, host, port, user, password):
         cs_socket.close()
         return
 
-    file_list = [f for f in os.scandir(directory) if f.is_file()]
+    # Send the files in the whole tree to the Central Server to check which
+    # ones should be backed up. In chunks, as the tree is walked, if the CS
+    # takes them; otherwise BCK starts with the number of files, so the
+    # tree is walked once to count them and again while sending them
+
+    if version >= 2 and CHUNKED in cs_granted.get((host, port, user), ()):
+        send_chunked(cs_socket, "BCK", [directory],
+                     ((relpath, int(f_stat.st_mtime), f_stat.st_size)
+                      for relpath, f_stat in walk_tree(directory, True)))
+        reply = read_reply(cs_socket, version)
+        if reply[0] == "BKR" and len(reply) > 3:
+            reply = ["BKR", *recv_chunked(cs_socket, "BKR", reply[1:], 2, 3)]
+        cs_socket.close()
+        return upload_backup(reply, version, user, password, directory)
+
+    n_local = sum(1 for _file in walk_tree(directory))
+    files = islice(walk_tree(directory, True), n_local)
 
-    if len(file_list) > 20:
-        print("The directory is too big to be backed up\n")
+    if version >= 2:
+        entries = [field for relpath, f_stat in files
+                   for field in (relpath, int(f_stat.st_mtime), f_stat.st_size)]
+        sent = len(entries) // 3
+    else:
+        cs_socket.sendall("BCK {} {}".format(directory, n_local).encode())
+        sent = 0
+        for relpath, f_stat in files:
+            f_time = strftime("%d.%m.%Y %H:%M:%S", gmtime(f_stat.st_mtime))
+            cs_socket.sendall(" {} {} {}".format(relpath, f_time, f_stat.st_size).encode())
+            sent += 1
+
+    if sent != n_local:
+        print("The directory changed while being backed up, try again\n")
         cs_socket.close()
         return
 
-    # Send the files in the directory to the Central Server
-    # to check which ones should be backed up
+    if version >= 2:
+        send_frame(cs_socket, "BCK", [directory, n_local, *entries])
+    else:
+        cs_socket.sendall("\n".encode())
 
-    cs_socket.sendall("BCK {} {}".format(directory, len(file_list)).encode())
+    reply = read_reply(cs_socket, version)
+    cs_socket.close()
+    return upload_backup(reply, version, user, password, directory)
 
-    for f in file_list:
 
-        f_stat = f.stat()
-        f_time = strftime("%d.%m.%Y %H:%M:%S", gmtime(f_stat.st_mtime))
-        cs_socket.sendall(" {} {} {}".format(f.name, f_time, f_stat.st_size).encode())
+def upload_backup(reply, version, user, password, directory):
+    """ Uploads the files of a BKR reply to the BSs of their shards
 
-    cs_socket.sendall("\n".encode())
+    Returns the shards of the directory, or None if the backup failed.
+    """
 
-    response = read_bytes_until(cs_socket, " \n")
-    bs_ip = read_bytes_until(cs_socket, " \n")
+    backup = parse_backup_reply(reply, version)
+    if backup is None:
+        return
+    entries, shards = backup
 
-    if response != "BKR":
-        print("Protocol was not followed\n")
+    if not entries:
+        print("All files are backed up already\n")
+        return shards
+
+    uploads = plan_uploads(entries, shards)
+    if not uploads:
+        return shards
+
+    from concurrent.futures import ThreadPoolExecutor # deferred, see main
+    with ThreadPoolExecutor(max_workers=len(uploads)) as executor:
+        results = executor.map(lambda upload: upload_files(upload[0], user, password, directory, upload[1]),
+                               uploads)
+
+        all_ok = True
+        for ((ip, port), _files), status in zip(uploads, results):
+            if len(uploads) > 1:
+                print("BS {} {}:".format(ip, port), end=" ")
+            report_upload(status)
+            all_ok = all_ok and status == "OK"
+
+    return shards if all_ok else None
+
+
+def backup_dirs(args, host, port, user, password):
+    """ Backs up several directories at once (BCM/BMR, then UPL/UPR with the BSs)
+
+    The directories are args, or the lines of the file after -f. The CS
+    gets all of them in a single BCM (one per BATCH_MAX_FILES files); the
+    uploads are grouped by BS, each BS gets all of its uploads over a
+    single session, and the BSs are uploaded to at the same time.
+
+    Returns {directory: its shards, or None if it was not backed up}, or
+    None if nothing could be done.
+    """
+
+    if args[:1] == ["-f"] and len(args) == 2:
+        try:
+            with open(args[1]) as paths_file:
+                directories = [line.strip() for line in paths_file if line.strip()]
+        except OSError as error:
+            print("Could not read {} ({})\n".format(args[1], error))
+            return
+    elif args and "-f" not in args:
+        directories = args
+    else:
+        print("Invalid arguments\n")
+        return
+
+    done = {}
+    to_check = []
+    for directory in dict.fromkeys(directories):
+        if " " in directory:
+            print("Skipping {}: spaces are not allowed in names".format(directory))
+        elif not os.path.isdir(directory):
+            print("The directory {} does not exist".format(directory))
+        else:
+            to_check.append(directory)
+            continue
+        done[directory] = None
+    if not to_check:
+        print()
+        return done
+
+    cs_socket, version = cs_session(host, port, user, password)
+    if cs_socket is None:
+        return
+
+    # The files in the tree of each directory, in batches of directories
+    # of at most BATCH_MAX_FILES files (but at least one directory)
+    batches = [[]]
+    n_batch = 0
+    for directory in to_check:
+        files = [field for relpath, f_stat in walk_tree(directory, True)
+                 for field in entry_fields(relpath, int(f_stat.st_mtime), f_stat.st_size,
+                                           version)]
+        n_files = len(files) // (3 if version >= 2 else 4)
+        if batches[-1] and n_batch + n_files > BATCH_MAX_FILES:
+            batches.append([])
+            n_batch = 0
+        batches[-1].append((directory, n_files, files))
+        n_batch += n_files
+
+    uploads_by_bs = {}  # {bs: [(directory, files)]}
+    fallback = []       # directories to back up one by one, with BCK
+    for k, batch in enumerate(batches):
+        reply = [""]
+        if cs_socket is None: # in text, the CS ends the session after each command
+            cs_socket, version = cs_session(host, port, user, password)
+        if cs_socket is not None:
+            reply = request(cs_socket, version,
+                            ["BCM", len(batch)] + [field for directory, n_files, files in batch
+                                                   for field in (directory, n_files, *files)])
+            if version == 1:
+                cs_socket.close()
+                cs_socket = None
+
+        if reply[0] != "BMR":
+            left = [directory for later in batches[k:] for directory, _n_files, _files in later]
+            if reply[0] == "ERR": # a CS that does not know BCM
+                fallback = left
+            else:
+                print("The backup of {} could not be requested\n".format(" ".join(left)))
+            done.update(dict.fromkeys(left))
+            break
+
+        i = 2
+        for directory, _n_files, _files in batch:
+            n_fields = int(reply[i])
+            print("{}:".format(directory))
+            backup = parse_backup_reply(["BKR", *reply[i + 1:i + 1 + n_fields]], version)
+            i += 1 + n_fields
+            if backup is None:
+                done[directory] = None
+                continue
+            entries, shards = backup
+            done[directory] = shards
+            if not entries:
+                print("All files are backed up already\n")
+            for bs, files in plan_uploads(entries, shards):
+                uploads_by_bs.setdefault(bs, []).append((directory, files))
+
+    if cs_socket is not None:
         cs_socket.close()
+
+    from concurrent.futures import ThreadPoolExecutor # deferred, see main
+    with ThreadPoolExecutor(max_workers=max(1, min(BATCH_MAX_BS, len(uploads_by_bs)))) as executor:
+        results = executor.map(lambda bs: upload_batch(bs, user, password, uploads_by_bs[bs]),
+                               uploads_by_bs)
+
+        for bs, statuses in zip(uploads_by_bs, results):
+            for (directory, _files), status in zip(uploads_by_bs[bs], statuses):
+                print("{} to BS {} {}:".format(directory, *bs), end=" ")
+                report_upload(status)
+                if status != "OK":
+                    done[directory] = None
+
+    for directory in fallback:
+        done[directory] = backup_dir([directory], host, port, user, password)
+    return done
+
+
+def report_upload(status):
+    """ Prints the outcome of an upload, from its UPR status """
+
+    if status == "OK":
+        print("File transfer successful\n")
+    elif status == "NOK":
+        print("File transfer unsuccessful\n")
+    else:
+        print("A protocol error ocurred\n")
+
+
+def parse_backup_reply(reply, version):
+    """ The files to upload and the shards of a directory, from its BKR reply
+
+    Returns ([(name, mtime, size)], shards), each shard a list of (ip, port)
+    of its replicas, or None (after saying why) if there is no backup.
+    """
+
+    if reply[0] != "BKR" or len(reply) < 2:
+        print("Protocol was not followed\n")
         return
 
-    elif bs_ip == "ERR":
+    elif reply[1] == "ERR":
         print("An error ocurred sending the backup request\n")
-        cs_socket.close()
         return
 
-    elif bs_ip == "EOF":
+    elif reply[1] == "EOF":
         print("The backup request cannot be answered\n")
-        cs_socket.close()
         return
 
     # Check which files are already backed up
 
-    bs_port = int(read_bytes_until(cs_socket, " "))
-    n_files = int(read_bytes_until(cs_socket, " \n"))
+    bs_ip, bs_port, n_files = reply[1], int(reply[2]), int(reply[3])
+    entries = parse_entries(reply[4:], n_files, version)
 
-    if n_files == 0:
-        print("All files are backed up already\n")
-        cs_socket.close()
-        return
+    # With several shards or replicas, all of them come after the files
+    shards = [[(bs_ip, bs_port)]]
+    placement = reply[4 + (3 if version >= 2 else 4) * n_files:]
+    if placement:
+        shards, i = [], 1
+        for _shard in range(int(placement[0])):
+            n_replicas = int(placement[i])
+            shards.append([(placement[i + 1 + 2*j], int(placement[i + 2 + 2*j]))
+                           for j in range(n_replicas)])
+            i += 1 + 2*n_replicas
+    return entries, shards
 
-    files_to_backup = []
 
-    for _i in range(n_files):
-        filename = read_bytes_until(cs_socket, " ")
-        date = read_bytes_until(cs_socket, " ")
-        date = date + " " + read_bytes_until(cs_socket, " ")  # do not forget hour
-        size = int(read_bytes_until(cs_socket, " \n"))
-        print(filename, date, size)
+def plan_uploads(entries, shards):
+    """ The uploads of the files of a BKR, [(bs, [file])]: each shard to all its replicas """
 
-        for f in file_list:
-            if f.name == filename:
-                files_to_backup.append(f)
+    from lib.placement import shard_of # deferred, see main
+    files_by_shard = [[] for _shard in shards]
 
-    cs_socket.close()
+    for filename, mtime, size in entries:
+        print(filename, format_mtime(mtime), size)
 
-    # create a connection with the Backup Server and send the files
+        if is_safe_path(filename):
+            files_by_shard[shard_of(filename, len(shards))].append(filename)
 
-    bs_socket = tcp_client(bs_ip, bs_port)
+    return [(bs, files) for shard, files in zip(shards, files_by_shard) if files
+            for bs in shard]
 
-    if not authenticate(bs_socket, user, password):
-        return
 
-    bs_socket.sendall("UPL {} {}".format(directory,len(files_to_backup)).encode())
 
-    for f in files_to_backup:
-        f_stat = f.stat()
-        f_time = strftime("%d.%m.%Y %H:%M:%S", gmtime(f_stat.st_mtime))
-        bs_socket.sendall(" {} {} {} ".format(f.name, f_time, f_stat.st_size).encode())
+def upload_files(bs, user, password, directory, files_to_backup):
+    """ Uploads files (paths relative to directory) to a BS (UPL/UPR)
+
+    Returns the UPR status.
+    """
+
+    bs_socket = tcp_client(*bs)
+
+    try:
+        version = authenticate(bs_socket, user, password)
+        if not version:
+            return "ERR"
+        return upload_session(bs_socket, version, directory, files_to_backup)
+    except (ConnectionError, timeout) as error:
+        print("Could not upload to BS {} {} ({})".format(*bs, error))
+        return "ERR"
+    finally:
+        bs_socket.close()
+
+
+def upload_batch(bs, user, password, uploads):
+    """ Uploads [(directory, files)] to a BS over a single session
+
+    In version 2 all the UPL are sent before reading any UPR. Returns the
+    UPR status of each upload.
+    """
+
+    bs_socket = tcp_client(*bs)
+
+    try:
+        version = authenticate(bs_socket, user, password)
+        if not version:
+            return ["ERR"] * len(uploads)
+        if version == 1:
+            return [upload_session(bs_socket, version, directory, files)
+                    for directory, files in uploads]
+        for directory, files in uploads:
+            send_upload(bs_socket, version, directory, files)
+        return [upload_status(bs_socket, version) for _upload in uploads]
+    except (ConnectionError, timeout) as error:
+        print("Could not upload to BS {} {} ({})".format(*bs, error))
+        return ["ERR"] * len(uploads)
+    finally:
+        bs_socket.close()
+
+
+def upload_session(bs_socket, version, directory, files_to_backup):
+    """ Sends one UPL over an authenticated BS session, returns the UPR status
+
+    The session stays open, so that more UPL may follow.
+    """
+
+    send_upload(bs_socket, version, directory, files_to_backup)
+    return upload_status(bs_socket, version)
+
+
+def send_upload(bs_socket, version, directory, files_to_backup):
+    """ Sends an UPL, with the files, without waiting for its UPR """
+
+    if version >= 2:
+        send_frame(bs_socket, "UPL", [directory, len(files_to_backup)])
+    else:
+        bs_socket.sendall("UPL {} {}".format(directory,len(files_to_backup)).encode())
+
+    for relpath in files_to_backup:
+        filefd = os.open(os.path.join(directory, relpath), os.O_RDONLY)
+        f_stat = os.fstat(filefd)
+        if version >= 2:
+            send_frame(bs_socket, "FIL", [relpath, int(f_stat.st_mtime), f_stat.st_size])
+        else:
+            f_time = strftime("%d.%m.%Y %H:%M:%S", gmtime(f_stat.st_mtime))
+            bs_socket.sendall(" {} {} {} ".format(relpath, f_time, f_stat.st_size).encode())
 
-        filefd = os.open(f.path, os.O_RDONLY)
         for chunk in chunked_read_fd(filefd, f_stat.st_size):
             bs_socket.sendall(chunk)
+        os.close(filefd)
 
-    bs_socket.sendall("\n".encode())
+    if version == 1:
+        bs_socket.sendall("\n".encode())
 
-    response = read_bytes_until(bs_socket, " ")
-    status = read_bytes_until(bs_socket, " \n")
 
-    if response == "UPR" and status == "OK":
-        print("File transfer successful\n")
-    elif status == "NOK":
-        print("File transfer unsuccessful\n")
-    else:
-        print("A protocol error ocurred\n")
+def upload_status(bs_socket, version):
+    """ Reads an UPR, returns its status """
 
-    bs_socket.close()
+    reply = read_reply(bs_socket, version)
+    return reply[1] if reply[0] == "UPR" and len(reply) > 1 else "ERR"
+
+
+
+def watch_tree(inotify_fd, directory, reldir, watches):
+    """ Watches reldir (under directory, "" for itself) and its subdirectories
+
+    watches maps each watch descriptor to the path of its directory.
+    Yields the files found along the way; the watches are only all in
+    place once the generator is exhausted.
+    """
+
+    stack = [reldir]
+    while stack:
+        reldir = stack.pop()
+        path = os.path.join(directory, reldir)
+        try:
+            watches[add_watch(inotify_fd, path, WATCH_EVENTS)] = reldir
+            entries = os.scandir(path)
+        except (FileNotFoundError, NotADirectoryError):
+            continue # gone already
+
+        with entries:
+            for entry in entries:
+                if " " in entry.name:
+                    continue
+                relpath = reldir + "/" + entry.name if reldir else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(relpath)
+                elif entry.is_file():
+                    yield relpath
+
+
+def push_to_bs(bs, files, directory, sessions, user, password):
+    """ Uploads files to bs over the session kept with it (opened if needed)
+
+    Returns the UPR status. A session that fails is dropped.
+    """
+
+    try:
+        if bs not in sessions:
+            bs_socket = tcp_client(*bs)
+            version = authenticate(bs_socket, user, password)
+            if not version:
+                return "ERR"
+            sessions[bs] = (bs_socket, version)
+        return upload_session(*sessions[bs], directory, files)
+    except OSError as error:
+        print("Could not upload to BS {} {} ({})".format(*bs, error))
+        session = sessions.pop(bs, None)
+        if session is not None:
+            session[0].close()
+        return "ERR"
+
+
+def push_changes(directory, dirty, shards, sessions, user, password):
+    """ Uploads the dirty files of directory to every replica of their shard
+
+    Returns True if all of them were stored.
+    """
+
+    from lib.placement import shard_of # deferred, see main
+    files_by_shard = [[] for _shard in shards]
+    for relpath in dirty:
+        if os.path.isfile(os.path.join(directory, relpath)):
+            files_by_shard[shard_of(relpath, len(shards))].append(relpath)
+
+    uploads = [(bs, files) for shard, files in zip(shards, files_by_shard) if files
+               for bs in shard]
+    if not uploads:
+        return True
+
+    from concurrent.futures import ThreadPoolExecutor # deferred, see main
+    with ThreadPoolExecutor(max_workers=len(uploads)) as executor:
+        results = list(executor.map(lambda upload: push_to_bs(upload[0], upload[1], directory,
+                                                              sessions, user, password),
+                                    uploads))
+
+    for ((ip, port), files), status in zip(uploads, results):
+        print("{} {} file(s) to BS {} {}: {}".format(strftime("%H:%M:%S"), len(files),
+                                                     ip, port, status))
+    return all(status == "OK" for status in results)
+
+
+def watch_dir(directory, host, port, user, password):
+    """ Continuous backup of a directory (user.py --watch)
+
+    Files written, moved in or touched anywhere in the tree are collected,
+    through inotify, in a dirty set, which is pushed to the BSs over
+    sessions kept open between pushes. Only a failed push or lost events
+    make it go through the CS (and the whole tree) again. Files deleted
+    locally are kept in the backup.
+    """
+
+    inotify_fd = inotify_init()
+    watches = {}    # {wd: directory path, relative to directory}
+    for _file in watch_tree(inotify_fd, directory, "", watches):
+        pass
 
+    # Watching first, so that nothing changed meanwhile is missed
+    shards = backup_dir([directory], host, port, user, password)
+    retry_at = monotonic() + WATCH_RETRY
+    sessions = {}   # {(ip, port): (authenticated socket, protocol version)}
+    dirty = set()
+    first_change = last_change = None
+
+    try:
+        while True:
+            if shards is None:
+                wait = retry_at - monotonic()
+            elif dirty:
+                wait = min(last_change + WATCH_DEBOUNCE,
+                           first_change + WATCH_MAX_DELAY) - monotonic()
+            else:
+                wait = None
+
+            if wait is None or wait > 0:
+                if not select([inotify_fd], [], [], wait)[0]:
+                    continue
+
+                for wd, mask, _cookie, name in read_events(inotify_fd):
+                    if mask & IN_Q_OVERFLOW:
+                        # Events were lost: go through the whole tree again
+                        shards, retry_at = None, 0
+                        continue
+                    if mask & IN_IGNORED:
+                        watches.pop(wd, None)
+                        continue
+                    if wd not in watches or " " in name:
+                        continue
+
+                    relpath = watches[wd] + "/" + name if watches[wd] else name
+                    if not mask & IN_ISDIR:
+                        dirty.add(relpath)
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        dirty.update(watch_tree(inotify_fd, directory, relpath, watches))
+
+                    last_change = monotonic()
+                    if first_change is None:
+                        first_change = last_change
+                continue
+
+            if shards is None:
+                for bs_socket, _version in sessions.values():
+                    bs_socket.close()
+                sessions.clear()
+                dirty.clear()
+                first_change = None
+                shards = backup_dir([directory], host, port, user, password)
+                retry_at = monotonic() + WATCH_RETRY
+
+            elif push_changes(directory, dirty, shards, sessions, user, password):
+                dirty.clear()
+                first_change = None
+
+            else:
+                # Maybe the placement changed: ask the CS again, a bit later
+                shards, retry_at = None, monotonic() + WATCH_RETRY
+
+    finally:
+        for bs_socket, _version in sessions.values():
+            bs_socket.close()
+        os.close(inotify_fd)
 
 
 def restore_dir(args, host, port, user, password):
-    cs_socket = tcp_client(host, port)
+    """ Restores a directory (RST/RSR, then RSB/RBR with the BSs)
+
+    args is [directory] or [directory, snapshot_id], to restore the
+    directory as it was at the time of that snapshot.
+    """
 
-    if not authenticate(cs_socket, user, password):
+    cs_socket, version = cs_session(host, port, user, password)
+    if cs_socket is None:
         return
 
-    if len(args) != 1:
+    if len(args) not in (1, 2):
         print("Invalid arguments\n")
         cs_socket.close()
         return
 
     directory = args[0]
+    as_of = args[1] if len(args) == 2 else None
 
-    cs_socket.sendall("RST {}\n".format(directory).encode())
-
-    response = read_bytes_until(cs_socket, " \n")
-    bs_ip = read_bytes_until(cs_socket, " \n")
+    reply = request(cs_socket, version, ["RST", directory])
+    cs_socket.close()
 
-    if response != "RSR":
+    if reply[0] != "RSR" or len(reply) < 2:
         print("Protocol was not followed\n")
-        cs_socket.close()
         return
 
-    elif bs_ip == "ERR":
+    elif reply[1] == "ERR":
         print("An error ocurred sending the backup request\n")
-        cs_socket.close()
         return
 
-    elif bs_ip == "EOF":
+    elif reply[1] == "EOF":
         print("The backup request cannot be answered\n")
-        cs_socket.close()
         return
 
-    bs_port = int(read_bytes_until(cs_socket, "\n"))
+    # A striped directory comes with one BS per shard
+    servers = [(reply[i], int(reply[i + 1])) for i in range(1, len(reply) - 1, 2)]
 
-    cs_socket.close()
+    # receive the files from all the Backup Servers at the same time
+
+    from concurrent.futures import ThreadPoolExecutor # deferred, see main
+    with ThreadPoolExecutor(max_workers=len(servers)) as executor:
+        results = list(executor.map(lambda bs: download_files(bs, user, password, directory, as_of),
+                                    servers))
+
+    if not all(results):
+        print("The restore of {} failed\n".format(directory))
+    return all(results)
+
+
+
+def download_files(bs, user, password, directory, as_of=None):
+    """ Restores the files a BS has of directory (RSB/RBR)
 
-    # create a connection with the Backup Server and receive the files
+    With as_of, a snapshot id, restores them as of that snapshot. Each
+    file is written aside and renamed over the local one once complete;
+    files that come with a digest are checked against it as they are
+    written, and one that does not match is dropped. Returns True if all
+    the files were restored.
+    """
+    from lib.checksum import new_digest, digested # deferred, see main
 
-    bs_socket = tcp_client(bs_ip, bs_port)
+    bs_socket = tcp_client(*bs)
 
-    if not authenticate(bs_socket, user, password):
+    version = authenticate(bs_socket, user, password)
+    if not version:
         return
 
-    bs_socket.sendall("RSB {}\n".format(directory).encode())
+    if version >= 2:
+        send_frame(bs_socket, "RSB", [directory] + ([as_of] if as_of else []))
+        response, n_files = (read_reply(bs_socket, version) + [""])[:2]
+    else:
+        snapshot = " " + as_of if as_of else ""
+        bs_socket.sendall("RSB {}{}\n".format(directory, snapshot).encode())
 
-    response = read_bytes_until(bs_socket, " \n")
-    n_files = read_bytes_until(bs_socket, " \n")
+        response = read_bytes_until(bs_socket, " \n")
+        n_files = read_bytes_until(bs_socket, " \n")
 
     if response != "RBR":
         print("Protocol was not followed\n")
@@ -262,7 +840,7 @@ def restore_dir(args, host, port, user, password):
     if n_files == 0:
         print("All files are already up to date\n")
         bs_socket.close()
-        return
+        return True
 
     # create directory
     try:
@@ -272,117 +850,172 @@ def restore_dir(args, host, port, user, password):
 
     print("Restoring the following directory: {}\n".format(directory))
 
-
+    restored = True
     for _i in range(n_files):
-        filename = read_bytes_until(bs_socket, " ")
-        date = read_bytes_until(bs_socket, " ")
-        date = date + " " + read_bytes_until(bs_socket, " ") # do not forget hour
-        size = int(read_bytes_until(bs_socket, " "))
-
+        if version >= 2:
+            header = recv_frame(bs_socket)
+            if header is None or header[0] != "FIL":
+                print("Protocol was not followed\n")
+                restored = False
+                break
+            filename, file_mtime, size, *digest = header[1]
+        else:
+            filename = read_bytes_until(bs_socket, " ")
+            date = read_bytes_until(bs_socket, " ")
+            hour = read_bytes_until(bs_socket, " ") # do not forget hour
+            size = int(read_bytes_until(bs_socket, " "))
+            file_mtime = parse_mtime(date, hour)
+            digest = []
+
+        if not is_safe_path(filename):
+            print("ERROR: Refusing to restore {} outside of {}".format(filename, directory))
+            restored = False
+            break
 
-        #Opening file now
+        # Written aside, so that a torn or corrupt file never replaces it
         filepath = os.path.join(directory, filename)
-        filefd = os.open(filepath, os.O_WRONLY | os.O_CREAT, mode=0o660)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        temppath = os.path.join(os.path.dirname(filepath), ".{}.{}.part".format(
+            os.path.basename(filepath), os.getpid()))
 
         written = 0
-        for d in chunked_read_socket(bs_socket, size):
-            written += len(d)
-            os.write(filefd, d)
+        file_digest = new_digest()
+        complete = False
+        try:
+            filefd = os.open(temppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode=0o660)
+            with os.fdopen(filefd, "wb") as tempfile:
+                for d in digested(chunked_read_socket(bs_socket, size), file_digest):
+                    written += len(d)
+                    tempfile.write(d)
+            complete = written == size and (not digest or file_digest.hexdigest() == digest[0])
+        finally:
+            if not complete and os.path.exists(temppath):
+                os.remove(temppath)
+
         if written != size:
             print("ERROR: Unable to fully write {}".format(filename))
+            restored = False
             break
 
-        print("Restored following file: {}\n".format(filename))
-        os.close(filefd)
-
-        # Set mtime to the sent one (and atime to now)
-        file_mtime = timegm(strptime(date, "%d.%m.%Y %H:%M:%S"))
-        os.utime(filepath, times=(timegm(gmtime()), file_mtime))
+        if not complete:
+            print("ERROR: {} is corrupt, it does not match its checksum\n".format(filename))
+            restored = False
+        else:
+            # Set mtime to the sent one (and atime to now)
+            os.utime(temppath, times=(timegm(gmtime()), file_mtime))
+            os.replace(temppath, filepath)
+            print("Restored following file: {}\n".format(filename))
 
-        bs_socket.recv(1)
+        if version == 1:
+            bs_socket.recv(1)
 
 
     bs_socket.close()
+    return restored
 
 
 
-def list_dir(host, port, user, password):
-    cs_socket = tcp_client(host, port)
+def list_dir(args, host, port, user, password):
+    """ Lists the backed up directories (LSD/LDR); with -l, with details (LDS/LDL) """
 
-    if not authenticate(cs_socket, user, password):
+    if args not in ([], ["-l"]):
+        print("Invalid arguments\n")
         return
+    if args:
+        return describe_dirs(host, port, user, password)
 
-    cs_socket.sendall("LSD\n".encode())
+    cs_socket, version = cs_session(host, port, user, password)
+    if cs_socket is None:
+        return
 
-    response = read_bytes_until(cs_socket, " \n")
-    n_files = int(read_bytes_until(cs_socket, " \n"))
+    reply = request(cs_socket, version, ["LSD"])
+    cs_socket.close()
 
-    if response != 'LDR':
+    if reply[0] != 'LDR' or len(reply) < 2:
         print("The request was unsuccessful\n")
-    elif n_files == 0:
+    elif int(reply[1]) == 0:
         print("No directories are backed up yet\n")
     else:
         print("The following directories are backed up:")
-        directories = read_bytes_until(cs_socket, "\n").split()
-        for d in directories:
+        for d in reply[2:2 + int(reply[1])]:
             print(d)
 
+
+def describe_dirs(host, port, user, password):
+    """ Lists the backed up directories with their files, size and last change (LDS/LDL) """
+
+    cs_socket, version = cs_session(host, port, user, password)
+    if cs_socket is None:
+        return
+
+    reply = request(cs_socket, version, ["LDS"])
     cs_socket.close()
 
+    if reply[0] != "LDL" or len(reply) < 2:
+        print("The request was unsuccessful\n")
+        return
+    elif int(reply[1]) == 0:
+        print("No directories are backed up yet\n")
+        return
 
-def filelist_dir(args, host, port, user, password):
-    cs_socket = tcp_client(host, port)
+    # Each directory is its number of files and an entry (name, mtime, size)
+    width = 4 if version >= 2 else 5
+    print("{:<20}{:>8}{:>14}  {}".format("directory", "files", "bytes", "last change (UTC)"))
+    for i in range(int(reply[1])):
+        fields = reply[2 + width*i: 2 + width*(i + 1)]
+        (name, mtime, size), = parse_entries(fields[1:], 1, version)
+        if fields[0] == "NOK":
+            print("{:<20}{:>8}{:>14}  {}".format(name, "?", "?", "(unavailable)"))
+        else:
+            print("{:<20}{:>8}{:>14}  {}".format(name, fields[0], size, format_mtime(mtime)))
+    print()
 
-    if not authenticate(cs_socket, user, password):
+
+def filelist_dir(args, host, port, user, password):
+    cs_socket, version = cs_session(host, port, user, password)
+    if cs_socket is None:
         return
 
-    if len(args) != 1:
+    if len(args) not in (1, 2):
         print("Invalid arguments\n")
         cs_socket.close()
         return
 
-    directory = args[0]
-
-    cs_socket.sendall("LSF {}\n".format(directory).encode())
-
-    response = read_bytes_until(cs_socket, " \n")
-    bs_ip = read_bytes_until(cs_socket, " \n")
-
+    # An optional snapshot id lists the directory as it was then
+    reply = request(cs_socket, version, ["LSF", *args])
+    cs_socket.close()
 
-    if response != "LFD":
+    if reply[0] != "LFD" or len(reply) < 2:
         print("Protocol was not followed\n")
-        cs_socket.close()
         return
 
-    elif bs_ip == "NOK":
+    elif reply[1] == "NOK":
         print("The request cannot be answered\n")
-        cs_socket.close()
         return
 
-    bs_port = read_bytes_until(cs_socket, " ")
-    n_files = int(read_bytes_until(cs_socket, " \n"))
+    bs_ip, bs_port, n_files = reply[1], reply[2], int(reply[3])
 
     print("At the BS in ip {} in port {} there are {} files backed up\n".format(bs_ip, bs_port, n_files))
 
     print("The files are:")
 
-    for i in range(n_files):
-        filename = read_bytes_until(cs_socket, " ")
-        date = read_bytes_until(cs_socket, " ")
-        date = date + " " + read_bytes_until(cs_socket, " ") # do not forget hour
-        size = int(read_bytes_until(cs_socket, " \n"))
-
-        print(" - {} {} {}".format(filename, date, size))
+    # A CS that knows checksums sends the digest of each file too
+    if version >= 2 and len(reply[4:]) == 4 * n_files:
+        for filename, mtime, size, digest in parse_entries(reply[4:], n_files, version, True):
+            print(" - {} {} {} {}".format(filename, format_mtime(mtime), size, digest))
+    else:
+        for filename, mtime, size in parse_entries(reply[4:], n_files, version):
+            print(" - {} {} {}".format(filename, format_mtime(mtime), size))
 
     print()
-    cs_socket.close()
 
 
 
-def delete_dir(args, host, port, user, password):
-    cs_socket = tcp_client(host, port)
+def snapshots_dir(args, host, port, user, password):
+    """ Lists the snapshots of a directory (LSN/LNR) """
 
-    if not authenticate(cs_socket, user, password):
+    cs_socket, version = cs_session(host, port, user, password)
+    if cs_socket is None:
         return
 
     if len(args) != 1:
@@ -390,14 +1023,40 @@ def delete_dir(args, host, port, user, password):
         cs_socket.close()
         return
 
-    cs_socket.sendall("DEL {}\n".format(args[0]).encode())
+    reply = request(cs_socket, version, ["LSN", args[0]])
+    cs_socket.close()
+
+    if len(reply) < 2 or reply[0] != "LNR":
+        print("Protocol was not followed\n")
+    elif reply[1] == "NOK":
+        print("The request cannot be answered\n")
+    elif int(reply[1]) == 0:
+        print("There are no snapshots of {} yet\n".format(args[0]))
+    else:
+        print("Snapshots of {} (restore or filelist {} <snapshot>):".format(args[0], args[0]))
+        for snap_id in reply[2:2 + int(reply[1])]:
+            print(" - {} ({}.{}.{} {}:{}:{} UTC)".format(snap_id, snap_id[6:8], snap_id[4:6], snap_id[:4],
+                                                     snap_id[8:10], snap_id[10:12], snap_id[12:]))
+        print()
 
-    response = read_bytes_until(cs_socket, "\n")
 
-    if response == "DDR OK":
+
+def delete_dir(args, host, port, user, password):
+    cs_socket, version = cs_session(host, port, user, password)
+    if cs_socket is None:
+        return
+
+    if len(args) != 1:
+        print("Invalid arguments\n")
+        cs_socket.close()
+        return
+
+    response = request(cs_socket, version, ["DEL", args[0]])
+
+    if response == ["DDR", "OK"]:
         print("The request was successful\n")
 
-    elif response == "DDR NOK":
+    elif response == ["DDR", "NOK"]:
         print("The request was unsuccessful\n")
 
     cs_socket.close()
@@ -418,11 +1077,20 @@ def exit_user():
 
 
 def main():
-    cs_host = get_best_ip()
+    """ user.py main
+
+    Only what every command needs is imported at startup; what only some
+    need (thread pools, sharding, checksums, inotify, getpass) is imported by them, and
+    the address of the CS is only looked up if -n does not give it.
+    """
+
+    cs_host = None
     cs_port = 58028
+    watch = None        # directory to back up continuously
+    watch_user = None
 
     try:
-        opts = getopt.getopt(sys.argv[1:], "n:p:")[0]
+        opts = getopt.getopt(sys.argv[1:], "n:p:u:", ["watch="])[0]
     except getopt.GetoptError as error:
         print(error)
         sys.exit(2)
@@ -433,6 +1101,28 @@ def main():
             cs_host = arg
         elif opt == '-p':
             cs_port = int(arg)
+        elif opt == '-u':
+            watch_user = arg
+        elif opt == '--watch':
+            watch = arg
+
+    if cs_host is None:
+        cs_host = get_best_ip()
+
+    if watch is not None:
+        if watch_user is None or not os.path.isdir(watch):
+            print("Usage: user.py [-n cs_ip] [-p cs_port] -u user --watch directory")
+            sys.exit(2)
+
+        from getpass import getpass
+        user, password = login_user([watch_user, getpass()], cs_host, cs_port)
+        if not user:
+            sys.exit(1)
+        try:
+            watch_dir(watch, cs_host, cs_port, user, password)
+        except KeyboardInterrupt:
+            pass
+        return
 
     current_user = ''
     current_password = ''
@@ -453,17 +1143,23 @@ def main():
                 current_user, current_password = delete_user(cs_host, cs_port, current_user, current_password)
 
             elif command == 'backup':
-                backup_dir(args, cs_host, cs_port, current_user, current_password)
+                if len(args) == 1:
+                    backup_dir(args, cs_host, cs_port, current_user, current_password)
+                else:
+                    backup_dirs(args, cs_host, cs_port, current_user, current_password)
 
             elif command == 'restore':
                 restore_dir(args, cs_host, cs_port, current_user, current_password)
 
             elif command == 'dirlist':
-                list_dir(cs_host, cs_port, current_user, current_password)
+                list_dir(args, cs_host, cs_port, current_user, current_password)
 
             elif command == 'filelist':
                 filelist_dir(args, cs_host, cs_port, current_user, current_password)
 
+            elif command == 'snapshots':
+                snapshots_dir(args, cs_host, cs_port, current_user, current_password)
+
             elif command == 'delete':
                 delete_dir(args, cs_host, cs_port, current_user, current_password)
 